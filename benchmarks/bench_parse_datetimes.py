@@ -0,0 +1,41 @@
+# Copyright (C) 2020 Weixuan Zhang
+#
+# SPDX-License-Identifier: MIT
+"""Micro-benchmark of parsing the date-times of a 1000 day, 15 minute
+readings history, with dateutil row by row against the vectorised
+datafetcher.parse_datetimes.
+
+Run from the repository root with
+``python -m benchmarks.bench_parse_datetimes``.
+"""
+
+import json
+import os
+import timeit
+
+import dateutil.parser
+
+from floodsystem.datafetcher import parse_datetimes
+
+FIXTURE = os.path.join(
+    os.path.dirname(__file__), "..", "tests", "fixtures", "readings.json"
+)
+
+
+def run(days=1000, repeat=5):
+    with open(FIXTURE) as f:
+        items = json.load(f)["items"]
+    # the fixture holds one day of readings
+    strings = [i["dateTime"] for i in items] * days
+    print("Parsing {} date-times".format(len(strings)))
+
+    for name, func in (
+        ("dateutil", lambda: [dateutil.parser.parse(s) for s in strings]),
+        ("parse_datetimes", lambda: parse_datetimes(strings)),
+    ):
+        t = min(timeit.repeat(func, number=1, repeat=repeat))
+        print("{:>16}: {:8.1f} ms".format(name, t * 1000))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,63 @@
+# Copyright (C) 2020 Weixuan Zhang
+#
+# SPDX-License-Identifier: MIT
+"""Benchmark of the forecast latency per station of predictor.predict,
+comparing the batched rollout with the previous loop of one model.predict
+call and one np.append per step, on an untrained model and synthetic levels.
+
+Needs Keras. Run from the repository root with
+``python -m benchmarks.bench_predictor``.
+"""
+
+import timeit
+
+import numpy as np
+
+from floodsystem.predictor import build_model, rollout
+
+
+def loop_rollout(model, window, steps):
+    """The rollout of predictor.predict before it was batched"""
+
+    lookback = len(window)
+    predictions = None
+    levels = window.reshape(1, 1, lookback)
+    for _ in range(steps):
+        prediction = model.predict(levels)
+        levels = np.append(
+            levels[:, :, -lookback + 1 :], prediction.reshape(1, 1, 1), axis=2
+        )
+        predictions = (
+            np.append(predictions, prediction, axis=0)
+            if predictions is not None
+            else prediction
+        )
+    return predictions
+
+
+def run(lookback=200, iteration=100, display=300, repeat=3):
+    rng = np.random.RandomState(0)
+    model = build_model(lookback)
+    forecast = rng.uniform(0, 1, lookback).astype(np.float32)
+    demo = rng.uniform(0, 1, lookback).astype(np.float32)
+
+    def before():
+        loop_rollout(model, forecast, iteration)
+        loop_rollout(model, demo, display)
+
+    def after():
+        rollout(model, np.stack((forecast, demo)), max(iteration, display))
+
+    print(
+        "lookback {}, {} forecast and {} demo steps per station".format(
+            lookback, iteration, display
+        )
+    )
+    for name, func in (("loop predict", before), ("batched rollout", after)):
+        func()  # warm up
+        t = min(timeit.repeat(func, number=1, repeat=repeat))
+        print("{:>16}: {:8.1f} ms/station".format(name, t * 1000))
+
+
+if __name__ == "__main__":
+    run()
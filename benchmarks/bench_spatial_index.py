@@ -0,0 +1,59 @@
+# Copyright (C) 2020 Weixuan Zhang
+#
+# SPDX-License-Identifier: MIT
+"""Benchmark of radius and nearest station queries with geo.SpatialIndex
+against a linear scan with geo.haversine_many, on synthetic points spread
+over England.
+
+Run from the repository root with
+``python -m benchmarks.bench_spatial_index``.
+"""
+
+import timeit
+
+import numpy as np
+
+from floodsystem.geo import SpatialIndex, haversine_many
+
+
+def run(sizes=(5000, 50000, 500000), queries=200, r=20, k=5):
+    rng = np.random.RandomState(0)
+    centres = np.column_stack(
+        (rng.uniform(50, 55, queries), rng.uniform(-5, 1, queries))
+    )
+    for n in sizes:
+        coords = np.column_stack((rng.uniform(50, 55, n), rng.uniform(-5, 1, n)))
+        t_build = min(timeit.repeat(lambda: SpatialIndex(coords), number=1, repeat=3))
+        index = SpatialIndex(coords)
+
+        def scan_radius():
+            for c in centres:
+                np.flatnonzero(haversine_many(coords, c) <= r)
+
+        def scan_nearest():
+            for c in centres:
+                d = haversine_many(coords, c)
+                nearest = np.argpartition(d, k)[:k]
+                nearest[np.argsort(d[nearest])]
+
+        def index_radius():
+            for c in centres:
+                index.within_radius(c, r)
+
+        def index_nearest():
+            for c in centres:
+                index.nearest(c, k)
+
+        print("{} points, index built in {:.1f} ms".format(n, t_build * 1000))
+        for name, func in (
+            ("scan radius", scan_radius),
+            ("index radius", index_radius),
+            ("scan nearest", scan_nearest),
+            ("index nearest", index_nearest),
+        ):
+            t = min(timeit.repeat(func, number=1, repeat=3)) / queries
+            print("{:>16}: {:8.3f} ms/query".format(name, t * 1000))
+
+
+if __name__ == "__main__":
+    run()
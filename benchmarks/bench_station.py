@@ -0,0 +1,98 @@
+# Copyright (C) 2020 Weixuan Zhang
+#
+# SPDX-License-Identifier: MIT
+"""Memory and time benchmark of a synthetic national-scale station list,
+comparing MonitoringStation with the previous __dict__-based class that
+recomputed the relative level on every call.
+
+Run from the repository root with ``python -m benchmarks.bench_station``.
+"""
+
+import random
+import timeit
+import tracemalloc
+
+from floodsystem.flood import stations_highest_rel_level, stations_level_over_threshold
+from floodsystem.station import MonitoringStation
+
+
+class DictStation:
+    """MonitoringStation before it was given __slots__ and memoisation"""
+
+    def __init__(
+        self, station_id, measure_id, label, coord, typical_range, river, town
+    ):
+        self._station_id = station_id
+        self._measure_id = measure_id
+        self._name = label
+        self._coord = coord
+        self._typical_range = typical_range
+        self._river = river
+        self._town = town
+        self.latest_level = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def typical_range(self):
+        return self._typical_range
+
+    def typical_range_consistent(self):
+        return (
+            type(self._typical_range) is tuple
+            and self._typical_range != (0.0, 0.0)
+            and self._typical_range[0] < self.typical_range[1]
+        )
+
+    def relative_water_level(self):
+        return (
+            (self.latest_level - self.typical_range[0])
+            / (self.typical_range[1] - self.typical_range[0])
+            if self.latest_level is not None and self.typical_range_consistent() is True
+            else None
+        )
+
+
+def build(cls, n, seed=0):
+    rng = random.Random(seed)
+    stations = []
+    for i in range(n):
+        low = rng.uniform(0, 1)
+        s = cls(
+            "station-{}".format(i),
+            "measure-{}".format(i),
+            "Station {}".format(i),
+            (rng.uniform(50, 55), rng.uniform(-5, 1)),
+            None if i % 20 == 0 else (low, low + rng.uniform(0, 2)),
+            "River {}".format(i % 1000),
+            "Town {}".format(i % 3000),
+        )
+        s.latest_level = None if i % 10 == 0 else rng.uniform(0, 3)
+        stations.append(s)
+    return stations
+
+
+def run(n=50000, repeat=5):
+    print("{} stations".format(n))
+    for cls in (DictStation, MonitoringStation):
+        tracemalloc.start()
+        stations = build(cls, n)
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        def query():
+            stations_level_over_threshold(stations, 0.8)
+            stations_highest_rel_level(stations, 10)
+
+        t = min(timeit.repeat(query, number=1, repeat=repeat))
+        print(
+            "{:>18}: {:6.1f} MB, threshold + top 10: {:7.1f} ms".format(
+                cls.__name__, size / 2 ** 20, t * 1000
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
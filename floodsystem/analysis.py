@@ -1,7 +1,7 @@
 # Copyright (C) 2020 Ghifari Pradana
 #
 # SPDX-License-Identifier: MIT
-"""This module contains function for polynomial fitting on data"""
+"""This module contains functions for polynomial fitting and downsampling of data"""
 import numpy as np
 from matplotlib.dates import date2num
 
@@ -11,17 +11,236 @@ def polyfit(dates, levels, p):
     Function that finds the least-square fit polynomial from
 
     Args:
-        dates (list): The list of dates for the x-axis.
-        levels (list): The corresponding water level for each date, y-axis.
+        dates (list or array): The dates for the x-axis, datetime objects or numpy datetime64.
+        levels (list or array): The corresponding water level for each date, y-axis.
         p (int): The degree of polynomial that is desired.
 
     Returns:
         numpy poly1d Object: Contains the coefficients of the resulting polynomial
         float: The number of days since the origin of the Gregorain Calendar that was shifted to find the polynomial.
+
+    Raises:
+        ValueError: If there are no dates to fit.
     """
+    if len(dates) == 0:
+        raise ValueError("No dates to fit a polynomial to")
     dates_num = date2num(dates)
-    x = [date - dates_num[-1] for date in dates_num]
+    x = dates_num - dates_num[-1]
     y = levels
     p_coeff = np.polyfit(x, y, p)
     poly = np.poly1d(p_coeff)
     return poly, dates_num[-1]
+
+
+def _as_float(x):
+    """Return dates or numbers as a float array, dates in days"""
+
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype("datetime64[s]").astype(np.float64) / 86400.0
+    if x.dtype == object:
+        return date2num(x)
+    return x.astype(np.float64)
+
+
+def lttb(x, y, n):
+    """
+    Function that downsamples a line with the Largest-Triangle-Three-Buckets
+    algorithm, which keeps the points that shape the line most, so peaks survive.
+
+    Args:
+        x (list or array): The x values in ascending order, may be dates.
+        y (list or array): The corresponding y values.
+        n (int): The number of points to keep, at least 3.
+
+    Returns:
+        array: Indices of the points kept, in ascending order.
+    """
+    length = len(y)
+    if n >= length or n < 3:
+        return np.arange(length)
+    x = _as_float(x)
+    y = np.asarray(y, dtype=np.float64)
+
+    # the first and last points are kept, the rest is split into n - 2 buckets
+    edges = (np.linspace(1, length - 1, n - 1)).astype(np.int64)
+    sums_x = np.add.reduceat(x[1:-1], edges[:-1] - 1)
+    sums_y = np.add.reduceat(y[1:-1], edges[:-1] - 1)
+    counts = np.diff(edges)
+    # the third point of each triangle is the average of the next bucket
+    next_x = np.append(sums_x[1:] / counts[1:], x[-1])
+    next_y = np.append(sums_y[1:] / counts[1:], y[-1])
+
+    indices = np.empty(n, dtype=np.int64)
+    indices[0], indices[-1] = 0, length - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        area = np.abs(
+            (x[a] - next_x[i]) * (y[lo:hi] - y[a])
+            - (x[a] - x[lo:hi]) * (next_y[i] - y[a])
+        )
+        a = lo + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+def minmax(x, y, n):
+    """
+    Function that downsamples a line by keeping the lowest and highest point
+    of each of n buckets of equal width in x, one bucket per pixel.
+
+    Args:
+        x (list or array): The x values in ascending order, may be dates.
+        y (list or array): The corresponding y values.
+        n (int): The number of buckets, at most 2n + 2 points are kept.
+
+    Returns:
+        array: Indices of the points kept, in ascending order.
+    """
+    length = len(y)
+    if 2 * n + 2 >= length or n < 1:
+        return np.arange(length)
+    x = _as_float(x)
+    y = np.asarray(y, dtype=np.float64)
+
+    span = x[-1] - x[0]
+    if span <= 0:
+        buckets = np.zeros(length, dtype=np.int64)
+    else:
+        buckets = np.minimum(((x - x[0]) * (n / span)).astype(np.int64), n - 1)
+    starts = np.flatnonzero(np.diff(buckets, prepend=-1))
+    ends = np.append(starts[1:], length)
+    # x is sorted, so sorting by bucket then y keeps the buckets in place
+    order = np.lexsort((y, buckets))
+    kept = np.concatenate(([0, length - 1], order[starts], order[ends - 1]))
+    return np.unique(kept)
+
+
+def decimate(x, y, n, method="minmax"):
+    """
+    Function that downsamples a line to about n points for plotting.
+
+    Args:
+        x (list or array): The x values in ascending order, may be dates.
+        y (list or array): The corresponding y values.
+        n (int): The width of the plot in pixels.
+        method (str, optional): "minmax" to keep the extremes of every pixel,
+            or "lttb" to keep n points with :func:`lttb`.
+
+    Returns:
+        array: The x values kept.
+        array: The corresponding y values.
+    """
+    if method == "minmax":
+        indices = minmax(x, y, n)
+    elif method == "lttb":
+        indices = lttb(x, y, n)
+    else:
+        raise ValueError("Unknown decimation method {!r}".format(method))
+    return np.asarray(x)[indices], np.asarray(y)[indices]
+
+
+def aggregate(dates, levels, period):
+    """
+    Function that aggregates readings into buckets of a fixed period.
+
+    Args:
+        dates (array): The dates in chronological order, numpy datetime64.
+        levels (array): The corresponding water level for each date.
+        period (numpy timedelta64): The length of the buckets, counted from the epoch.
+
+    Returns:
+        array: The start date of each bucket holding readings.
+        array: The lowest level in each bucket.
+        array: The mean level in each bucket.
+        array: The highest level in each bucket.
+    """
+    dates = np.asarray(dates, dtype="datetime64[s]")
+    levels = np.asarray(levels, dtype=np.float64)
+    period = np.timedelta64(period, "s")
+    if len(dates) == 0:
+        empty = np.empty(0)
+        return dates, empty, empty, empty
+    buckets = (dates - np.datetime64(0, "s")) // period
+    starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+    counts = np.diff(np.append(starts, len(levels)))
+    return (
+        np.datetime64(0, "s") + buckets[starts] * period,
+        np.minimum.reduceat(levels, starts),
+        np.add.reduceat(levels, starts) / counts,
+        np.maximum.reduceat(levels, starts),
+    )
+
+
+class LevelPyramid:
+    """This class represents a readings history at several resolutions: the
+    raw readings, and their hourly, daily and weekly aggregates, so that a
+    window of any length can be served in a bounded number of points.
+
+    Attributes:
+        dates (array): Dates of the raw readings.
+        levels (array): Raw water levels.
+        periods (tuple): Names and periods of the aggregates, finest first.
+        aggregates (dict): Maps the names to the (dates, low, mean, high)
+            arrays of the aggregates, see :func:`aggregate`.
+    """
+
+    PERIODS = (
+        ("hourly", np.timedelta64(1, "h")),
+        ("daily", np.timedelta64(1, "D")),
+        ("weekly", np.timedelta64(7, "D")),
+    )
+
+    def __init__(self, dates, levels, periods=PERIODS):
+        self.dates = np.asarray(dates, dtype="datetime64[s]")
+        self.levels = np.asarray(levels, dtype=np.float64)
+        self.periods = tuple(periods)
+        self.aggregates = {
+            name: aggregate(self.dates, self.levels, period)
+            for name, period in self.periods
+        }
+
+    def __len__(self):
+        return len(self.dates)
+
+    def level(self, name):
+        """
+        Function that returns the readings of a resolution.
+
+        Args:
+            name (str): "raw", or the name of an aggregate.
+
+        Returns:
+            tuple: (dates, low, mean, high) arrays, low and high being the
+            levels themselves for the raw readings.
+        """
+        if name == "raw":
+            return self.dates, self.levels, self.levels, self.levels
+        return self.aggregates[name]
+
+    def select(self, start=None, end=None, max_points=1200):
+        """
+        Function that returns the finest resolution with at most max_points
+        readings between start and end, or the coarsest one if none fits.
+
+        Args:
+            start (numpy datetime64, optional): Start of the window, the first reading if None.
+            end (numpy datetime64, optional): End of the window, the last reading if None.
+            max_points (int, optional): The most readings to return.
+
+        Returns:
+            str: The name of the resolution, "raw" for the raw readings.
+            dict: "dates", "levels", "low" and "high" arrays of the window,
+            with one reading either side so a line reaches its edges.
+        """
+        for name in ("raw",) + tuple(name for name, _ in self.periods):
+            dates, low, mean, high = self.level(name)
+            lo = 0 if start is None else np.searchsorted(dates, start)
+            hi = len(dates) if end is None else np.searchsorted(dates, end, "right")
+            if hi - lo <= max_points:
+                break
+        lo, hi = max(lo - 1, 0), min(hi + 1, len(dates))
+        return name, dict(
+            dates=dates[lo:hi], levels=mean[lo:hi], low=low[lo:hi], high=high[lo:hi]
+        )
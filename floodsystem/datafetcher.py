@@ -6,12 +6,176 @@ latest time history level data
 
 """
 
+import collections
+import contextlib
 import datetime
+import hashlib
 import json
+import logging
 import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlsplit
 
 import dateutil.parser
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+
+try:
+    from .analysis import LevelPyramid
+except ImportError:
+    from analysis import LevelPyramid
+
+# URL for retrieving data for active stations with river level
+# monitoring (see
+# http://environment.data.gov.uk/flood-monitoring/doc/reference)
+STATION_URL = "http://environment.data.gov.uk/flood-monitoring/id/stations?status=Active&parameter=level&qualifier=Stage&_view=full"  # noqa
+
+# URL for retrieving latest levels
+LEVEL_URL = "http://environment.data.gov.uk/flood-monitoring/id/measures?parameter=level&qualifier=Stage&qualifier=level"  # noqa
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+_timeout = (5, 60)
+
+_stats = {
+    "requests": 0,
+    "not_modified": 0,
+    "connections_opened": 0,
+    "bytes_received": 0,
+    "bytes_decoded": 0,
+}
+_stats_lock = threading.Lock()
+
+
+def _count(key, n=1):
+    with _stats_lock:
+        _stats[key] += n
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _count("connections_opened")
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _count("connections_opened")
+        return super()._new_conn()
+
+
+class _CountingAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+def configure_session(timeout=(5, 60), pool_connections=4, pool_maxsize=16):
+    """Configure the HTTP session shared by all requests of this module.
+
+    The session keeps connections alive and reuses them across calls,
+    and asks for gzip/deflate compressed responses.
+
+    Args:
+        timeout (float or tuple, optional): Connect and read timeouts in seconds,
+            see the requests documentation (default (5, 60))
+        pool_connections (int, optional): Number of hosts to keep connection pools for (default 4)
+        pool_maxsize (int, optional): Maximum number of connections kept alive per host (default 16)
+    """
+    global _session, _timeout
+    session = requests.Session()
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    adapter = _CountingAdapter(
+        pool_connections=pool_connections, pool_maxsize=pool_maxsize
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    with _session_lock:
+        old, _session, _timeout = _session, session, timeout
+    if old is not None:
+        old.close()
+
+
+def get_session():
+    """Return the shared HTTP session, creating it on first use
+
+    Returns:
+        requests.Session: The session
+    """
+    if _session is None:
+        configure_session()
+    return _session
+
+
+def transfer_stats():
+    """Return counters of the HTTP traffic of this module
+
+    Returns:
+        dict: With keys
+
+            * 'requests' - number of requests sent
+            * 'not_modified' - number of 304 Not Modified responses
+            * 'connections_opened' - number of new connections
+            * 'bytes_received' - response body bytes read from the network
+            * 'bytes_decoded' - response body bytes after decompression
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_transfer_stats():
+    """Reset all counters returned by :func:`transfer_stats` to zero"""
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+
+def _conditional_headers(validators):
+    headers = {}
+    if validators is not None:
+        etag, last_modified = validators
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+def fetch_conditional(url, validators=None):
+    """Fetch data from url, unless it has not changed since a previous fetch
+
+    Args:
+        url (str): url to be fetched
+        validators (tuple, optional): (etag, last_modified) returned by a previous call
+
+    Returns:
+        tuple: (data, validators), where data is None if the server
+        reports the resource as not modified
+    """
+    headers = _conditional_headers(validators)
+    r = get_session().get(url, headers=headers, timeout=_timeout)
+    _count("requests")
+    if r.status_code == 304:
+        _count("not_modified")
+        return None, validators
+    r.raise_for_status()
+
+    content = r.content
+    _count("bytes_received", r.raw.tell())
+    _count("bytes_decoded", len(content))
+    data = r.json()
+    return data, (r.headers.get("ETag"), r.headers.get("Last-Modified"))
 
 
 def fetch(url):
@@ -23,19 +187,189 @@ def fetch(url):
     Returns:
         dict: Json string fetched
     """
-    r = requests.get(url)
-    data = r.json()
+    data, _ = fetch_conditional(url)
     return data
 
 
+def fetch_to_file(url, filename, validators=None):
+    """Stream the data at url into a file, unless it has not changed since
+    a previous fetch. The response is written as it arrives, without being
+    held in memory, and the file is only replaced once it is complete.
+
+    Args:
+        url (str): url to be fetched
+        filename (str): Path to file
+        validators (tuple, optional): (etag, last_modified) returned by a previous call
+
+    Returns:
+        tuple: (modified, validators), where modified is False if the
+        server reports the resource as not modified
+    """
+    headers = _conditional_headers(validators)
+    with get_session().get(url, headers=headers, timeout=_timeout, stream=True) as r:
+        _count("requests")
+        if r.status_code == 304:
+            _count("not_modified")
+            return False, validators
+        r.raise_for_status()
+
+        decoded = 0
+        with _atomic_file(filename, "wb") as f:
+            for chunk in r.iter_content(2 ** 16):
+                f.write(chunk)
+                decoded += len(chunk)
+        _count("bytes_received", r.raw.tell())
+        _count("bytes_decoded", decoded)
+        return True, (r.headers.get("ETag"), r.headers.get("Last-Modified"))
+
+
+def iter_items(f, chunk_size=2 ** 16):
+    """Generator of the elements of the "items" array of a JSON object
+    read from a file, parsed one at a time.
+
+    Only the element being parsed is held in memory, rather than the whole
+    document. Other members of the object are parsed and discarded.
+
+    Args:
+        f (file): Text file, read in chunks
+        chunk_size (int, optional): Number of characters read at a time
+
+    Yields:
+        dict: Json string of each item
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+
+    def more():
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf, pos = buf[pos:] + chunk, 0
+
+    def peek():
+        # next non-whitespace character, "" at the end of the file
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf[pos : pos + 1]
+            more()
+
+    def expect(chars):
+        nonlocal pos
+        c = peek()
+        if not c or c not in chars:
+            raise ValueError("Expected one of {!r} in JSON, got {!r}".format(chars, c))
+        pos += 1
+        return c
+
+    def value():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                end = None
+            # a value ending with the buffer may continue in the next chunk
+            if end is not None and (end < len(buf) or eof):
+                pos = end
+                return obj
+            if eof:
+                raise ValueError("Invalid or truncated JSON")
+            more()
+
+    expect("{")
+    if peek() == "}":
+        return
+    while True:
+        key = value()
+        expect(":")
+        if key == "items":
+            expect("[")
+            if peek() == "]":
+                pos += 1
+            else:
+                while True:
+                    yield value()
+                    if expect(",]") == "]":
+                        break
+        else:
+            value()
+        if expect(",}") == "}":
+            return
+
+
+def _is_transient(error):
+    """Whether a failed request is worth retrying (connection problems,
+    timeouts, throttling and server side errors)"""
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+        return status is None or status == 429 or status >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def _with_retry(func, retries, backoff, limiter):
+    """Call func, retrying transient request failures with exponential
+    backoff. The limiter is held during each attempt, but not while
+    backing off."""
+    for attempt in range(retries + 1):
+        try:
+            if limiter is None:
+                return func()
+            with limiter:
+                return func()
+        except requests.RequestException as e:
+            if attempt == retries or not _is_transient(e):
+                raise
+        time.sleep(backoff * 2 ** attempt)
+
+
+def fetch_with_retry(url, retries=3, backoff=0.5, limiter=None):
+    """Fetch data from url, retrying transient failures with exponential backoff
+
+    Args:
+        url (str): url to be fetched
+        retries (int, optional): Number of retries after the first attempt (default 3)
+        backoff (float, optional): Delay in seconds before the first retry,
+            doubled on every subsequent retry (default 0.5)
+        limiter (threading.Semaphore, optional): Held for the duration of each
+            attempt, but not while backing off
+
+    Returns:
+        dict: Json string fetched
+    """
+    return _with_retry(lambda: fetch(url), retries, backoff, limiter)
+
+
+@contextlib.contextmanager
+def _atomic_file(filename, mode="w"):
+    """Context manager opening a temporary file, which replaces filename
+    once it is closed without error"""
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(filename) or ".", prefix=".tmp-", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
 def dump(data, filename):
     """Save JSON object to file
 
+    The file is written under a temporary name and then renamed, so
+    readers never see a partially written file.
+
     Args:
         data (dict): Json string to be saved
         filename (str): Path to file
     """
-    with open(filename, "w") as f:
+    with _atomic_file(filename) as f:
         json.dump(data, f)
 
 
@@ -53,15 +387,385 @@ def load(filename):
     return data
 
 
+# (time to live, additional time a stale copy may be served while it is
+# revalidated in the background) in seconds, of each kind of cached resource
+CACHE_POLICY = {
+    "station_data": (24 * 3600, 7 * 24 * 3600),
+    "level_data": (15 * 60, 15 * 60),
+    # readings history is brought up to date incrementally, see
+    # fetch_measure_readings, so it is never served stale
+    "readings": (15 * 60, 0),
+}
+
+
+class Cache:
+    """This class represents an on-disk cache of fetched data.
+
+    Every entry is stored either as ``<key>.json`` in the cache directory,
+    or as columns of NumPy arrays in ``<key>.<token>.<column>.npy`` files
+    which can be memory-mapped. Next to it, a ``<key>.meta.json`` file
+    records when it was fetched and the HTTP validators used to revalidate
+    it. All files are written atomically. Once the total size of the
+    entries exceeds max_bytes, the least recently used entries are evicted.
+
+    Attributes:
+        directory (str): Path of the cache directory.
+        max_bytes (int): Size limit of the cache in bytes.
+    """
+
+    def __init__(self, directory="cache", max_bytes=512 * 2 ** 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._revalidating = set()
+
+    def path(self, key):
+        """str: Path of the data file of an entry"""
+        return os.path.join(self.directory, key + ".json")
+
+    def _meta_path(self, key):
+        return os.path.join(self.directory, key + ".meta.json")
+
+    def lock(self, key):
+        """Return the lock serialising updates of an entry within this process
+
+        Args:
+            key (str): Key of the entry
+
+        Returns:
+            threading.Lock: The lock
+        """
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def read(self, key):
+        """Return the cached data of an entry, or None if there is none
+
+        Args:
+            key (str): Key of the entry
+
+        Returns:
+            dict: Json string
+        """
+        path = self.path(key)
+        try:
+            data = load(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass
+        return data
+
+    def read_meta(self, key):
+        """Return the metadata of an entry, or None if there is none
+
+        Args:
+            key (str): Key of the entry
+
+        Returns:
+            dict: With keys 'fetched' (UNIX time), 'etag' and 'last_modified'
+        """
+        try:
+            return load(self._meta_path(key))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def age(self, key):
+        """Return the time in seconds since an entry was last fetched or
+        revalidated, or None if there is no such entry
+
+        Args:
+            key (str): Key of the entry
+
+        Returns:
+            float: Age in seconds
+        """
+        meta = self.read_meta(key)
+        return None if meta is None else time.time() - meta["fetched"]
+
+    def write(self, key, data, validators=(None, None)):
+        """Store data as an entry, then evict entries if over the size limit
+
+        Args:
+            key (str): Key of the entry
+            data (dict): Json string
+            validators (tuple, optional): (etag, last_modified) of the data
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        dump(data, path)
+        self._touch(key, validators)
+        self.evict(keep=key)
+
+    def write_arrays(self, key, columns, evict=True, **info):
+        """Store NumPy arrays as an entry, then evict entries if over the size limit.
+
+        Every column is saved to a new ``.npy`` file, and the entry is
+        switched over to the new files by atomically replacing its metadata,
+        so readers always see a consistent set of columns.
+
+        Args:
+            key (str): Key of the entry
+            columns (dict): Maps column names to arrays
+            evict (bool, optional): Whether to evict entries, or leave it to
+                the caller after a batch of writes (default True)
+            **info: Additional fields stored in the metadata of the entry
+        """
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        old = self.read_meta(key)
+        token = uuid.uuid4().hex[:8]
+        files = {}
+        for name, array in columns.items():
+            files[name] = "{}.{}.{}.npy".format(os.path.basename(key), token, name)
+            with _atomic_file(
+                os.path.join(os.path.dirname(path), files[name]), "wb"
+            ) as f:
+                np.save(f, np.ascontiguousarray(array))
+        self._touch(key, (None, None), columns=files, **info)
+        if old is not None:
+            self._remove_columns(key, old)
+        if evict:
+            self.evict(keep=key)
+
+    def read_arrays(self, key, mmap_mode="r"):
+        """Return the columns of an entry stored by :meth:`write_arrays`,
+        or None if there is no such entry
+
+        Args:
+            key (str): Key of the entry
+            mmap_mode (str, optional): Passed to numpy.load, memory-map the
+                files read-only by default
+
+        Returns:
+            dict: Maps column names to arrays
+        """
+        for _ in range(3):
+            meta = self.read_meta(key)
+            if meta is None or "columns" not in meta:
+                return None
+            directory = os.path.dirname(os.path.join(self.directory, key))
+            try:
+                columns = {
+                    name: np.load(os.path.join(directory, f), mmap_mode=mmap_mode)
+                    for name, f in meta["columns"].items()
+                }
+            except FileNotFoundError:
+                # replaced by a concurrent write, read the new metadata
+                continue
+            for f in meta["columns"].values():
+                try:
+                    os.utime(os.path.join(directory, f))  # mark as recently used
+                except OSError:
+                    pass
+            return columns
+        return None
+
+    def _touch(self, key, validators, **info):
+        meta = self.read_meta(key) or {}
+        info.setdefault("columns", meta.get("columns"))
+        meta = dict(
+            info,
+            fetched=time.time(),
+            etag=validators[0],
+            last_modified=validators[1],
+        )
+        if meta["columns"] is None:
+            del meta["columns"]
+        dump(meta, self._meta_path(key))
+
+    def _remove_columns(self, key, meta):
+        directory = os.path.dirname(os.path.join(self.directory, key))
+        for f in meta.get("columns", {}).values():
+            try:
+                os.remove(os.path.join(directory, f))
+            except OSError:
+                # already removed, or still memory-mapped on Windows
+                pass
+
+    def remove(self, key):
+        """Remove an entry from the cache
+
+        Args:
+            key (str): Key of the entry
+        """
+        meta = self.read_meta(key)
+        if meta is not None:
+            self._remove_columns(key, meta)
+        for path in (self.path(key), self._meta_path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the cache fits in max_bytes
+
+        Only entries with metadata are counted and removed, other files
+        stored in the cache directory, such as trained models, are left alone.
+
+        Args:
+            keep (str, optional): Key of an entry never to remove
+        """
+        entries = {}
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            names = set(files)
+            for name in files:
+                if name.endswith(".meta.json"):
+                    continue
+                if name.endswith(".json"):
+                    key = name[: -len(".json")]
+                elif name.endswith(".npy") and name.count(".") >= 3:
+                    key = name.rsplit(".", 3)[0]
+                else:
+                    continue
+                if key + ".meta.json" not in names:
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                key = os.path.relpath(os.path.join(root, key), self.directory)
+                used, size = entries.get(key, (0, 0))
+                entries[key] = (max(used, stat.st_mtime), size + stat.st_size)
+                total += stat.st_size
+        for key, (_, size) in sorted(entries.items(), key=lambda x: x[1]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total -= size
+
+    def open(self, key, url, ttl, stale_ttl=0, refresh=False):
+        """Open the data file of an entry for reading, fetching it from url
+        when needed.
+
+        An entry younger than ttl is used as is. An entry that is older,
+        but by no more than stale_ttl, is used immediately while it is
+        revalidated in the background. Otherwise the entry is revalidated
+        first, which only downloads the data if it has changed on the
+        server, and if that fails an expired entry is still used unless
+        refresh is set. Concurrent calls for the same key share a single
+        fetch.
+
+        Args:
+            key (str): Key of the entry
+            url (str): url of the data
+            ttl (float): Time to live in seconds
+            stale_ttl (float, optional): Time in seconds past ttl during which
+                a stale entry may be served (default 0)
+            refresh (bool, optional): Whether to always revalidate (default False)
+
+        Returns:
+            file: Text file, to be closed by the caller
+        """
+        with self.lock(key):
+            if not refresh:
+                age = self.age(key)
+                if age is not None and age <= ttl + stale_ttl:
+                    f = self._open(key)
+                    if f is not None:
+                        if age > ttl:
+                            self._revalidate_in_background(key, url)
+                        return f
+            try:
+                self._revalidate(key, url)
+            except requests.RequestException:
+                f = None if refresh else self._open(key)
+                if f is None:
+                    raise
+                logger.warning(
+                    "Failed to revalidate cached %s, using it expired",
+                    key,
+                    exc_info=True,
+                )
+                return f
+            return self._open(key)
+
+    def get(self, key, url, ttl, stale_ttl=0, refresh=False):
+        """Return the data of an entry, fetching it from url when needed,
+        see :meth:`open`.
+
+        Args:
+            key (str): Key of the entry
+            url (str): url of the data
+            ttl (float): Time to live in seconds
+            stale_ttl (float, optional): Time in seconds past ttl during which
+                a stale entry may be served (default 0)
+            refresh (bool, optional): Whether to always revalidate (default False)
+
+        Returns:
+            dict: Json string
+        """
+        with self.open(key, url, ttl, stale_ttl, refresh) as f:
+            return json.load(f)
+
+    def _open(self, key):
+        path = self.path(key)
+        try:
+            f = open(path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass
+        return f
+
+    def _revalidate(self, key, url):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = self.read_meta(key)
+        validators = None
+        if meta is not None and os.path.exists(path):
+            validators = (meta["etag"], meta["last_modified"])
+            if not any(validators):
+                validators = None
+        modified, validators = fetch_to_file(url, path, validators)
+        if not modified and not os.path.exists(path):
+            # the entry disappeared since the request was made
+            modified, validators = fetch_to_file(url, path)
+        self._touch(key, validators)
+        self.evict(keep=key)
+
+    def _revalidate_in_background(self, key, url):
+        with self._locks_lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+
+        def revalidate():
+            try:
+                with self.lock(key):
+                    self._revalidate(key, url)
+            except Exception:
+                logger.exception("Failed to revalidate cached %s", key)
+            finally:
+                with self._locks_lock:
+                    self._revalidating.discard(key)
+
+        threading.Thread(target=revalidate, daemon=True).start()
+
+
+#: Cache used by the fetch functions of this module
+cache = Cache()
+
+
 def fetch_station_data(use_cache=True):
     """Fetch data from Environment agency for all active river level
     monitoring stations via a REST API and return retrieved data as a
     JSON object.
 
-    Fetched data is dumped to a cache file so on subsequent call it can
-    optionally be retrieved from the cache file. This is faster than
+    Fetched data is stored in the cache so on subsequent call it can
+    optionally be retrieved from the cache. This is faster than
     retrieval over the Internet and avoids excessive calls to the
-    Environment Agency service.
+    Environment Agency service. Cached data expires according to
+    ``CACHE_POLICY["station_data"]``.
 
     Args:
         use_cache (bool, optional): Whether to use cached data
@@ -70,77 +774,265 @@ def fetch_station_data(use_cache=True):
         dict: Json string
 
     """
+    ttl, stale_ttl = CACHE_POLICY["station_data"]
+    return cache.get("station_data", STATION_URL, ttl, stale_ttl, refresh=not use_cache)
 
-    # URL for retrieving data for active stations with river level
-    # monitoring (see
-    # http://environment.data.gov.uk/flood-monitoring/doc/reference)
-    url = "http://environment.data.gov.uk/flood-monitoring/id/stations?status=Active&parameter=level&qualifier=Stage&_view=full"  # noqa
 
-    sub_dir = "cache"
-    try:
-        os.makedirs(sub_dir)
-    except FileExistsError:
-        pass
-    cache_file = os.path.join(sub_dir, "station_data.json")
-
-    # Attempt to load station data from file, otherwise fetch over
-    # Internet
-    if use_cache:
-        try:
-            # Attempt to load from file
-            data = load(cache_file)
-        except FileNotFoundError:
-            # If load from file fails, fetch and dump to file
-            data = fetch(url)
-            dump(data, cache_file)
-    else:
-        # Fetch and dump to file
-        data = fetch(url)
-        dump(data, cache_file)
+def iter_station_data(use_cache=True):
+    """Generator of the data of each monitoring station, as returned by
+    :func:`fetch_station_data` in its "items", parsed one station at a time
+    from the cache file to bound memory use.
 
-    return data
+    Args:
+        use_cache (bool, optional): Whether to use cached data
+
+    Yields:
+        dict: Json string of a station
+    """
+    ttl, stale_ttl = CACHE_POLICY["station_data"]
+    with cache.open(
+        "station_data", STATION_URL, ttl, stale_ttl, refresh=not use_cache
+    ) as f:
+        yield from iter_items(f)
 
 
-def fetch_latest_water_level_data(use_cache=False):
+def fetch_latest_water_level_data(use_cache=True):
     """Fetch latest levels from all 'measures'. Returns JSON object
 
+    Cached data expires according to ``CACHE_POLICY["level_data"]``.
+
     Args:
         use_cache (bool, optional): Whether to use cached data
 
     Returns:
         dict: Json string
     """
+    ttl, stale_ttl = CACHE_POLICY["level_data"]
+    return cache.get("level_data", LEVEL_URL, ttl, stale_ttl, refresh=not use_cache)
 
-    # URL for retrieving data
-    url = "http://environment.data.gov.uk/flood-monitoring/id/measures?parameter=level&qualifier=Stage&qualifier=level"  # noqa
 
-    sub_dir = "cache"
-    try:
-        os.makedirs(sub_dir)
-    except FileExistsError:
-        pass
-    cache_file = os.path.join(sub_dir, "level_data.json")
-
-    # Attempt to load level data from file, otherwise fetch over
-    # Internet
-    if use_cache:
-        try:
-            # Attempt to load from file
-            data = load(cache_file)
-        except FileNotFoundError:
-            data = fetch(url)
-            dump(data, cache_file)
-    else:
-        data = fetch(url)
-        dump(data, cache_file)
+def iter_latest_water_level_data(use_cache=True):
+    """Generator of the data of each measure, as returned by
+    :func:`fetch_latest_water_level_data` in its "items", parsed one
+    measure at a time from the cache file to bound memory use.
+
+    Args:
+        use_cache (bool, optional): Whether to use cached data
+
+    Yields:
+        dict: Json string of a measure
+    """
+    ttl, stale_ttl = CACHE_POLICY["level_data"]
+    with cache.open(
+        "level_data", LEVEL_URL, ttl, stale_ttl, refresh=not use_cache
+    ) as f:
+        yield from iter_items(f)
+
+
+def _history_key(measure_id):
+    """Cache key of the readings history of a measure"""
+    return "history/" + hashlib.sha1(measure_id.encode()).hexdigest()[:20]
+
+
+def _readings_url(measure_id, since):
+    """Construct the url for the readings of a measure since a time
+    (ISO 8601 string in UTC)"""
+    return measure_id + "/readings/?_sorted&since=" + since
+
+
+def _isoformat(t):
+    """ISO 8601 string of a time in UTC, to the second"""
+    return str(np.datetime64(t, "s"))
+
+
+# Code points of the fixed date-time format returned by the API, with
+# digits marked by "0"
+_ISO_UTC = np.array([ord(c) for c in "0000-00-00T00:00:00Z"], dtype=np.uint32)
+_ISO_UTC_DIGITS = _ISO_UTC == ord("0")
+
+
+def _parse_datetime(s):
+    """Parse a date-time string of any format with dateutil, as UTC"""
+    d = dateutil.parser.parse(s)
+    if d.tzinfo is not None:
+        d = d.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return np.datetime64(d, "s")
 
-    return data
+
+def parse_datetimes(strings):
+    """Convert ISO 8601 date-time strings to an array of numpy datetime64
+    in UTC, to the second.
+
+    Strings in the fixed ``YYYY-MM-DDThh:mm:ssZ`` format returned by the
+    Environment Agency API are recognised and converted by NumPy in one
+    go; any other strings are parsed one by one with dateutil.
+
+    Args:
+        strings (list): Date-time strings
+
+    Returns:
+        array: Dates (datetime64[s])
+    """
+    strings = np.asarray(strings, dtype=str)
+    dates = np.empty(len(strings), dtype="datetime64[s]")
+    if len(strings) == 0:
+        return dates
+
+    width = strings.dtype.itemsize // 4
+    fixed = np.zeros(len(strings), dtype=bool)
+    if width >= len(_ISO_UTC):
+        codes = strings.view(np.uint32).reshape(len(strings), width)
+        head = codes[:, : len(_ISO_UTC)]
+        fixed = (
+            (codes[:, len(_ISO_UTC) :] == 0).all(axis=1)
+            & (head[:, ~_ISO_UTC_DIGITS] == _ISO_UTC[~_ISO_UTC_DIGITS]).all(axis=1)
+            # code points below "0" wrap around, so are also out of range
+            & ((head[:, _ISO_UTC_DIGITS] - ord("0")) <= 9).all(axis=1)
+        )
+        if fixed.any():
+            naive = head[fixed]  # copy, without the trailing Z
+            naive[:, -1] = 0
+            try:
+                dates[fixed] = naive.view("U{}".format(len(_ISO_UTC)))[:, 0]
+            except ValueError:
+                # well formed, but not a valid date
+                fixed[:] = False
+
+    for i in np.flatnonzero(~fixed):
+        dates[i] = _parse_datetime(strings[i])
+    return dates
+
+
+def _parse_readings(items):
+    """Convert fetched readings to arrays of dates (numpy datetime64, UTC)
+    and levels, in chronological order. Readings without a numeric value
+    are skipped."""
+    items = [
+        i
+        for i in items
+        if isinstance(i.get("value"), (int, float)) and not isinstance(i["value"], bool)
+    ]
+    dates = parse_datetimes([i["dateTime"] for i in items])
+    levels = np.array([i["value"] for i in items], dtype=np.float64)
+    order = np.argsort(dates, kind="stable")
+    return dates[order], levels[order]
+
+
+def _sync_history(
+    measure_id, start, fetcher=fetch_conditional, refresh=False, evict=True
+):
+    """Bring the stored readings history of a measure up to date, so that
+    it covers the period from start to now, and return it as arrays of
+    dates and levels.
+
+    If the stored history already reaches back to start, only readings
+    newer than the last stored one are fetched and appended, when it is
+    older than its time to live or refresh is True, and the readings older
+    than the longest period asked for are dropped. Otherwise the whole
+    period is fetched.
+
+    The cache is only evicted from if evict is True, so that a batch of
+    syncs can evict once.
+    """
+    key = _history_key(measure_id)
+    start = np.datetime64(start, "s")
+    now = np.datetime64(datetime.datetime.utcnow(), "s")
+    ttl, _ = CACHE_POLICY["readings"]
+    with cache.lock(key):
+        history = cache.read_arrays(key)
+        meta = cache.read_meta(key)
+        # longest period asked for, in seconds
+        window = max(int((now - start) / np.timedelta64(1, "s")), 0)
+        if meta is not None:
+            window = max(window, meta.get("window", 0))
+        if history is None or np.datetime64(meta["start"]) > start:
+            data, _ = fetcher(_readings_url(measure_id, _isoformat(start) + "Z"), None)
+            dates, levels = _parse_readings(data["items"])
+            cache.write_arrays(
+                key,
+                {"dates": dates, "levels": levels},
+                evict=False,
+                start=_isoformat(start),
+                window=window,
+            )
+        elif refresh or time.time() - meta["fetched"] > ttl:
+            dates, levels = history["dates"], history["levels"]
+            last = dates[-1] if len(dates) else np.datetime64(meta["start"])
+            data, _ = fetcher(_readings_url(measure_id, _isoformat(last) + "Z"), None)
+            new_dates, new_levels = _parse_readings(data["items"])
+            newer = new_dates > last
+            retained = max(
+                np.datetime64(meta["start"]), now - np.timedelta64(window, "s")
+            )
+            kept = dates >= retained
+            dates = np.concatenate((dates[kept], new_dates[newer]))
+            levels = np.concatenate((levels[kept], new_levels[newer]))
+            cache.write_arrays(
+                key,
+                {"dates": dates, "levels": levels},
+                evict=False,
+                start=_isoformat(retained),
+                window=window,
+            )
+        else:
+            dates, levels = history["dates"], history["levels"]
+            return dates, levels
+    if evict:
+        cache.evict(keep=key)
+    return dates, levels
+
+
+def _window(history, start):
+    """Slice the readings from start onwards out of a history"""
+    dates, levels = history
+    i = np.searchsorted(dates, np.datetime64(start, "s"))
+    return dates[i:], levels[i:]
+
+
+def _to_lists(readings):
+    """Convert readings arrays to lists, newest first like the API returns
+    them, with dates as timezone aware datetime objects"""
+    dates, levels = readings
+    return (
+        [d.replace(tzinfo=datetime.timezone.utc) for d in dates[::-1].tolist()],
+        levels[::-1].tolist(),
+    )
+
+
+def fetch_measure_readings(measure_id, dt, use_cache=True):
+    """Fetch measure levels from latest reading and going back a period
+    dt, as arrays.
+
+    The readings history of every measure is kept in the cache in a
+    columnar binary format, so repeated calls only fetch readings newer
+    than those already stored, and the returned arrays are read-only
+    memory-mapped slices of the cache when no new readings were fetched.
+
+    Args:
+        measure_id (str): measure_id of the specified station
+        dt (DateTime Object): Period of time
+        use_cache (bool, optional): Whether to use the stored history as is
+            while it is younger than its time to live, rather than always
+            fetching the readings newer than it (default True)
+
+    Returns:
+        tuple: Tuple of arrays of the form (dates, levels) in chronological
+        order, dates being numpy datetime64 in UTC
+
+    """
+
+    # Start time for data (UTC)
+    start = datetime.datetime.utcnow() - dt
+
+    return _window(_sync_history(measure_id, start, refresh=not use_cache), start)
 
 
 def fetch_measure_levels(measure_id, dt):
     """Fetch measure levels from latest reading and going back a period
     dt. Return list of dates and a list of values.
 
+    See :func:`fetch_measure_readings` for the same data as arrays.
+
     Args:
         measure_id (str): measure_id of the specified station
         dt (DateTime Object): Period of time
@@ -150,34 +1042,243 @@ def fetch_measure_levels(measure_id, dt):
 
     """
 
-    # Current time (UTC)
-    now = datetime.datetime.utcnow()
+    return _to_lists(fetch_measure_readings(measure_id, dt))
+
+
+def fetch_measure_levels_many(
+    measure_ids,
+    dt,
+    max_workers=8,
+    max_per_host=4,
+    retries=3,
+    backoff=0.5,
+    arrays=False,
+):
+    """Fetch measure levels of many measures concurrently, see
+    :func:`fetch_measure_levels`.
+
+    Requests are spread over a bounded thread pool, with at most
+    max_per_host requests in flight to any single host, and transient
+    failures are retried with exponential backoff.
+
+    Args:
+        measure_ids (list): List of measure_id
+        dt (DateTime Object): Period of time
+        max_workers (int, optional): Size of the thread pool (default 8)
+        max_per_host (int, optional): Maximum concurrent requests per host (default 4)
+        retries (int, optional): Number of retries of a failed request (default 3)
+        backoff (float, optional): Initial retry delay in seconds (default 0.5)
+        arrays (bool, optional): Whether to return arrays as
+            :func:`fetch_measure_readings` does (default False)
+
+    Returns:
+        list: List of tuples of the form (dates, levels), in the order of measure_ids
+    """
+    measure_ids = list(measure_ids)
+    if not measure_ids:
+        return []
+
+    host_slots = {}
+    lock = threading.Lock()
 
-    # Start time for data
-    start = now - dt
+    def host_slot(url):
+        host = urlsplit(url).netloc
+        with lock:
+            if host not in host_slots:
+                host_slots[host] = threading.BoundedSemaphore(max_per_host)
+            return host_slots[host]
 
-    # Construct URL for fetching data
-    url_base = measure_id
-    url_options = "/readings/?_sorted&since=" + start.isoformat() + "Z"
-    url = url_base + url_options
+    start = datetime.datetime.utcnow() - dt
 
-    # Fetch data
-    data = fetch(url)
+    def task(measure_id):
+        limiter = host_slot(measure_id)
 
-    # Extract dates and levels
-    dates, levels = [], []
-    for measure in data["items"]:
-        # Convert date-time string to a datetime object
-        d = dateutil.parser.parse(measure["dateTime"])
+        def fetcher(url, validators):
+            return _with_retry(
+                lambda: fetch_conditional(url, validators), retries, backoff, limiter
+            )
 
+        readings = _window(
+            _sync_history(measure_id, start, fetcher, evict=False), start
+        )
+        return readings if arrays else _to_lists(readings)
+
+    try:
+        with ThreadPoolExecutor(
+            max_workers=min(max_workers, len(measure_ids))
+        ) as executor:
+            return list(executor.map(task, measure_ids))
+    finally:
+        # once for the whole batch
+        cache.evict()
+
+
+class ReadingsLRU:
+    """This class represents a bounded in-memory LRU of recent readings
+    histories, keyed by measure id and shared by every caller in the
+    process, so switching between stations does not fetch or read the
+    same history again.
+
+    An entry is fresh for ttl seconds. Concurrent requests for the same
+    measure wait on a single fetch, and histories can be prefetched in
+    the background. The :class:`LevelPyramid` of every history is computed
+    when it is stored, for plots zooming over it.
+
+    Attributes:
+        maxsize (int): Maximum number of histories kept.
+        ttl (float): Freshness of a history in seconds.
+    """
+
+    def __init__(self, maxsize=64, ttl=CACHE_POLICY["readings"][0], max_workers=4):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._max_workers = max_workers
+        self._entries = collections.OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _fresh(self, entry, start):
+        fetched, entry_start = entry[:2]
+        return time.time() - fetched < self.ttl and entry_start <= start
+
+    def get(self, measure_id, dt, use_cache=True):
+        """Return measure levels from latest reading and going back a
+        period dt, see :func:`fetch_measure_readings`
+
+        Args:
+            measure_id (str): measure_id of the specified station
+            dt (DateTime Object): Period of time
+            use_cache (bool, optional): Whether to use a fresh history, kept
+                or being fetched, rather than fetching the latest readings,
+                as when the level of the measure is known to have changed
+                (default True)
+
+        Returns:
+            tuple: Tuple of arrays of the form (dates, levels) in chronological order
+        """
+
+        start = datetime.datetime.utcnow() - dt
+        while True:
+            with self._lock:
+                entry = self._entries.get(measure_id)
+                if use_cache and entry is not None and self._fresh(entry, start):
+                    self._entries.move_to_end(measure_id)
+                    return _window(entry[2], start)
+                pending = self._pending.get(measure_id)
+                # a pending fetch may have started before the latest readings
+                if not use_cache or pending is None or pending[0] > start:
+                    future = Future()
+                    self._pending[measure_id] = (start, future)
+                    break
+            # another caller is fetching a long enough history
+            try:
+                pending[1].result()
+            except Exception:
+                pass
+
+        fetched = time.time()
         try:
-            levels.append(measure["value"])
-            dates.append(d)
+            dates, levels = fetch_measure_readings(measure_id, dt, use_cache=use_cache)
+            # copied so no memory-mapped cache file is held open
+            history = np.array(dates), np.array(levels)
+            for column in history:
+                column.flags.writeable = False
+            pyramid = LevelPyramid(*history)
+        except Exception as e:
+            with self._lock:
+                if self._pending.get(measure_id, (None, None))[1] is future:
+                    del self._pending[measure_id]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            pending = self._pending.get(measure_id, (None, None))[1]
+            entry = self._entries.get(measure_id)
+            if pending is future:
+                del self._pending[measure_id]
+            # unless a later fetch, started since, is pending or was stored
+            if pending is future or (
+                pending is None and (entry is None or entry[0] < fetched)
+            ):
+                self._entries[measure_id] = (fetched, start, history, pyramid)
+                self._entries.move_to_end(measure_id)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        future.set_result(None)
+        return history
+
+    def prefetch(self, measure_ids, dt):
+        """Fetch histories in the background, skipping fresh ones
+
+        Args:
+            measure_ids (list): List of measure_id
+            dt (DateTime Object): Period of time
+
+        Returns:
+            list: Futures of the fetches started.
+        """
+
+        start = datetime.datetime.utcnow() - dt
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._max_workers, thread_name_prefix="prefetch"
+                )
+            measure_ids = [
+                i
+                for i in dict.fromkeys(measure_ids)
+                if i not in self._pending
+                and not (i in self._entries and self._fresh(self._entries[i], start))
+            ]
+        return [self._executor.submit(self._prefetch, i, dt) for i in measure_ids]
+
+    def pyramid(self, measure_id, dt, use_cache=True):
+        """Return the :class:`LevelPyramid` of the history of a measure,
+        covering at least the period dt, see :meth:`get`
+
+        Args:
+            measure_id (str): measure_id of the specified station
+            dt (DateTime Object): Period of time
+            use_cache (bool, optional): Whether to use a fresh history (default True)
+
+        Returns:
+            LevelPyramid: The history at several resolutions.
+        """
+
+        history = self.get(measure_id, dt, use_cache=use_cache)
+        with self._lock:
+            entry = self._entries.get(measure_id)
+        if entry is not None and len(entry[2][0]) >= len(history[0]):
+            return entry[3]
+        # evicted or invalidated since
+        return LevelPyramid(*history)
+
+    def _prefetch(self, measure_id, dt):
+        try:
+            self.get(measure_id, dt)
         except Exception:
-            continue
+            logger.warning("Failed to prefetch %s", measure_id, exc_info=True)
+
+    def invalidate(self, measure_id):
+        """Remove the history of a measure, so it is fetched again
+
+        Args:
+            measure_id (str): measure_id of the specified station
+        """
+        with self._lock:
+            self._entries.pop(measure_id, None)
+
+    def clear(self):
+        """Remove every history"""
+        with self._lock:
+            self._entries.clear()
 
-    return dates, levels
 
+readings_lru = ReadingsLRU()
 
 # if __name__=="__main__":
 #     print("Example of station data:")
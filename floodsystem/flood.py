@@ -5,18 +5,117 @@
 flooding.
 """
 
+import heapq
+
+import numpy as np
+
 try:
+    from .station import StationTable
     from .utils import sorted_by_key
 except ImportError:
+    from station import StationTable
     from utils import sorted_by_key
 
 
+class FloodRanking:
+    """This class represents the relative water levels of a network of
+    stations, computed in one array pass and ranked by severity, to answer
+    threshold and top-N queries without recomputing them.
+
+    Queries return index arrays into the stations, most severe first;
+    use :meth:`stations` or :meth:`view` to turn them into stations.
+
+    Attributes:
+        table (StationTable): The stations.
+        relative_level (array): Relative water levels, NaN where not available.
+        order (array): Indices of the stations with a relative level, most severe first.
+        thresholds (array): Ascending thresholds of the warning bands.
+        severity (array): Number of thresholds each relative level is above,
+            -1 where not available.
+    """
+
+    def __init__(self, stations, thresholds=(1.0, 1.5, 2.0)):
+        self.table = (
+            stations
+            if isinstance(stations, StationTable)
+            else StationTable.from_stations(stations)
+        )
+        self.relative_level = self.table.relative_water_level()
+        available = np.flatnonzero(~np.isnan(self.relative_level))
+        self.order = available[
+            np.argsort(-self.relative_level[available], kind="stable")
+        ]
+        self._sorted = -self.relative_level[self.order]
+
+        self.thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+        self.severity = np.full(len(self.table), -1)
+        self.severity[available] = np.searchsorted(
+            self.thresholds, self.relative_level[available], "left"
+        )
+
+    def over(self, tol):
+        """
+        Method that returns the stations whose relative water level is over a threshold.
+
+        Args:
+            tol (float): The threshold relative water level.
+
+        Returns:
+            array: Indices of the stations, most severe first.
+        """
+
+        return self.order[: np.searchsorted(self._sorted, -tol, "left")]
+
+    def top(self, N):
+        """
+        Method that returns the N stations with the highest relative water levels.
+
+        Args:
+            N (int): Number of stations.
+
+        Returns:
+            array: Indices of the stations, most severe first.
+        """
+
+        return self.order[: max(N, 0)]
+
+    def bands(self):
+        """
+        Method that splits the stations over the lowest threshold into the
+        warning bands.
+
+        Returns:
+            dict: Keys - thresholds, values - indices of the stations above the
+            threshold but not above the next one, most severe first.
+        """
+
+        counts = np.searchsorted(self._sorted, -self.thresholds, "left")
+        stops = np.append(counts[1:], 0)
+        return {
+            float(t): self.order[stop:count]
+            for t, count, stop in zip(self.thresholds, counts, stops)
+        }
+
+    def view(self, indices):
+        """Return the stations at indices as a StationTable"""
+        return self.table[indices]
+
+    def stations(self, indices):
+        """Return the stations at indices as a list of MonitoringStation"""
+        return [self.table.station(i) for i in indices]
+
+    def levels(self, indices):
+        """Return the stations at indices with their relative levels, as a
+        list of tuples (MonitoringStation, relative water level)"""
+        return [(self.table.station(i), float(self.relative_level[i])) for i in indices]
+
+
 def stations_level_over_threshold(stations, tol):
     """
     Function that returns stations whose latest relative water level is over some threshold.
 
     Args:
-        stations (list): List of stations (MonitoringStation).
+        stations (list or StationTable): List of stations (MonitoringStation).
         tol (float): The threshold relative water level.
 
     Returns:
@@ -24,18 +123,16 @@ def stations_level_over_threshold(stations, tol):
         relative water level) sorted by the relative level in descending order.
     """
 
-    return sorted_by_key(
-        filter(
-            lambda x: x[1] > tol,
-            [
-                (station, station.relative_water_level())
-                for station in stations
-                if station.relative_water_level() is not None
-            ],
-        ),
-        1,
-        reverse=True,
-    )
+    if isinstance(stations, StationTable):
+        ranking = FloodRanking(stations)
+        return ranking.levels(ranking.over(tol))
+
+    over = []
+    for station in stations:
+        level = station.relative_water_level()
+        if level is not None and level > tol:
+            over.append((station, level))
+    return sorted_by_key(over, 1, reverse=True)
 
 
 def stations_highest_rel_level(stations, N):
@@ -43,15 +140,27 @@ def stations_highest_rel_level(stations, N):
     Function that returns the N number of most at risk stations.
 
     Args:
-        stations (list): List of stations (MonitoringStation).
+        stations (list or StationTable): List of stations (MonitoringStation).
         N (int): Length of the desired list
 
     Returns:
-        list: List of stations (MonitoringStation).
+        list: List of stations (MonitoringStation), as a StationTable if a
+        table is given.
     """
 
-    return sorted(
+    if isinstance(stations, StationTable):
+        level = stations.relative_water_level()
+        available = np.flatnonzero(~np.isnan(level))
+        if N <= 0:
+            return stations[available[:0]]
+        if N < len(available):
+            # keep the stations tied with the N-th so the stable order is kept
+            threshold = np.partition(-level[available], N - 1)[N - 1]
+            available = available[-level[available] <= threshold]
+        return stations[available[np.argsort(-level[available], kind="stable")[:N]]]
+
+    return heapq.nlargest(
+        N,
         filter(lambda x: x.relative_water_level() is not None, stations),
         key=lambda x: x.relative_water_level(),
-        reverse=True,
-    )[:N]
+    )
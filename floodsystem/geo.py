@@ -6,14 +6,17 @@ geographical data.
 
 """
 
-from functools import reduce
+import heapq
+from collections import Counter
 from itertools import groupby
 from math import sqrt, asin, sin, cos, radians
 
+import numpy as np
+
 try:
-    from .utils import sorted_by_key  # noqa
+    from .station import StationTable
 except ImportError:
-    from utils import sorted_by_key
+    from station import StationTable
 
 
 def haversine(a, b):
@@ -46,36 +49,122 @@ def haversine(a, b):
     )
 
 
+def _as_coords(coords):
+    """Return coordinates as an (N, 2) float array in radians"""
+    return np.radians(np.asarray(coords, dtype=np.float64).reshape(-1, 2))
+
+
+def _haversine_radians(a_lat, a_lng, b_lat, b_lng):
+    r = 6371
+    return (
+        2
+        * r
+        * np.arcsin(
+            np.sqrt(
+                np.sin((b_lat - a_lat) / 2) ** 2
+                + np.cos(a_lat) * np.cos(b_lat) * np.sin((b_lng - a_lng) / 2) ** 2
+            )
+        )
+    )
+
+
+def haversine_many(coords, point):
+    """
+    Function that calculates the haversine distances between many points and a single point in kilometers.
+
+    Args:
+        coords (array): (N, 2) array of coordinates as (latitude, longitude).
+        point (tuple): The coordinate of the point as (latitude, longitude).
+
+    Returns:
+        array: (N,) array of haversine distances.
+    """
+
+    a = _as_coords(coords)
+    b_lat, b_lng = radians(point[0]), radians(point[1])
+    return _haversine_radians(a[:, 0], a[:, 1], b_lat, b_lng)
+
+
+def haversine_matrix(a, b):
+    """
+    Function that calculates the pairwise haversine distances between two sets of points in kilometers.
+
+    Args:
+        a (array): (N, 2) array of coordinates as (latitude, longitude).
+        b (array): (M, 2) array of coordinates as (latitude, longitude).
+
+    Returns:
+        array: (N, M) array where element [i, j] is the distance between a[i] and b[j].
+    """
+
+    a, b = _as_coords(a), _as_coords(b)
+    return _haversine_radians(
+        a[:, 0, np.newaxis],
+        a[:, 1, np.newaxis],
+        b[np.newaxis, :, 0],
+        b[np.newaxis, :, 1],
+    )
+
+
 def stations_by_distance(stations, p):
     """
     Function that returns the sorted distances between the input stations and a specified point p.
 
     Args:
-        stations (list): List of stations (MonitoringStation).
+        stations (list or StationTable): List of stations (MonitoringStation).
         p (tuple): Coordinate of the origin.
 
     Returns:
         list: List of (station, distance) sorted by distance.
     """
 
-    return sorted_by_key([(i.name, i.town, haversine(i.coord, p)) for i in stations], 2)
+    if isinstance(stations, StationTable):
+        distance = haversine_many(stations.coord, p)
+        name, town = stations.name, stations.town
+    else:
+        stations = list(stations)
+        distance = haversine_many([i.coord for i in stations], p)
+        name, town = [i.name for i in stations], [i.town for i in stations]
 
+    return [
+        (name[i], town[i], float(distance[i]))
+        for i in np.argsort(distance, kind="stable")
+    ]
 
-def stations_within_radius(stations, centre, r):
+
+def stations_within_radius(stations, centre, r, index=None):
     """
     Function that returns a list of all stations (MonitoringStation)
     within radius r of a geographic coordinate.
 
     Args:
-        stations (list): List of stations (MonitoringStation).
+        stations (list or StationTable): List of stations (MonitoringStation).
         centre (tuple): Coordinate of centre in (latitude, longitude).
         r (float): Radius in kilometers.
+        index (SpatialIndex, optional): Index built over the stations, to
+            avoid measuring the distance to every station.
 
     Returns:
-        list: List of stations (MonitoringStation) within the distance.
+        list: List of stations (MonitoringStation) within the distance, as a
+        StationTable if a table is given.
     """
 
-    return [station for station in stations if haversine(station.coord, centre) <= r]
+    if index is not None:
+        if not isinstance(stations, StationTable):
+            stations = list(stations)
+        return _select(stations, index.within_radius(centre, r))
+
+    if isinstance(stations, StationTable):
+        return stations[haversine_many(stations.coord, centre) <= r]
+
+    stations = list(stations)
+    within = haversine_many([i.coord for i in stations], centre) <= r
+    return [station for station, keep in zip(stations, within) if keep]
+
+
+def _name_key(name):
+    """Sort key of river and town names that sorts None last"""
+    return (name is None, name or "")
 
 
 def rivers_with_station(stations):
@@ -84,12 +173,17 @@ def rivers_with_station(stations):
     returns a container with the names of the rivers with a monitoring station.
 
     Args:
-        stations (list): List of stations (MonitoringStation).
+        stations (list or StationTable): List of stations (MonitoringStation).
 
     Returns:
         set: Set of names of rivers with a monitoring station.
     """
 
+    if isinstance(stations, StationTable):
+        return set(np.array(stations.rivers + [None])[np.unique(stations.river_code)])
+    if isinstance(stations, RiverTownIndex):
+        return set(stations.rivers())
+
     return {station.river for station in stations}
 
 
@@ -99,16 +193,35 @@ def stations_by_river(stations):
     to a list of station objects on a given river.
 
     Args:
-        stations (list): List of stations (MonitoringStation).
+        stations (list, StationTable or RiverTownIndex): List of stations (MonitoringStation).
 
     Returns:
-        dict: Keys - river names.
+        dict: Keys - river names, sorted with stations without a river under None last.
+        Values are StationTable if a table is given.
     """
 
+    if isinstance(stations, StationTable):
+        return {
+            stations.rivers[code]
+            if code >= 0
+            else None: stations[stations.river_code == code]
+            for code in sorted(
+                np.unique(stations.river_code),
+                key=lambda code: _name_key(
+                    stations.rivers[code] if code >= 0 else None
+                ),
+            )
+        }
+    if isinstance(stations, RiverTownIndex):
+        return {
+            river: stations.stations_on_river(river)
+            for river in sorted(stations.rivers(), key=_name_key)
+        }
+
     return {
         key: list(value)
         for key, value in groupby(
-            sorted(stations, key=lambda x: x.river), lambda x: x.river
+            sorted(stations, key=lambda x: _name_key(x.river)), lambda x: x.river
         )
     }
 
@@ -118,22 +231,396 @@ def rivers_by_station_number(stations, N):
     Function that returns a list of tuples containing the river name and the number of stations it has.
 
     Args:
-        stations (list): List of stations (MonitoringStation)
+        stations (list, StationTable or RiverTownIndex): List of stations (MonitoringStation)
         N (int): The number of desired rivers with the largest number of stations
 
     Returns:
-        list: tuple of (river, number of stations on river) sorted in descending order
-    """
-
-    return list(
-        reduce(
-            lambda acc, val: acc + [val]
-            if (len(acc) < N or val[1] == acc[-1][1])
-            else acc,
-            sorted(
-                [(key, len(i)) for key, i in stations_by_river(stations).items()],
-                key=lambda x: (-x[1], x[0]),
-            ),
-            [],
+        list: tuple of (river, number of stations on river) sorted in descending order,
+        including every river tied with the N-th.
+    """
+
+    if isinstance(stations, StationTable):
+        counts = np.bincount(
+            stations.river_code[stations.river_code >= 0],
+            minlength=len(stations.rivers),
         )
+        if N <= 0 or not counts.any():
+            return []
+        # the N-th largest count, ties with it are included
+        kth = len(counts) - min(N, len(counts))
+        threshold = np.partition(counts, kth)[kth]
+        river_counts = [
+            (stations.rivers[code], int(counts[code]))
+            for code in np.flatnonzero(counts >= max(threshold, 1))
+        ]
+    else:
+        if isinstance(stations, RiverTownIndex):
+            counts = stations.river_counts()
+        else:
+            counts = Counter(station.river for station in stations)
+        counts.pop(None, None)
+        if N <= 0 or not counts:
+            return []
+        threshold = heapq.nlargest(N, counts.values())[-1]
+        river_counts = [
+            (river, count) for river, count in counts.items() if count >= threshold
+        ]
+
+    return sorted(river_counts, key=lambda x: (-x[1], x[0]))
+
+
+class RiverTownIndex:
+    """This class represents an index of stations by river and by town,
+    kept up to date as stations are added and removed, so lookups do not
+    regroup the whole station list.
+
+    Stations without a river or town are indexed under None.
+    """
+
+    def __init__(self, stations=()):
+        # dicts rather than sets so stations stay in the order they were added
+        self._by_river = {}
+        self._by_town = {}
+        self._stations = {}
+        for station in stations:
+            self.add(station)
+
+    def __len__(self):
+        return len(self._stations)
+
+    def __contains__(self, station):
+        return station in self._stations
+
+    def __iter__(self):
+        return iter(self._stations)
+
+    def add(self, station):
+        """Add a station to the index, if not already in it
+
+        Args:
+            station (MonitoringStation): The station.
+        """
+
+        if station in self._stations:
+            return
+        self._stations[station] = None
+        self._by_river.setdefault(station.river, {})[station] = None
+        self._by_town.setdefault(station.town, {})[station] = None
+
+    def remove(self, station):
+        """Remove a station from the index
+
+        Args:
+            station (MonitoringStation): The station.
+
+        Raises:
+            KeyError: If the station is not in the index.
+        """
+
+        del self._stations[station]
+        for groups, key in (
+            (self._by_river, station.river),
+            (self._by_town, station.town),
+        ):
+            del groups[key][station]
+            if not groups[key]:
+                del groups[key]
+
+    def rivers(self):
+        """Return the rivers with a station
+
+        Returns:
+            KeysView: River names.
+        """
+        return self._by_river.keys()
+
+    def towns(self):
+        """Return the towns with a station
+
+        Returns:
+            KeysView: Town names.
+        """
+        return self._by_town.keys()
+
+    def stations_on_river(self, river):
+        """Return the stations on a river
+
+        Args:
+            river (str): River name, or None.
+
+        Returns:
+            list: List of stations (MonitoringStation).
+        """
+        return list(self._by_river.get(river, ()))
+
+    def stations_in_town(self, town):
+        """Return the stations in a town
+
+        Args:
+            town (str): Town name, or None.
+
+        Returns:
+            list: List of stations (MonitoringStation).
+        """
+        return list(self._by_town.get(town, ()))
+
+    def river_count(self, river):
+        """Return the number of stations on a river
+
+        Args:
+            river (str): River name, or None.
+
+        Returns:
+            int: Number of stations.
+        """
+        return len(self._by_river.get(river, ()))
+
+    def town_count(self, town):
+        """Return the number of stations in a town
+
+        Args:
+            town (str): Town name, or None.
+
+        Returns:
+            int: Number of stations.
+        """
+        return len(self._by_town.get(town, ()))
+
+    def river_counts(self):
+        """Return the number of stations on each river
+
+        Returns:
+            dict: Keys - river names, values - number of stations.
+        """
+        return {river: len(stations) for river, stations in self._by_river.items()}
+
+
+class SpatialIndex:
+    """This class represents a grid index over coordinates for haversine
+    radius, nearest neighbour and bounding box queries.
+
+    Points are sorted into rows of latitude cells, and by longitude within
+    each row, so a query only measures the distance to points in the rows
+    and longitude span of its bounding box. Build the index once per
+    station refresh and reuse it for every query.
+
+    Attributes:
+        coords (array): (N, 2) array of the indexed coordinates.
+        cell_size (float): Height of a latitude row in degrees.
+        stations (list or StationTable): The indexed stations, if built
+            from stations.
+    """
+
+    def __init__(self, coords, cell_size=0.5):
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.cell_size = cell_size
+        self.stations = None
+
+        row = np.floor(self.coords[:, 0] / cell_size).astype(np.int64)
+        self._order = np.lexsort((self.coords[:, 1], row))
+        self._row = row[self._order]
+        self._lat = self.coords[self._order, 0]
+        self._lon = self.coords[self._order, 1]
+
+    @classmethod
+    def from_stations(cls, stations, cell_size=0.5):
+        """Build an index over the coordinates of stations
+
+        Args:
+            stations (list or StationTable): List of stations (MonitoringStation).
+            cell_size (float, optional): Height of a latitude row in degrees.
+
+        Returns:
+            SpatialIndex: The index.
+        """
+
+        if isinstance(stations, StationTable):
+            index = cls(stations.coord, cell_size)
+        else:
+            stations = list(stations)
+            index = cls([i.coord for i in stations], cell_size)
+        index.stations = stations
+        return index
+
+    def __len__(self):
+        return len(self.coords)
+
+    def _box(self, lat_min, lon_min, lat_max, lon_max):
+        """Positions in the sorted order of the points in a box that does
+        not cross the antimeridian"""
+
+        first, last = np.floor(np.array([lat_min, lat_max]) / self.cell_size)
+        starts = np.searchsorted(self._row, np.arange(first, last + 1), "left")
+        stops = np.searchsorted(self._row, np.arange(first, last + 1), "right")
+        positions = [
+            np.arange(
+                start + np.searchsorted(self._lon[start:stop], lon_min, "left"),
+                start + np.searchsorted(self._lon[start:stop], lon_max, "right"),
+            )
+            for start, stop in zip(starts, stops)
+            if start < stop
+        ]
+        if not positions:
+            return np.empty(0, dtype=np.int64)
+        positions = np.concatenate(positions)
+        lat = self._lat[positions]
+        return positions[(lat >= lat_min) & (lat <= lat_max)]
+
+    def within_box(self, lat_min, lon_min, lat_max, lon_max):
+        """
+        Method that returns the points inside a bounding box. A box with
+        lon_min > lon_max crosses the antimeridian.
+
+        Args:
+            lat_min (float): Southern edge.
+            lon_min (float): Western edge.
+            lat_max (float): Northern edge.
+            lon_max (float): Eastern edge.
+
+        Returns:
+            array: Indices of the points in ascending order.
+        """
+
+        if lon_min <= lon_max:
+            positions = self._box(lat_min, lon_min, lat_max, lon_max)
+        else:
+            positions = np.concatenate(
+                (
+                    self._box(lat_min, lon_min, lat_max, 180.0),
+                    self._box(lat_min, -180.0, lat_max, lon_max),
+                )
+            )
+        return np.sort(self._order[positions])
+
+    def within_radius(self, centre, r):
+        """
+        Method that returns the points within radius r of a geographic coordinate.
+
+        Args:
+            centre (tuple): Coordinate of centre in (latitude, longitude).
+            r (float): Radius in kilometers.
+
+        Returns:
+            array: Indices of the points in ascending order.
+        """
+
+        indices = self._candidates(centre, r)
+        return indices[haversine_many(self.coords[indices], centre) <= r]
+
+    def _candidates(self, centre, r):
+        """Indices of the points in the bounding box of a circle"""
+
+        angle = r / 6371
+        lat, lon = centre
+        lat_min, lat_max = lat - np.degrees(angle), lat + np.degrees(angle)
+        if lat_min <= -90 or lat_max >= 90 or np.sin(angle) >= cos(radians(lat)):
+            # the circle contains a pole, so spans every longitude
+            return self.within_box(
+                max(lat_min, -90.0), -180.0, min(lat_max, 90.0), 180.0
+            )
+
+        span = np.degrees(np.arcsin(np.sin(angle) / cos(radians(lat))))
+        lon_min = (lon - span + 180) % 360 - 180
+        lon_max = (lon + span + 180) % 360 - 180
+        return self.within_box(lat_min, lon_min, lat_max, lon_max)
+
+    def nearest(self, point, k=1):
+        """
+        Method that returns the k points nearest to a geographic coordinate.
+
+        Args:
+            point (tuple): Coordinate in (latitude, longitude).
+            k (int, optional): Number of points.
+
+        Returns:
+            tuple: (indices, distances) of the points, nearest first.
+        """
+
+        k = min(k, len(self))
+        if k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        # grow the search radius until it holds k points, every point
+        # outside it is then further away than the k nearest
+        r = self.cell_size * 111.2
+        while True:
+            indices = self._candidates(point, r)
+            distance = haversine_many(self.coords[indices], point)
+            within = distance <= r
+            if within.sum() >= k or r > np.pi * 6371:
+                break
+            r *= 2
+
+        indices, distance = indices[within], distance[within]
+        nearest = np.argsort(distance, kind="stable")[:k]
+        return indices[nearest], distance[nearest]
+
+
+def cluster_stations(stations, eps=15, min_samples=5):
+    """
+    Function that clusters stations by location with DBSCAN on haversine distances.
+
+    Stations sharing coordinates are counted once, and given the label of their coordinates.
+    Needs scikit-learn.
+
+    Args:
+        stations (list or StationTable): List of stations (MonitoringStation).
+        eps (float, optional): Maximum distance between neighbouring stations in kilometers.
+        min_samples (int, optional): Minimum number of stations in the neighbourhood of a core station.
+
+    Returns:
+        array: Cluster label of each station, -1 for noise.
+    """
+
+    if isinstance(stations, StationTable):
+        coords = stations.coord
+    else:
+        coords = np.array([i.coord for i in stations], dtype=np.float64).reshape(-1, 2)
+    if len(coords) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    # only clustering needs scikit-learn
+    from sklearn.cluster import DBSCAN
+
+    _, first, inverse = np.unique(
+        coords, axis=0, return_index=True, return_inverse=True
     )
+    # distinct coordinates in the order the stations are, so labels are too
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    # the radius of the earth DBSCAN distances were scaled by before
+    db = DBSCAN(
+        eps=eps / 6373, min_samples=min_samples, metric="haversine", n_jobs=-1
+    ).fit(np.radians(coords[first[order]]))
+    return db.labels_[rank[inverse.reshape(-1)]]
+
+
+def _select(stations, indices):
+    """Select stations from a list or StationTable by index"""
+
+    if isinstance(stations, StationTable):
+        return stations[indices]
+    return [stations[i] for i in indices]
+
+
+def stations_nearest(stations, p, k=1, index=None):
+    """
+    Function that returns the k stations nearest to a geographic coordinate.
+
+    Args:
+        stations (list or StationTable): List of stations (MonitoringStation).
+        p (tuple): Coordinate in (latitude, longitude).
+        k (int, optional): Number of stations.
+        index (SpatialIndex, optional): Index built over the stations.
+
+    Returns:
+        list: List of stations (MonitoringStation) nearest first, as a
+        StationTable if a table is given.
+    """
+
+    if index is None:
+        index = SpatialIndex.from_stations(stations)
+    if not isinstance(stations, StationTable):
+        stations = list(stations)
+    return _select(stations, index.nearest(p, k)[0])
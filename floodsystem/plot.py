@@ -2,7 +2,10 @@
 #
 # SPDX-License-Identifier: MIT
 """This module contains functions for plotting"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from functools import partial
 from os import environ
 
 import numpy as np
@@ -20,11 +23,35 @@ from bokeh.plotting import figure, gmap
 from matplotlib.dates import date2num
 
 try:
-    from .analysis import polyfit
-    from .datafetcher import fetch_measure_levels
+    from .analysis import decimate, polyfit
+    from .datafetcher import fetch_measure_levels_many, fetch_measure_readings
+    from .station import StationTable
 except ImportError:
-    from analysis import polyfit
-    from datafetcher import fetch_measure_levels
+    from analysis import decimate, polyfit
+    from datafetcher import fetch_measure_levels_many, fetch_measure_readings
+    from station import StationTable
+
+logger = logging.getLogger(__name__)
+
+
+def decimated(dates, levels, width, method="minmax"):
+    """
+    Function that downsamples a level history to the width of a plot, as more
+    than a few points per pixel cannot be seen but still have to be sent to the browser.
+
+    Args:
+        dates (list or array): The dates in chronological order.
+        levels (list or array): The corresponding water level for each date.
+        width (int): The width of the plot in pixels.
+        method (str, optional): "minmax" or "lttb", see :func:`analysis.decimate`.
+
+    Returns:
+        array: The dates kept.
+        array: The corresponding water levels.
+    """
+    if len(levels) == 0:
+        return dates, levels
+    return decimate(dates, levels, width, method)
 
 
 def map_palette(station):
@@ -32,10 +59,11 @@ def map_palette(station):
     Function that returns the colour of a given station to use on the map, depending on the relationship between latest level and typical range.
 
     Args:
-        station (MonitoringStation): The station.
+        station (MonitoringStation or StationTable): The station, or a table of stations
+            to colour all at once.
 
     Returns:
-        str: One of
+        str: One of (an array of them for a StationTable)
 
             * 'gray' - typical range not consistent
             * 'red' - above the typical range
@@ -43,6 +71,19 @@ def map_palette(station):
             * 'blue' - within the typical range
 
     """
+    if isinstance(station, StationTable):
+        consistent = station.typical_range_consistent() & ~np.isnan(
+            station.latest_level
+        )
+        return np.select(
+            [
+                ~consistent,
+                station.latest_level > station.typical_high,
+                station.latest_level < station.typical_low,
+            ],
+            ["gray", "red", "green"],
+            "blue",
+        )
     if station.typical_range_consistent() is False or station.latest_level is None:
         return "gray"
     if station.latest_level > station.typical_range[1]:
@@ -142,8 +183,8 @@ def plot_water_levels(station, dates, levels):
 
     Args:
         station (MonitoringStation): The desired station to graph.
-        dates (list): The list of dates for the x-axis.
-        levels (list): The corresponding water level for each date, y-axis.
+        dates (list or array): The dates for the x-axis.
+        levels (list or array): The corresponding water level for each date, y-axis.
 
     Returns:
         Bokeh plot object.
@@ -155,7 +196,7 @@ def plot_water_levels(station, dates, levels):
         y_axis_label="Water level (m)",
         active_scroll="wheel_zoom",
     )
-    p.line(dates, levels, line_width=2)
+    p.line(*decimated(dates, levels, p.plot_width), line_width=2)
     p.xaxis.formatter = DatetimeTickFormatter(
         hours=["%d %B %Y"],
         days=["%d %B %Y"],
@@ -171,7 +212,9 @@ def plot_water_levels_dynamic(source):
     Function that makes a graph of the water level over time for a given station.
 
     Args:
-        source (type ColumnDataSource): The dataset.
+        source (type ColumnDataSource): The dataset, "dates" and "levels" columns,
+            with optional "low" and "high" columns drawn as a band around the line
+            for aggregated levels, see :class:`analysis.LevelPyramid`.
 
     Returns:
         Bokeh plot object.
@@ -179,6 +222,8 @@ def plot_water_levels_dynamic(source):
     p = figure(
         x_axis_label="Date", y_axis_label="Water level (m)", active_scroll="wheel_zoom"
     )
+    if "low" in source.data and "high" in source.data:
+        p.varea(x="dates", y1="low", y2="high", source=source, fill_alpha=0.3)
     p.line(x="dates", y="levels", source=source, line_width=2)
     p.xaxis.formatter = DatetimeTickFormatter(
         hours=["%d %B %Y"],
@@ -190,79 +235,182 @@ def plot_water_levels_dynamic(source):
     return p
 
 
-def plot_water_levels_multiple(stations, dt, ncol=3, height=250, width=300):
+def stream_new_readings(source, dates, levels, low=None, high=None):
+    """
+    Function that brings the source of a graph made by :func:`plot_water_levels_dynamic`
+    up to date with a newer history. The last plotted point is patched if it changed,
+    as the last bucket of an aggregate does while readings arrive, and the newer points
+    are appended, dropping as many of the oldest so that the graph keeps the length of
+    its window.
+
+    Args:
+        source (type ColumnDataSource): The dataset.
+        dates (array): The dates of the readings in chronological order, numpy datetime64.
+        levels (array): The corresponding water level for each date.
+        low (array, optional): The lowest level at each date, the levels if None.
+        high (array, optional): The highest level at each date, the levels if None.
+
+    Returns:
+        int: The number of points appended or patched.
+    """
+    columns = dict(
+        levels=levels,
+        low=levels if low is None else low,
+        high=levels if high is None else high,
+    )
+    columns = {name: columns[name] for name in columns if name in source.data}
+    plotted = source.data["dates"]
+    patched = 0
+    if len(plotted) != 0:
+        last = len(plotted) - 1
+        i = np.searchsorted(dates, plotted[last])
+        if i < len(dates) and dates[i] == plotted[last]:
+            patches = {
+                name: [(last, float(column[i]))]
+                for name, column in columns.items()
+                if source.data[name][last] != column[i]
+            }
+            if patches:
+                source.patch(patches)
+                patched = 1
+        new = dates > plotted[last]
+    else:
+        new = slice(None)
+    data = dict(dates=dates[new], **{name: c[new] for name, c in columns.items()})
+    if len(data["dates"]) != 0:
+        source.stream(data, rollover=max(len(plotted), 1))
+    return patched + len(data["dates"])
+
+
+def _typical_range_box(station):
+    """The typical range of a station as a box with dashed edges, drawn on a
+    red background so levels outside it stand out"""
+
+    return BoxAnnotation(
+        bottom=station.typical_range[0],
+        top=station.typical_range[1],
+        fill_alpha=0.1,
+        fill_color="green",
+        line_color="gray",
+        line_alpha=1.0,
+        line_dash="4 4",
+        line_width=2,
+    )
+
+
+def plot_water_levels_multiple(
+    stations,
+    dt,
+    ncol=3,
+    height=250,
+    width=300,
+    histories=None,
+    placeholders=False,
+    schedule=None,
+):
     """
     Function that displays a grid of graphs of the water level over time for a given list of stations.
 
+    The histories of all the stations are fetched concurrently first, then
+    the graphs are built sharing one tick formatter, with the typical range
+    drawn as a single annotation per graph.
+
     Args:
         stations (list): List of the desired stations (type MonitoringStation) to graph.
         dt (int): Number of days.
         ncol (int, optional): Number of columns.
         height (int, optional): Height of each individual plot.
         width (int, optional): Width of each individual plot.
+        histories (list, optional): (dates, levels) of each station, fetched
+            if not given.
+        placeholders (bool, optional): Whether to return empty graphs at once,
+            and fill each one in on a background thread as its history arrives.
+        schedule (function, optional): Function the updates of the placeholders
+            are passed to, ``Document.add_next_tick_callback`` on a Bokeh server.
+            The updates are applied directly if not given.
 
     Returns:
         Bokeh plot object.
     """
+    stations = list(stations)
+    if histories is None and not placeholders:
+        histories = fetch_measure_levels_many(
+            [station.measure_id for station in stations],
+            dt=timedelta(days=dt),
+            arrays=True,
+        )
+
+    formatter = DatetimeTickFormatter(
+        hours=["%d %B %Y"],
+        days=["%d %B %Y"],
+        months=["%d %B %Y"],
+        years=["%d %B %Y"],
+    )
     plots = []
-    for station in stations:
-        dates, levels = fetch_measure_levels(station.measure_id, dt=timedelta(days=dt))
+    sources = []
+    for i, station in enumerate(stations):
+        dates, levels = histories[i] if histories is not None else ([], [])
+        dates, levels = decimated(dates, levels, width)
+        source = ColumnDataSource(data=dict(dates=dates, levels=levels))
         p = figure(
-            title=station.name, x_axis_label="Date", y_axis_label="Water level (m)"
-        )
-        p.line(dates, levels, line_width=2)
-        low = Span(
-            location=station.typical_range[0],
-            dimension="width",
-            line_color="gray",
-            line_dash="4 4",
-            line_width=2,
-        )
-        p.add_layout(low)
-        high = Span(
-            location=station.typical_range[1],
-            dimension="width",
-            line_color="gray",
-            line_dash="4 4",
-            line_width=2,
-        )
-        p.add_layout(high)
-        low_box = BoxAnnotation(
-            top=station.typical_range[0], fill_alpha=0.1, fill_color="red"
-        )
-        mid_box = BoxAnnotation(
-            bottom=station.typical_range[0],
-            top=station.typical_range[1],
-            fill_alpha=0.1,
-            fill_color="green",
-        )
-        high_box = BoxAnnotation(
-            bottom=station.typical_range[1], fill_alpha=0.1, fill_color="red"
-        )
-        p.add_layout(low_box)
-        p.add_layout(mid_box)
-        p.add_layout(high_box)
-        p.xaxis.formatter = DatetimeTickFormatter(
-            hours=["%d %B %Y"],
-            days=["%d %B %Y"],
-            months=["%d %B %Y"],
-            years=["%d %B %Y"],
+            title=station.name,
+            x_axis_label="Date",
+            y_axis_label="Water level (m)",
+            x_axis_type="datetime",
+            background_fill_color="red",
+            background_fill_alpha=0.1,
         )
+        p.line(x="dates", y="levels", source=source, line_width=2)
+        p.add_layout(_typical_range_box(station))
+        p.xaxis.formatter = formatter
         p.xaxis.major_label_orientation = np.pi / 4
         plots.append(p)
+        sources.append(source)
+
+    if histories is None:
+        _fill_placeholders(stations, sources, dt, width, schedule)
 
     output_file("grid.html")
     grid = gridplot(plots, ncols=ncol, plot_width=width, plot_height=height)
     return grid
 
 
+def _fill_placeholders(stations, sources, dt, width, schedule=None, max_workers=4):
+    """Fetch the histories of stations on a background thread pool, and
+    pass the update of each source to schedule as its history arrives"""
+
+    def fill(source, dates, levels):
+        source.data = dict(dates=dates, levels=levels)
+
+    def fetch(station, source):
+        try:
+            dates, levels = fetch_measure_readings(
+                station.measure_id, timedelta(days=dt)
+            )
+        except Exception:
+            # leave the graph empty
+            logger.warning("Failed to fetch levels of %s", station.name, exc_info=True)
+            return
+        update = partial(fill, source, *decimated(dates, levels, width))
+        if schedule is None:
+            update()
+        else:
+            schedule(update)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(stations))))
+    for station, source in zip(stations, sources):
+        executor.submit(fetch, station, source)
+    # the pool threads exit once every history is fetched
+    executor.shutdown(wait=False)
+
+
 def plot_prediction(date, data):
     """
     Function that plots the prediction made by predictor.
 
     Args:
-        date (2-tuple): List of datetime objects of actual and demo data, list of datatime objects of future predicted data.
-        data (3-tuple): Lists of water levels of actual data, demo data, predicted data.
+        date (2-tuple): Dates of actual and demo data, dates of future predicted data.
+        data (3-tuple): Water levels of actual data, demo data, predicted data.
 
     Returns:
         Bokeh plot object.
@@ -276,10 +424,18 @@ def plot_prediction(date, data):
         y_axis_label="Water level (m)",
     )
 
-    p.line(date[0], data[0], legend_label="Raw", line_width=2)
-    p.line(date[0], data[1], line_color="orange", line_width=2, legend_label="Demo")
+    p.line(*decimated(date[0], data[0], 600), legend_label="Raw", line_width=2)
+    p.line(
+        *decimated(date[0], data[1], 600),
+        line_color="orange",
+        line_width=2,
+        legend_label="Demo",
+    )
     p.line(
-        date[1], data[2], line_color="green", line_width=2, legend_label="Prediction"
+        *decimated(date[1], data[2], 600),
+        line_color="green",
+        line_width=2,
+        legend_label="Prediction",
     )
     p.xaxis.formatter = DatetimeTickFormatter(
         hours=["%d %B %Y"],
@@ -299,8 +455,8 @@ def plot_water_level_with_fit(station, dates, levels, p):
 
     Args:
         station (MonitoringStation): The desired station to graph.
-        dates (list): The list of dates for the x-axis.
-        levels (list): The corresponding water level for each date, y-axis.
+        dates (list or array): The dates for the x-axis.
+        levels (list or array): The corresponding water level for each date, y-axis.
         p (int): The degree of polynomial that is desired.
 
     Returns:
@@ -310,11 +466,11 @@ def plot_water_level_with_fit(station, dates, levels, p):
     graph = figure(
         title=station.name, x_axis_label="Date", y_axis_label="Water level (m)"
     )
-    graph.line(dates, levels, line_width=2)
+    graph.line(*decimated(dates, levels, graph.plot_width), line_width=2)
     poly, d0 = polyfit(dates, levels, p)
     graph.line(
         dates,
-        [poly(date - d0) for date in date2num(dates)],
+        poly(date2num(dates) - d0),
         line_width=2,
         line_color="orange",
     )
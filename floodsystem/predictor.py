@@ -13,21 +13,88 @@ os.environ["KERAS_BACKEND"] = "plaidml.keras.backend"
 import numpy as np
 import matplotlib.pyplot as plt
 from sklearn.preprocessing import MinMaxScaler
-import keras
-from keras.models import Sequential
-from keras.layers import Dense, LSTM
 
 try:
-    from .datafetcher import fetch_measure_levels
+    from .datafetcher import (
+        dump,
+        fetch_measure_readings,
+        fetch_measure_levels_many,
+        load,
+    )
     from .stationdata import build_station_list
 except ImportError:
-    from datafetcher import fetch_measure_levels
+    from datafetcher import (
+        dump,
+        fetch_measure_readings,
+        fetch_measure_levels_many,
+        load,
+    )
     from stationdata import build_station_list
 
-scalar = MinMaxScaler(feature_range=(0, 1))
 np.random.seed(6)  # for reproducibility
 
 
+def fit_scaler(levels):
+    """
+    Function that fits a scaler mapping water levels to the range of the model.
+
+    Args:
+        levels (array): The water levels, usually the whole training dataset.
+
+    Returns:
+        MinMaxScaler: The fitted scaler.
+    """
+    return MinMaxScaler(feature_range=(0, 1)).fit(np.reshape(levels, (-1, 1)))
+
+
+def scaler_file(model_file):
+    """
+    Function that returns the path of the scaling parameters saved next to a model.
+
+    Args:
+        model_file (str): Path of the model file.
+
+    Returns:
+        str: Path of the JSON file of the scaling parameters.
+    """
+    return os.path.splitext(model_file)[0] + ".scaler.json"
+
+
+def save_scaler(scaler, filename):
+    """
+    Function that saves the parameters of a fitted scaler as JSON.
+
+    Args:
+        scaler (MinMaxScaler): The fitted scaler.
+        filename (str): Path of the JSON file.
+    """
+    dump(
+        {
+            "feature_range": list(scaler.feature_range),
+            "data_min": scaler.data_min_.tolist(),
+            "data_max": scaler.data_max_.tolist(),
+        },
+        filename,
+    )
+
+
+def load_scaler(filename):
+    """
+    Function that loads a scaler saved by :func:`save_scaler`.
+
+    Args:
+        filename (str): Path of the JSON file.
+
+    Returns:
+        MinMaxScaler: The fitted scaler.
+    """
+    params = load(filename)
+    # fitting on the extremes restores every fitted attribute
+    return MinMaxScaler(feature_range=tuple(params["feature_range"])).fit(
+        np.array([params["data_min"], params["data_max"]])
+    )
+
+
 def fetch_levels(station_name, dt, return_date=False):
     """
     Function that returns measurements and dates of a specified station since a specified number of days ago.
@@ -45,7 +112,7 @@ def fetch_levels(station_name, dt, return_date=False):
 
         * If return_date True
 
-          - list - List of dates (datetime object).
+          - array - Dates (numpy datetime64).
           - array - Water levels.
 
     """
@@ -55,16 +122,55 @@ def fetch_levels(station_name, dt, return_date=False):
     except StopIteration:
         print("Station {} could not be found".format(station_name))
         return
-    date, data = fetch_measure_levels(
+    date, data = fetch_measure_readings(
         station.measure_id, dt=datetime.timedelta(days=dt)
     )
 
     if return_date:
-        return date[::-1], np.array(data[::-1])
-    return np.array(data[::-1])
+        return date, data
+    return data
+
+
+def _iter_histories(stations, dt, chunk_size=8):
+    """Generator of (index, station, levels) over the supplied stations,
+    with the histories of each chunk of stations fetched concurrently
+    so that only chunk_size histories are held in memory at once."""
+    for start in range(0, len(stations), chunk_size):
+        chunk = stations[start : start + chunk_size]
+        histories = fetch_measure_levels_many(
+            [station.measure_id for station in chunk],
+            dt=datetime.timedelta(days=dt),
+            arrays=True,
+        )
+        for i, (station, (_, data)) in enumerate(zip(chunk, histories), start):
+            yield i, station, data
+
+
+def model_scaler(model_file, levels):
+    """
+    Function that returns the scaler saved next to a model, or one fitted on
+    the levels for a model saved without it.
+
+    Args:
+        model_file (str): Path of the model file.
+        levels (array): The water levels, usually the whole dataset.
+
+    Returns:
+        MinMaxScaler: The scaler.
+    """
+    try:
+        return load_scaler(scaler_file(model_file))
+    except (OSError, ValueError, KeyError):
+        # models saved before their scaling parameters were
+        print(
+            "No scaling parameters for {} found, fitting them on the dataset.".format(
+                model_file
+            )
+        )
+        return fit_scaler(levels)
 
 
-def data_prep(data, lookback, exclude=0):
+def data_prep(data, lookback, scaler, exclude=0):
     """
     Function that prepares the dataset by constructing x,y pairs.
     Each y is determined on the previous <lookback> data points (x).
@@ -72,6 +178,7 @@ def data_prep(data, lookback, exclude=0):
     Args:
         data (array): The water level data.
         lookback (int): The look back value, i.e. every y is determined how many x.
+        scaler (MinMaxScaler): The scaler of the station, see :func:`fit_scaler`.
         exclude (int, optional): The number of latest data points to ignore (default 0).
 
     Returns:
@@ -80,7 +187,7 @@ def data_prep(data, lookback, exclude=0):
     """
     if exclude != 0:
         data = data[:-exclude]
-    scaled_levels = scalar.transform(data.reshape(-1, 1))
+    scaled_levels = scaler.transform(data.reshape(-1, 1))
     x = np.array(
         [
             scaled_levels[i - lookback : i, 0]
@@ -102,6 +209,11 @@ def build_model(lookback):
     Returns:
         Keras model: Untrained model.
     """
+    # Keras is only imported by the functions using it, so the scaling and
+    # rollout functions work without it
+    from keras.models import Sequential
+    from keras.layers import Dense, LSTM
+
     model = Sequential()
     model.add(
         LSTM(256, activation="relu", input_shape=(1, lookback), recurrent_dropout=0.1)
@@ -122,6 +234,7 @@ def train_model(
     epoch,
     save_file="./cache/predictor_model.hdf5",
     show_loss=False,
+    scaler=None,
 ):
     """
     Function that trains and saves the Keras model.
@@ -135,6 +248,8 @@ def train_model(
         save_file (str, optional): Path to save the trained model file
             (default: './cache/predictor_model.hdf5')
         show_loss (bool, optional): Whether to display the loss-epoch graph after training.
+        scaler (MinMaxScaler, optional): The scaler x and y were scaled with,
+            saved next to the model, see :func:`scaler_file`.
 
     Returns:
         Keras model: The trained model.
@@ -144,11 +259,11 @@ def train_model(
         plt.plot(history.history["loss"])
         plt.ylabel("loss")
         plt.show()
-    try:
-        model.save(save_file)
-    except OSError:
-        os.mkdir("./cache")
-        model.save(save_file)
+    # several stations may be trained at once
+    os.makedirs(os.path.dirname(save_file) or ".", exist_ok=True)
+    model.save(save_file)
+    if scaler is not None:
+        save_scaler(scaler, scaler_file(save_file))
     return model
 
 
@@ -163,11 +278,11 @@ def train_all(stations, dataset_size=1000, lookback=2000, batch_size=256, epoch=
         batch_size (int, optional): (default: 256).
         epoch (int, optional): (default: 20).
     """
-    for i, station in enumerate(stations):
+    for i, station, data in _iter_histories(stations, dataset_size):
         print("Training for {} ({}/{})".format(station.name, i, len(stations)))
-        levels = fetch_levels(station.name, dataset_size)
-        scalar.fit(levels.reshape(-1, 1))  # fit the scalar on across the entire dataset
-        x_train, y_train = data_prep(levels, lookback)
+        levels = data
+        scaler = fit_scaler(levels)  # fit the scaler on across the entire dataset
+        x_train, y_train = data_prep(levels, lookback, scaler)
         train_model(
             build_model(lookback),
             x_train,
@@ -175,9 +290,37 @@ def train_all(stations, dataset_size=1000, lookback=2000, batch_size=256, epoch=
             batch_size,
             epoch,
             save_file="./cache/{}.hdf5".format(station.name),
+            scaler=scaler,
         )
 
 
+def rollout(model, windows, steps):
+    """
+    Function that predicts water levels autoregressively, each prediction
+    being appended to the window the next one is based on.
+
+    The windows are rolled out together, one batch per step, in a buffer
+    allocated once that holds the windows followed by the predictions.
+
+    Args:
+        model (Keras model): The trained model.
+        windows (array): Scaled water levels of shape (n, lookback), one window per rollout.
+        steps (int): Number of levels to predict for each window.
+
+    Returns:
+        array: Scaled predictions of shape (n, steps).
+    """
+    windows = np.asarray(windows, dtype=np.float32)
+    n, lookback = windows.shape
+    buffer = np.empty((n, lookback + steps), dtype=np.float32)
+    buffer[:, :lookback] = windows
+    for i in range(steps):
+        x = buffer[:, i : i + lookback].reshape(n, 1, lookback)
+        # skips the batching and callbacks of model.predict
+        buffer[:, lookback + i] = np.reshape(model.predict_on_batch(x), n)
+    return buffer[:, lookback:]
+
+
 def predict(
     station_name,
     dataset_size=1000,
@@ -211,81 +354,62 @@ def predict(
     Returns:
         tuple:
 
-        * 2-tuple (list, list)
+        * 2-tuple (array, array)
 
-          List of datetime objects of actual and demo data,
-          list of datatime objects of future predicted data.
-        * 3-tuple (list, list, list)
+          Dates (numpy datetime64) of actual and demo data,
+          dates of future predicted data.
+        * 3-tuple (array, array, array)
 
-          Lists of water levels of actual data, demo data, predicted data.
+          Water levels of actual data, demo data, predicted data.
     """
     date, levels = fetch_levels(station_name, dataset_size, return_date=True)
-    scalar.fit(levels.reshape(-1, 1))  # fit the scalar on across the entire dataset
+    save_file = "./cache/{}.hdf5".format(station_name)
 
+    model = None
     if use_pretrained:
+        import keras
+
         try:
-            model = keras.models.load_model("./cache/{}.hdf5".format(station_name))
+            model = keras.models.load_model(save_file)
         except Exception:
             print(
                 "No pre-trained model for {} found, training a model for it now.".format(
                     station_name
                 )
             )
-            x_train, y_train = data_prep(levels, lookback)
-            model = train_model(
-                build_model(lookback),
-                x_train,
-                y_train,
-                batch_size,
-                epoch,
-                save_file="./cache/{}.hdf5".format(station_name),
-            )
+        else:
+            scaler = model_scaler(save_file, levels)
     else:
         print("Training a model for {} now.".format(station_name))
-        x_train, y_train = data_prep(levels, lookback)
+    if model is None:
+        scaler = fit_scaler(levels)  # fit the scaler on across the entire dataset
+        x_train, y_train = data_prep(levels, lookback, scaler)
         model = train_model(
             build_model(lookback),
             x_train,
             y_train,
             batch_size,
             epoch,
-            save_file="./cache/{}.hdf5".format(station_name),
+            save_file=save_file,
+            scaler=scaler,
         )
 
-    # prediction of future <iteration> readings, based on the last <lookback> values
-    predictions = None
-    pred_levels = scalar.transform(levels[-lookback:].reshape(-1, 1))
-    pred_levels = pred_levels.reshape(1, 1, lookback)
-    for _ in range(iteration):
-        prediction = model.predict(pred_levels)
-        pred_levels = np.append(
-            pred_levels[:, :, -lookback + 1 :], prediction.reshape(1, 1, 1), axis=2
-        )
-        predictions = (
-            np.append(predictions, prediction, axis=0)
-            if predictions is not None
-            else prediction
-        )
-
-    # demo of prediction of the last <display> data points, which is based on the <lookback> values before the final 100 points
-    demo = None
-    demo_levels = scalar.transform(
-        levels[-display - lookback : -display].reshape(-1, 1)
-    ).reshape(1, 1, lookback)
-    for _ in range(display):
-        prediction = model.predict(demo_levels)
-        demo_levels = np.append(
-            demo_levels[:, :, -lookback + 1 :], prediction.reshape(1, 1, 1), axis=2
-        )
-        demo = np.append(demo, prediction, axis=0) if demo is not None else prediction
+    # prediction of future <iteration> readings, based on the last <lookback> values,
+    # and demo of prediction of the last <display> data points, based on the <lookback>
+    # values before them, rolled out together
+    windows = np.stack((levels[-lookback:], levels[-display - lookback : -display]))
+    windows = scaler.transform(windows.reshape(-1, 1)).reshape(2, lookback)
+    rollouts = rollout(model, windows, max(iteration, display))
+    predictions = rollouts[0, :iteration].reshape(-1, 1)
+    demo = rollouts[1, :display].reshape(-1, 1)
 
     # return on last <display> data points, the demo values, and future predictions
     date = (
         date[-display:],
-        [date[-1] + datetime.timedelta(minutes=15) * i for i in range(iteration)],
+        date[-1] + np.arange(iteration) * np.timedelta64(15, "m"),
     )
     return date, (
         levels[-display:],
-        scalar.inverse_transform(demo).ravel(),
-        scalar.inverse_transform(predictions).ravel(),
+        scaler.inverse_transform(demo).ravel(),
+        scaler.inverse_transform(predictions).ravel(),
     )
@@ -0,0 +1,329 @@
+# Copyright (C) 2020 Weixuan Zhang
+#
+# SPDX-License-Identifier: MIT
+"""This module provides a process-wide scheduler that refreshes station
+data in the background and publishes immutable snapshots of it
+
+"""
+
+import logging
+import threading
+import time
+from collections import namedtuple
+from datetime import timedelta
+from types import MappingProxyType
+
+import numpy as np
+
+try:
+    from .datafetcher import fetch_measure_levels_many, fetch_measure_readings
+    from .flood import FloodRanking
+    from .geo import RiverTownIndex, cluster_stations
+    from .stationdata import WaterLevelUpdater, build_station_table
+except ImportError:
+    from datafetcher import fetch_measure_levels_many, fetch_measure_readings
+    from flood import FloodRanking
+    from geo import RiverTownIndex, cluster_stations
+    from stationdata import WaterLevelUpdater, build_station_table
+
+logger = logging.getLogger(__name__)
+
+Snapshot = namedtuple(
+    "Snapshot", ["version", "time", "table", "changed", "ranking", "extras"]
+)
+Snapshot.__doc__ = """Immutable state of the station data after a refresh
+
+Attributes:
+    version (int): Number of the refresh, starting from 1.
+    time (float): Time of the refresh, seconds since the epoch.
+    table (StationTable): The stations, with read-only columns.
+    changed (array): Indices of the stations whose level changed since the
+        previous snapshot, or None if the station list was rebuilt.
+    ranking (FloodRanking): Relative levels of the stations ranked by severity.
+    extras (mapping): Read-only results of the scheduler stages, by name.
+"""
+
+
+def _frozen(table):
+    """Return a copy of a StationTable with read-only columns, and its own
+    stations (MonitoringStation) built once, so that sessions and the
+    scheduler thread never write to shared objects"""
+
+    table = table[np.arange(len(table))]
+    table._stations = np.empty(len(table), dtype=object)
+    table._built = np.zeros(len(table), dtype=bool)
+    table.to_stations()
+    # the stations now hold their levels, and are returned unchanged
+    table._built[:] = False
+    for column in (
+        table.station_id,
+        table.measure_id,
+        table.name,
+        table.lat,
+        table.lon,
+        table.typical_low,
+        table.typical_high,
+        table.latest_level,
+        table.river_code,
+        table.town_code,
+        table._stations,
+        table._built,
+    ):
+        column.flags.writeable = False
+    return table
+
+
+class RefreshScheduler:
+    """This class represents a scheduler that polls the water levels on a
+    daemon thread, so refreshing never blocks the caller, and publishes
+    each refresh as a :class:`Snapshot` to its subscribers.
+
+    Attributes:
+        interval (float): Seconds between level refreshes.
+        station_interval (float): Seconds between rebuilds of the station list.
+        retry_interval (float): Seconds between attempts at the first refresh,
+            when it fails, as sessions have no data to show until it succeeds.
+    """
+
+    def __init__(self, interval=15 * 60, station_interval=24 * 3600, retry_interval=60):
+        self.interval = interval
+        self.station_interval = station_interval
+        self.retry_interval = retry_interval
+        self._snapshot = None
+        self._updater = None
+        self._built = 0.0
+        self._subscribers = []
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_stage(self, name, func):
+        """Compute a value from every refresh on the scheduler thread, and
+        publish it in the snapshot extras. Add stages before starting the
+        scheduler so the first snapshot includes them.
+
+        Args:
+            name (str): Key of the value in the snapshot extras.
+            func (function): Function taking a Snapshot, with the extras of
+                the stages added before it.
+        """
+
+        with self._lock:
+            self._stages[name] = func
+
+    def start(self):
+        """Start refreshing on a daemon thread, if not already started"""
+
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="refresh-scheduler", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        """Stop refreshing, after the current refresh finishes"""
+
+        self._stop.set()
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                # keep publishing the previous snapshot until the next refresh
+                logger.exception("Failed to refresh station data")
+            if self._snapshot is None:
+                self._stop.wait(min(self.interval, self.retry_interval))
+            else:
+                self._stop.wait(self.interval)
+
+    def refresh(self):
+        """Refresh the water levels once, rebuilding the station list when
+        it is older than station_interval, and publish the snapshot
+
+        Returns:
+            Snapshot: The published snapshot.
+        """
+
+        now = time.time()
+        # the level data is always revalidated, a conditional request, as
+        # serving it stale would publish the levels of the previous refresh
+        if self._updater is None or now - self._built >= self.station_interval:
+            self._updater = WaterLevelUpdater(build_station_table())
+            self._built = now
+            self._updater.update(use_cache=False)
+            changed = None
+        else:
+            changed = np.array(
+                sorted(self._updater.update(use_cache=False)), dtype=np.int64
+            )
+
+        table = _frozen(self._updater.stations)
+        with self._lock:
+            previous = self._snapshot
+            stages = dict(self._stages)
+        version = previous.version + 1 if previous else 1
+        extras = {}
+        snapshot = Snapshot(
+            version, now, table, changed, FloodRanking(table), MappingProxyType(extras)
+        )
+        for name, func in stages.items():
+            try:
+                extras[name] = func(snapshot)
+            except Exception:
+                # keep the value of the previous refresh
+                logger.exception("Failed to compute %s", name)
+                if previous is not None and name in previous.extras:
+                    extras[name] = previous.extras[name]
+
+        with self._lock:
+            self._snapshot = snapshot
+            subscribers = list(self._subscribers)
+            self._ready.notify_all()
+
+        for callback in subscribers:
+            try:
+                callback(snapshot)
+            except Exception:
+                logger.exception("Failed to publish snapshot to %r", callback)
+        return snapshot
+
+    def snapshot(self, timeout=None):
+        """Return the latest snapshot, waiting for the first refresh
+
+        Args:
+            timeout (float, optional): Seconds to wait, forever if None.
+
+        Returns:
+            Snapshot: The latest snapshot, or None if the timeout expired.
+        """
+
+        with self._lock:
+            self._ready.wait_for(lambda: self._snapshot is not None, timeout)
+            return self._snapshot
+
+    def subscribe(self, callback):
+        """Call a function with every new snapshot. The function is called
+        on the scheduler thread, so it must not touch Bokeh documents
+        directly; schedule the work with ``add_next_tick_callback``.
+
+        Args:
+            callback (function): Function taking a Snapshot.
+
+        Returns:
+            function: Function that cancels the subscription.
+        """
+
+        with self._lock:
+            self._subscribers.append(callback)
+
+        def unsubscribe():
+            with self._lock:
+                if callback in self._subscribers:
+                    self._subscribers.remove(callback)
+
+        return unsubscribe
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(interval=15 * 60, start=True):
+    """Return the process-wide scheduler, creating it on the first call
+
+    Args:
+        interval (float, optional): Seconds between level refreshes, used
+            when the scheduler is created.
+        start (bool, optional): Whether to start the scheduler.
+
+    Returns:
+        RefreshScheduler: The scheduler.
+    """
+
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RefreshScheduler(interval)
+        if start:
+            _scheduler.start()
+        return _scheduler
+
+
+def highrisk_histories(snapshot, N=6, dt=10):
+    """Stage that fetches the level histories of the stations with the
+    highest relative water levels
+
+    Args:
+        snapshot (Snapshot): The snapshot.
+        N (int, optional): Number of stations.
+        dt (int, optional): Number of days.
+
+    Returns:
+        list: (dates, levels) arrays of each station, most severe first.
+    """
+
+    stations = snapshot.ranking.stations(snapshot.ranking.top(N))
+    return fetch_measure_levels_many(
+        [station.measure_id for station in stations],
+        dt=timedelta(days=dt),
+        arrays=True,
+    )
+
+
+def selection_history(snapshot, name, dt=30):
+    """Stage that fetches the level history of a station
+
+    Args:
+        snapshot (Snapshot): The snapshot.
+        name (str): Name of the station.
+        dt (int, optional): Number of days.
+
+    Returns:
+        tuple: (name, dates, levels), or None if there is no such station.
+    """
+
+    indices = np.flatnonzero(snapshot.table.name == name)
+    if len(indices) == 0:
+        return None
+    dates, levels = fetch_measure_readings(
+        snapshot.table.measure_id[indices[0]], dt=timedelta(days=dt)
+    )
+    return name, dates, levels
+
+
+def risk_clusters(snapshot, tol=1.5):
+    """Stage that clusters the stations over a relative water level
+
+    Args:
+        snapshot (Snapshot): The snapshot.
+        tol (float, optional): The threshold relative water level.
+
+    Returns:
+        array: Cluster label of each station in ``snapshot.ranking.over(tol)``, -1 for noise.
+    """
+
+    return cluster_stations(snapshot.table[snapshot.ranking.over(tol)])
+
+
+def risk_index(snapshot, tol=1.5):
+    """Stage that indexes the stations over a relative water level by river and town
+
+    Args:
+        snapshot (Snapshot): The snapshot.
+        tol (float, optional): The threshold relative water level.
+
+    Returns:
+        RiverTownIndex: The stations in ``snapshot.ranking.over(tol)``.
+    """
+
+    return RiverTownIndex(snapshot.ranking.stations(snapshot.ranking.over(tol)))
@@ -6,6 +6,8 @@ for manipulating/modifying station data
 
 """
 
+import numpy as np
+
 
 class MonitoringStation:
     """This class represents a river level monitoring station
@@ -14,6 +16,21 @@ class MonitoringStation:
         latest_level (float): The latest water level of the station
     """
 
+    # stations are created for the whole national network, so they are
+    # kept without a per-instance __dict__
+    __slots__ = (
+        "_station_id",
+        "_measure_id",
+        "_name",
+        "_coord",
+        "_typical_range",
+        "_river",
+        "_town",
+        "_latest_level",
+        "_consistent",
+        "_relative_level",
+    )
+
     def __init__(
         self, station_id, measure_id, label, coord, typical_range, river, town
     ):
@@ -31,8 +48,20 @@ class MonitoringStation:
         self._river = river
         self._town = town
 
+        # the typical range is read-only, so its consistency is computed once
+        self._consistent = None
         self.latest_level = None
 
+    @property
+    def latest_level(self):
+        """float: The latest water level of the station"""
+        return self._latest_level
+
+    @latest_level.setter
+    def latest_level(self, value):
+        self._latest_level = value
+        self._relative_level = None
+
     @property
     def station_id(self):
         """str: station_id"""
@@ -87,11 +116,13 @@ class MonitoringStation:
             Boolean: Returns whether or not the data is consistent
         """
 
-        return (
-            type(self._typical_range) is tuple
-            and self._typical_range != (0.0, 0.0)
-            and self._typical_range[0] < self.typical_range[1]
-        )
+        if self._consistent is None:
+            self._consistent = (
+                type(self._typical_range) is tuple
+                and self._typical_range != (0.0, 0.0)
+                and self._typical_range[0] < self.typical_range[1]
+            )
+        return self._consistent
 
     def relative_water_level(self):
         """
@@ -101,12 +132,12 @@ class MonitoringStation:
             float: 0.0 (corresponds to a level at the typical low) to 1.0 (corresponds to a level at the typical high)
         """
 
-        return (
-            (self.latest_level - self.typical_range[0])
-            / (self.typical_range[1] - self.typical_range[0])
-            if self.latest_level is not None and self.typical_range_consistent() is True
-            else None
-        )
+        if self._relative_level is None and self._latest_level is not None:
+            if self.typical_range_consistent() is True:
+                self._relative_level = (self._latest_level - self._typical_range[0]) / (
+                    self._typical_range[1] - self._typical_range[0]
+                )
+        return self._relative_level
 
 
 def inconsistent_typical_range_stations(stations):
@@ -115,10 +146,233 @@ def inconsistent_typical_range_stations(stations):
     range for each are consistent.
 
     Args:
-        stations (list): List of stations (type MonitoringStation).
+        stations (list or StationTable): List of stations (type MonitoringStation).
 
     Returns:
         list: List (type String) of all the stations with inconsistent typical ranges in alphabetical order
     """
 
+    if isinstance(stations, StationTable):
+        return sorted(stations.name[~stations.typical_range_consistent()])
     return sorted([i.name for i in stations if i.typical_range_consistent() is False])
+
+
+class StationTable:
+    """This class represents a collection of stations as columns of NumPy
+    arrays, so that network-wide queries are array operations.
+
+    Rivers and towns are stored as integer codes into the lists of
+    distinct names, with -1 where not available. Missing typical ranges
+    and levels are NaN.
+
+    Attributes:
+        station_id (array): Station ids.
+        measure_id (array): Measure ids.
+        name (array): Station names.
+        lat (array): Latitudes.
+        lon (array): Longitudes.
+        typical_low (array): Lower ends of the typical ranges.
+        typical_high (array): Upper ends of the typical ranges.
+        latest_level (array): Latest water levels.
+        river_code (array): Index of the river of each station in rivers.
+        town_code (array): Index of the town of each station in towns.
+        rivers (list): River names.
+        towns (list): Town names.
+    """
+
+    def __init__(
+        self,
+        station_id,
+        measure_id,
+        name,
+        lat,
+        lon,
+        typical_low,
+        typical_high,
+        river,
+        town,
+        latest_level=None,
+    ):
+        self.station_id = np.asarray(station_id, dtype=object)
+        self.measure_id = np.asarray(measure_id, dtype=object)
+        self.name = np.asarray(name, dtype=object)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.typical_low = np.asarray(typical_low, dtype=np.float64)
+        self.typical_high = np.asarray(typical_high, dtype=np.float64)
+        self.latest_level = (
+            np.full(len(self.name), np.nan)
+            if latest_level is None
+            else np.asarray(latest_level, dtype=np.float64)
+        )
+        self.rivers, self.river_code = _encode(river)
+        self.towns, self.town_code = _encode(town)
+        self._stations = np.empty(len(self.name), dtype=object)
+        # whether each station was built by the table, rather than given
+        self._built = np.zeros(len(self.name), dtype=bool)
+
+    @classmethod
+    def from_stations(cls, stations):
+        """Build a table from a list of stations. The stations are kept,
+        and returned unchanged by :meth:`station` and :meth:`to_stations`.
+
+        Args:
+            stations (list): List of stations (MonitoringStation).
+
+        Returns:
+            StationTable: The table.
+        """
+        stations = list(stations)
+        ranges = [
+            s.typical_range if s.typical_range is not None else (np.nan, np.nan)
+            for s in stations
+        ]
+        table = cls(
+            station_id=[s.station_id for s in stations],
+            measure_id=[s.measure_id for s in stations],
+            name=[s.name for s in stations],
+            lat=[s.coord[0] for s in stations],
+            lon=[s.coord[1] for s in stations],
+            typical_low=[r[0] for r in ranges],
+            typical_high=[r[1] for r in ranges],
+            river=[s.river for s in stations],
+            town=[s.town for s in stations],
+            latest_level=[
+                s.latest_level if s.latest_level is not None else np.nan
+                for s in stations
+            ],
+        )
+        table._stations[:] = stations
+        return table
+
+    def __len__(self):
+        return len(self.name)
+
+    def __getitem__(self, index):
+        """Return a table of a subset of the stations, selected by an
+        index array, boolean mask or slice"""
+        table = object.__new__(StationTable)
+        for attr in (
+            "station_id",
+            "measure_id",
+            "name",
+            "lat",
+            "lon",
+            "typical_low",
+            "typical_high",
+            "latest_level",
+            "river_code",
+            "town_code",
+            "_stations",
+            "_built",
+        ):
+            setattr(table, attr, getattr(self, attr)[index])
+        table.rivers = self.rivers
+        table.towns = self.towns
+        return table
+
+    def __repr__(self):
+        return "A table of {} stations".format(len(self))
+
+    @property
+    def coord(self):
+        """array: (N, 2) array of coordinates in (latitude, longitude)"""
+        return np.column_stack((self.lat, self.lon))
+
+    @property
+    def river(self):
+        """array: River names, None where not available"""
+        return _decode(self.rivers, self.river_code)
+
+    @property
+    def town(self):
+        """array: Town names, None where not available"""
+        return _decode(self.towns, self.town_code)
+
+    def typical_range_consistent(self):
+        """
+        Vectorised version of :meth:`MonitoringStation.typical_range_consistent`.
+
+        Returns:
+            array: Boolean mask of the stations with consistent typical ranges
+        """
+        # comparisons with NaN (missing range) are False
+        return self.typical_low < self.typical_high
+
+    def relative_water_level(self):
+        """
+        Vectorised version of :meth:`MonitoringStation.relative_water_level`.
+
+        Returns:
+            array: Relative water levels, NaN where not available
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            level = (self.latest_level - self.typical_low) / (
+                self.typical_high - self.typical_low
+            )
+        level[~self.typical_range_consistent()] = np.nan
+        return level
+
+    def station(self, i):
+        """Return the i-th station as a MonitoringStation. A station the
+        table was built from is returned unchanged, otherwise the station is
+        built from the columns, with its latest level set from the table
+
+        Args:
+            i (int): Index of the station.
+
+        Returns:
+            MonitoringStation: The station.
+        """
+        s = self._stations[i]
+        if s is None:
+            low, high = self.typical_low[i], self.typical_high[i]
+            s = MonitoringStation(
+                station_id=self.station_id[i],
+                measure_id=self.measure_id[i],
+                label=self.name[i],
+                coord=(float(self.lat[i]), float(self.lon[i])),
+                typical_range=None
+                if np.isnan(low) or np.isnan(high)
+                else (float(low), float(high)),
+                river=self.rivers[self.river_code[i]]
+                if self.river_code[i] >= 0
+                else None,
+                town=self.towns[self.town_code[i]] if self.town_code[i] >= 0 else None,
+            )
+            self._stations[i] = s
+            self._built[i] = True
+        if self._built[i]:
+            level = self.latest_level[i]
+            s.latest_level = None if np.isnan(level) else float(level)
+        return s
+
+    def to_stations(self):
+        """Return the stations as a list of MonitoringStation
+
+        Returns:
+            list: List of stations (MonitoringStation).
+        """
+        return [self.station(i) for i in range(len(self))]
+
+
+def _encode(values):
+    """Encode a sequence of hashable values (or None) as a list of the
+    distinct values and an array of indices into it, -1 for None"""
+    categories = []
+    index = {}
+    codes = np.empty(len(values), dtype=np.int32)
+    for i, value in enumerate(values):
+        if value is None:
+            codes[i] = -1
+            continue
+        if value not in index:
+            index[value] = len(categories)
+            categories.append(value)
+        codes[i] = index[value]
+    return categories, codes
+
+
+def _decode(categories, codes):
+    values = np.array(categories + [None], dtype=object)
+    return values[codes]
@@ -6,12 +6,60 @@ JSON objects fetched from the Internet and updating their water levels
 
 """
 
+from math import isnan, nan
+
 try:
     from . import datafetcher
-    from .station import MonitoringStation
+    from .station import MonitoringStation, StationTable
 except ImportError:
     import datafetcher
-    from station import MonitoringStation
+    from station import MonitoringStation, StationTable
+
+
+def _parse_station(e):
+    """Extract the MonitoringStation arguments from a station item of
+    the fetched station data
+
+    Args:
+        e (dict): Station item.
+
+    Returns:
+        dict: Keyword arguments of MonitoringStation, or None if not all
+        required data on the station is available.
+    """
+
+    # Extract town string (not always available)
+    town = None
+    if "town" in e:
+        town = e["town"]
+
+    # Extract river name (not always available)
+    river = None
+    if "riverName" in e:
+        river = e["riverName"]
+
+    # Attempt to extract typical range (low, high)
+    try:
+        typical_range = (
+            float(e["stageScale"]["typicalRangeLow"]),
+            float(e["stageScale"]["typicalRangeHigh"]),
+        )
+    except Exception:
+        typical_range = None
+
+    try:
+        return dict(
+            station_id=e["@id"],
+            measure_id=e["measures"][-1]["@id"],
+            label=e["label"],
+            coord=(float(e["lat"]), float(e["long"])),
+            typical_range=typical_range,
+            river=river,
+            town=town,
+        )
+    except Exception:
+        # Not all required data on the station was available
+        return None
 
 
 def build_station_list(use_cache=True):
@@ -20,7 +68,8 @@ def build_station_list(use_cache=True):
     represented as a MonitoringStation object.
 
     The available data for some station is incomplete or not
-    available.
+    available. Station data is parsed one station at a time, so the
+    whole JSON document is never held in memory.
 
     Args:
         use_cache (bool, optional): Whether to use cached data
@@ -30,69 +79,86 @@ def build_station_list(use_cache=True):
 
     """
 
-    # Fetch station data
-    data = datafetcher.fetch_station_data(use_cache)
-
-    # Build list of MonitoringStation objects
-    stations = []
-    for e in data["items"]:
-        # Extract town string (not always available)
-        town = None
-        if "town" in e:
-            town = e["town"]
-
-        # Extract river name (not always available)
-        river = None
-        if "riverName" in e:
-            river = e["riverName"]
-
-        # Attempt to extract typical range (low, high)
-        try:
-            typical_range = (
-                float(e["stageScale"]["typicalRangeLow"]),
-                float(e["stageScale"]["typicalRangeHigh"]),
-            )
-        except Exception:
-            typical_range = None
-
-        try:
-            # Create mesure station object if all required data is
-            # available, and add to list
-            s = MonitoringStation(
-                station_id=e["@id"],
-                measure_id=e["measures"][-1]["@id"],
-                label=e["label"],
-                coord=(float(e["lat"]), float(e["long"])),
-                typical_range=typical_range,
-                river=river,
-                town=town,
-            )
-            stations.append(s)
-        except Exception:
-            # Not all required data on the station was available, so
-            # skip over
-            pass
-
-    return stations
+    # Build list of MonitoringStation objects from the fetched station data,
+    # skipping over stations without all the required data
+    return [
+        MonitoringStation(**kwargs)
+        for kwargs in map(_parse_station, datafetcher.iter_station_data(use_cache))
+        if kwargs is not None
+    ]
 
 
-def update_water_levels(stations):
-    """Attach level data contained in measure_data to stations
+def build_station_table(use_cache=True):
+    """Build and return a StationTable of all river level monitoring
+    stations based on data fetched from the Environment agency, without
+    creating a MonitoringStation object per station.
 
     Args:
-        stations (list): List of stations (MonitoringStation Object)
+        use_cache (bool, optional): Whether to use cached data
+
+    Returns:
+        StationTable: Table of the stations
+
     """
 
-    # Fetch level data
-    measure_data = datafetcher.fetch_latest_water_level_data()
+    columns = {
+        key: []
+        for key in (
+            "station_id",
+            "measure_id",
+            "name",
+            "lat",
+            "lon",
+            "typical_low",
+            "typical_high",
+            "river",
+            "town",
+        )
+    }
+    for kwargs in map(_parse_station, datafetcher.iter_station_data(use_cache)):
+        if kwargs is None:
+            continue
+        label = kwargs["label"]
+        low, high = kwargs["typical_range"] or (nan, nan)
+        columns["station_id"].append(kwargs["station_id"])
+        columns["measure_id"].append(kwargs["measure_id"])
+        columns["name"].append(label[0] if isinstance(label, list) else label)
+        columns["lat"].append(kwargs["coord"][0])
+        columns["lon"].append(kwargs["coord"][1])
+        columns["typical_low"].append(low)
+        columns["typical_high"].append(high)
+        columns["river"].append(kwargs["river"])
+        columns["town"].append(kwargs["town"])
+
+    return StationTable(**columns)
+
+
+def _latest_levels():
+    """Build map from measure id to latest reading (value) from the
+    fetched level data"""
 
-    # Build map from measure id to latest reading (value)
     measure_id_to_value = {}
-    for measure in measure_data["items"]:
+    for measure in datafetcher.iter_latest_water_level_data():
         if "latestReading" in measure:
             latest_reading = measure["latestReading"]
             measure_id = latest_reading["measure"]
             measure_id_to_value[measure_id] = latest_reading["value"]
+    return measure_id_to_value
+
+
+def update_water_levels(stations):
+    """Attach level data contained in measure_data to stations
+
+    Args:
+        stations (list or StationTable): List of stations (MonitoringStation Object)
+    """
+
+    measure_id_to_value = _latest_levels()
+
+    if isinstance(stations, StationTable):
+        values = [measure_id_to_value.get(i) for i in stations.measure_id]
+        stations.latest_level[:] = [v if isinstance(v, float) else nan for v in values]
+        return
 
     # Attach latest reading to station objects
     for station in stations:
@@ -104,3 +170,68 @@ def update_water_levels(stations):
         if station.measure_id in measure_id_to_value:
             if isinstance(measure_id_to_value[station.measure_id], float):
                 station.latest_level = measure_id_to_value[station.measure_id]
+
+
+class WaterLevelUpdater:
+    """This class represents an incremental updater of the water levels
+    of a list of stations.
+
+    The map from measure id to station is built once, and only readings
+    whose ``dateTime`` has advanced since the previous update are
+    applied. Stations missing from the level data keep their level.
+
+    Attributes:
+        stations (list or StationTable): The stations to update.
+    """
+
+    def __init__(self, stations):
+        self.stations = stations
+        if isinstance(stations, StationTable):
+            self._index = {m: i for i, m in enumerate(stations.measure_id)}
+        else:
+            self._index = {station.measure_id: station for station in stations}
+        self._date_times = {}
+
+    def update(self, use_cache=True):
+        """Apply the readings that advanced since the previous update
+
+        Args:
+            use_cache (bool, optional): Whether to use cached level data
+
+        Returns:
+            set: Stations (MonitoringStation) whose latest level changed, or
+            indices into the table if the stations are a StationTable.
+        """
+
+        table = isinstance(self.stations, StationTable)
+        changed = set()
+        for measure in datafetcher.iter_latest_water_level_data(use_cache):
+            latest_reading = measure.get("latestReading")
+            if not isinstance(latest_reading, dict):
+                continue
+            measure_id = latest_reading.get("measure")
+            if measure_id not in self._index:
+                continue
+
+            date_time = latest_reading.get("dateTime")
+            previous = self._date_times.get(measure_id)
+            if previous is not None and (date_time is None or date_time <= previous):
+                continue
+            self._date_times[measure_id] = date_time
+
+            value = latest_reading.get("value")
+            if table:
+                i = self._index[measure_id]
+                level = value if isinstance(value, float) else nan
+                old = self.stations.latest_level[i]
+                if level != old and not (isnan(level) and isnan(old)):
+                    self.stations.latest_level[i] = level
+                    changed.add(i)
+            else:
+                station = self._index[measure_id]
+                level = value if isinstance(value, float) else None
+                if station.latest_level != level:
+                    station.latest_level = level
+                    changed.add(station)
+
+        return changed
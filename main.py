@@ -4,15 +4,18 @@
 
 import logging
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-from functools import partial, reduce
+from functools import partial
 from os import environ
 from threading import Thread
 
 import numpy as np
+from bokeh import events
 from bokeh.layouts import layout, column, row
 from bokeh.models import (
     ColumnDataSource,
+    CustomJS,
     Div,
     TextInput,
     Tabs,
@@ -29,20 +32,24 @@ from bokeh.plotting import curdoc, gmap
 from bokeh.transform import log_cmap
 from fuzzywuzzy import process
 from matplotlib.dates import date2num
-from sklearn.cluster import DBSCAN
 
-from floodsystem.analysis import polyfit
-from floodsystem.datafetcher import fetch_measure_levels
-from floodsystem.flood import stations_highest_rel_level, stations_level_over_threshold
-from floodsystem.geo import rivers_by_station_number, rivers_with_station
+from floodsystem.analysis import LevelPyramid, polyfit
+from floodsystem.datafetcher import readings_lru
+from floodsystem.geo import (
+    SpatialIndex,
+    rivers_by_station_number,
+    rivers_with_station,
+)
 from floodsystem.plot import (
     map_palette,
     plot_water_levels_dynamic,
     plot_water_levels_multiple,
     plot_prediction,
+    stream_new_readings,
 )
 from floodsystem.predictor import predict
-from floodsystem.stationdata import build_station_list, update_water_levels
+from floodsystem.refresh import get_scheduler, risk_clusters, risk_index
+from floodsystem.station import StationTable
 
 # if the app is running on server, if so disable nn prediction
 ON_SERVER = environ.get("ON_SERVER") == "true"
@@ -50,518 +57,843 @@ ON_SERVER = environ.get("ON_SERVER") == "true"
 logger = logging.getLogger("main")
 logger.setLevel(logging.INFO)
 
+doc = curdoc()
+
 # Fetching and preparing data
 
-stations = build_station_list()
-update_water_levels(stations)
-highrisk_stations = stations_highest_rel_level(stations, 6)
+# levels are refreshed on a background thread shared by every session,
+# each session starts from the latest snapshot and receives the changes
+scheduler = get_scheduler(float(environ.get("REFRESH_INTERVAL", 15 * 60)))
+# sessions never wait for the first refresh on the IO loop, until it is
+# published a notice is shown, and the page reloads once it is
+snapshot = scheduler.snapshot(timeout=0)
+
+if snapshot is None:
+    logger.warning("No station data yet, showing the unavailable notice")
+    notice = Div(
+        text="""<h3>Flood Warning System</h3>
+        <p>The station data is unavailable at the moment,
+        this page will reload once it is.</p>"""
+    )
+    # the browser reloads the page when the text of the notice changes
+    notice.js_on_change("text", CustomJS(code="window.location.reload();"))
+    doc.add_root(notice)
+    doc.title = "Flood Warning System"
+
+    def reload(snapshot):
+        """Function that reloads the page once the first snapshot is published."""
+        notice.text = "<p><i>Loading...</i></p>"
 
+    unsubscribe = scheduler.subscribe(
+        lambda snapshot: doc.add_next_tick_callback(partial(reload, snapshot))
+    )
+    doc.on_session_destroyed(lambda session_context: unsubscribe())
+    if scheduler.snapshot(timeout=0) is not None:
+        # published before the subscription
+        doc.add_next_tick_callback(partial(reload, None))
+else:
+    stations = snapshot.table
+    # relative levels ranked once per refresh for the high risk and warning sections
+    ranking = snapshot.ranking
+    highrisk_stations = ranking.stations(ranking.top(6))
 
-def convert_to_datasource(station_list):
-    """Function that converts a list of stations into a ColumnDataSource
-    with all the relevant attributes as columns.
+    def convert_to_datasource(station_list):
+        """Function that converts a list of stations into a ColumnDataSource
+        with all the relevant attributes as columns.
 
-    Args:
-        station_list (list): List of stations (MonitoringStation).
+        Args:
+            station_list (list or StationTable): List of stations (MonitoringStation).
 
-    Returns:
-        ColumnDataSource: Columns includes lat, lng, name, measure_id, river, town, typical_low, typical_high,
-            latest_level, relative_level, color
+        Returns:
+            ColumnDataSource: Columns includes lat, lng, name, measure_id, river, town, typical_low, typical_high,
+                latest_level, relative_level, color
 
-    """
+        """
 
-    def reducer(acc, val):
-        acc["lat"].append(val.coord[0])
-        acc["lng"].append(val.coord[1])
-        acc["name"].append(val.name)
-        acc["measure_id"].append(val.measure_id)
-        acc["river"].append(val.river)
-        acc["town"].append(val.town)
-        acc["typical_low"].append(
-            val.typical_range[0] if val.typical_range is not None else "nan"
+        table = (
+            station_list
+            if isinstance(station_list, StationTable)
+            else StationTable.from_stations(station_list)
         )
-        acc["typical_high"].append(
-            val.typical_range[1] if val.typical_range is not None else "nan"
+        return ColumnDataSource(
+            data=dict(
+                lat=table.lat,
+                lng=table.lon,
+                name=table.name.tolist(),
+                measure_id=table.measure_id.tolist(),
+                river=table.river.tolist(),
+                town=table.town.tolist(),
+                typical_low=table.typical_low,
+                typical_high=table.typical_high,
+                latest_level=table.latest_level,
+                relative_level=table.relative_water_level(),
+                color=map_palette(table).tolist(),
+            )
         )
-        acc["latest_level"].append(
-            val.latest_level if val.latest_level is not None else "nan"
+
+    source = convert_to_datasource(stations)
+    # building a hash table for quick search up of indices
+    name_to_indx = {i: indx for indx, i in enumerate(source.data["name"])}
+
+    # Map
+
+    origin = (52.2070, 0.1131)
+    options = GMapOptions(lat=origin[0], lng=origin[1], map_type="roadmap", zoom=11)
+    tools = "crosshair,pan,wheel_zoom,reset,save"
+    location_map = gmap(
+        environ.get("API_KEY"),
+        options,
+        title="Station locations",
+        tools=tools,
+        active_scroll="wheel_zoom",
+    )
+    r = location_map.circle(
+        x="lng", y="lat", size=15, fill_color="color", fill_alpha=0.8, source=source
+    )
+    hover_tool = HoverTool(
+        tooltips=[
+            ("Station Name", "@name"),
+            ("River Name", "@river"),
+            ("Town", "@town"),
+            ("Latitude,Longitude", "(@lat, @lng)"),
+            ("Typical Range (m)", "@typical_low - @typical_high"),
+            ("Latest Level (m)", "@latest_level"),
+        ]
+    )
+    tap_tool = TapTool()
+    location_map.add_tools(hover_tool, tap_tool)
+    location_map.plot_width = 700
+    location_map.plot_height = 500
+    location_map.sizing_mode = "scale_width"
+
+    # Selected station plot
+
+    select_input = TextInput(value="Cambridge Jesus Lock", title="Name of station:")
+    select_text = Div(
+        text="""<p>Select a station either by clicking on the map,
+            or using the search field below, to display its historical level.</p>"""
+    )
+
+    loading_text = Div(text="")
+
+    # initialise data for plot of selected station
+    init_indx = name_to_indx[select_input.value]
+    # data for the selected station plot
+    selected_plot_source = ColumnDataSource(
+        data=dict(dates=[], levels=[], low=[], high=[])
+    )
+    # cache for current selection, avoid repeat update
+    current_selection = [
+        select_input.value,
+        init_indx,
+    ]
+
+    # histories are fetched on worker threads so callbacks never block the IO
+    # loop, every selection increments the generation so that the results of
+    # superseded selections are dropped
+    executor = ThreadPoolExecutor(max_workers=2)
+    selection_generation = 0
+    pending_fetch = None
+    # measure id of the history shown in the selected station plot
+    plotted_measure = None
+    # the selected station plot shows the finest resolution of the history
+    # with at most SELECTED_POINTS readings in the visible window, reloaded
+    # when zooming
+    SELECTED_POINTS = 2 * 600
+    # (start, end) of the window shown, or None if the whole history is shown
+    selected_window = None
+    # resolution shown, "raw" or the name of an aggregate of the pyramid
+    selected_resolution = "raw"
+    zoom_timeout = None
+
+    def show_history(pyramid):
+        """Function that displays a whole history in the selected station plot."""
+
+        global selected_window, selected_resolution
+        selected_resolution, selected_plot_source.data = pyramid.select(
+            max_points=SELECTED_POINTS
         )
-        acc["relative_level"].append(
-            val.relative_water_level()
-            if val.relative_water_level() is not None
-            else "nan"
+        selected_window = None
+
+    def station_index(snapshot):
+        """Function that returns the spatial index of the stations of a snapshot,
+        computed once per refresh by the server hooks when available."""
+
+        index = snapshot.extras.get("spatial_index")
+        return (
+            index if index is not None else SpatialIndex.from_stations(snapshot.table)
         )
-        acc["color"].append(map_palette(val))
-        return acc
 
-    return ColumnDataSource(data=reduce(reducer, station_list, defaultdict(list)))
+    spatial_index = station_index(snapshot)
 
+    def prefetch_neighbours(indx, k=6):
+        """Function that fetches the histories of the stations nearest to the
+        selected one in the background, as they are likely to be selected next."""
 
-source = convert_to_datasource(stations)
-# building a hash table for quick search up of indices
-name_to_indx = {i: indx for indx, i in enumerate(source.data["name"])}
+        neighbours, _ = spatial_index.nearest(spatial_index.coords[indx], k)
+        readings_lru.prefetch(
+            [source.data["measure_id"][i] for i in neighbours if i != indx],
+            dt=timedelta(days=30),
+        )
 
-# Map
+    def show_selection(generation, measure_id, pyramid):
+        """Function that displays the fetched history of a selection, unless a
+        newer selection was made since."""
 
-origin = (52.2070, 0.1131)
-options = GMapOptions(lat=origin[0], lng=origin[1], map_type="roadmap", zoom=11)
-tools = "crosshair,pan,wheel_zoom,reset,save"
-location_map = gmap(
-    environ.get("API_KEY"),
-    options,
-    title="Station locations",
-    tools=tools,
-    active_scroll="wheel_zoom",
-)
-r = location_map.circle(
-    x="lng", y="lat", size=15, fill_color="color", fill_alpha=0.8, source=source
-)
-hover_tool = HoverTool(
-    tooltips=[
-        ("Station Name", "@name"),
-        ("River Name", "@river"),
-        ("Town", "@town"),
-        ("Latitude,Longitude", "(@lat, @lng)"),
-        ("Typical Range (m)", "@typical_low - @typical_high"),
-        ("Latest Level (m)", "@latest_level"),
-    ]
-)
-tap_tool = TapTool()
-location_map.add_tools(hover_tool, tap_tool)
-location_map.plot_width = 700
-location_map.plot_height = 500
-location_map.sizing_mode = "scale_width"
-
-# Selected station plot
-
-select_input = TextInput(value="Cambridge Jesus Lock", title="Name of station:")
-select_text = Div(
-    text="""<p>Select a station either by clicking on the map,
-        or using the search field below, to display its historical level.</p>"""
-)
+        global plotted_measure
+        if generation != selection_generation:
+            return
+        loading_text.text = ""
+        show_history(pyramid)
+        plotted_measure = measure_id
 
-# initialise data for plot of selected station
-init_indx = name_to_indx[select_input.value]
-init_dates, init_levels = fetch_measure_levels(
-    source.data["measure_id"][init_indx], dt=timedelta(days=30)
-)
-# data for the selected station plot
-selected_plot_source = ColumnDataSource(data=dict(dates=init_dates, levels=init_levels))
-# cache for current selection, avoid repeat update
-current_selection = [
-    select_input.value,
-    init_indx,
-]
-
-
-def update_text_select(attr, old, new):
-    """Function that updates the selected plot according to the name text provided."""
-    global current_selection
-    logger.info("Current Selection: {}".format(current_selection))
-    input_text = select_input.value
-    # without fuzzy match, the new station is equal to the current station
-    if input_text == current_selection[0]:
-        return
-    if input_text != "":
-        selected_station_name = process.extractOne(input_text, source.data["name"])[0]
-        if selected_station_name == current_selection[0]:
-            # after fuzzy match, the new station is equal to the current station
-            select_input.value = selected_station_name
+    def show_failure(generation, name):
+        """Function that reports that the history of a selection failed to load."""
+
+        if generation != selection_generation:
             return
-        logger.info("Input: {}, Matched: {}".format(input_text, selected_station_name))
-        indx = name_to_indx[selected_station_name]
-        # update the current selection cache
-        current_selection = [
-            selected_station_name,
-            indx,
-        ]
-        # update the selection on map
-        r.data_source.selected.indices = [indx]
-        # update the displayed text in the text input box
-        select_input.value = selected_station_name
+        loading_text.text = "<p><i>Failed to load the levels of {}.</i></p>".format(
+            name
+        )
+
+    def fetch_selection(generation, name, measure_id):
+        """Function that fetches the history of a selection on a worker thread,
+        then hands it to the IO loop."""
+
+        try:
+            pyramid = readings_lru.pyramid(measure_id, dt=timedelta(days=30))
+        except Exception:
+            logger.exception("Failed to fetch the levels of {}".format(name))
+            doc.add_next_tick_callback(partial(show_failure, generation, name))
+            return
+        doc.add_next_tick_callback(
+            partial(show_selection, generation, measure_id, pyramid)
+        )
 
-        # TODO recenter map
+    def select_station(indx):
+        """Function that starts loading the history of a station, cancelling the
+        fetch of the previous selection, or clears the plot if indx is None."""
+
+        global selection_generation, pending_fetch, plotted_measure
+        selection_generation += 1
+        if pending_fetch is not None:
+            pending_fetch.cancel()
+            pending_fetch = None
+        if indx is None:
+            loading_text.text = ""
+            show_history(LevelPyramid([], []))
+            plotted_measure = None
+            return
 
-        # get the data for the newly selected station
-        dates, levels = fetch_measure_levels(
-            source.data["measure_id"][indx], dt=timedelta(days=30)
+        name = source.data["name"][indx]
+        loading_text.text = "<p><i>Loading the levels of {}...</i></p>".format(name)
+        pending_fetch = executor.submit(
+            fetch_selection,
+            selection_generation,
+            name,
+            source.data["measure_id"][indx],
         )
-        selected_plot_source.data.update(dict(dates=dates, levels=levels))
+        prefetch_neighbours(indx)
+
+    # computed once per refresh by the server hooks, when available
+    selection = snapshot.extras.get("selection")
+    if selection is not None and selection[0] == select_input.value:
+        show_history(LevelPyramid(selection[1], selection[2]))
+        plotted_measure = source.data["measure_id"][init_indx]
+        prefetch_neighbours(init_indx)
     else:
-        current_selection = [None, None]  # update the current selection
-        r.data_source.selected.indices = []
-        selected_plot_source.data.update(dict(dates=[], levels=[]))
+        select_station(init_indx)
+
+    def update_text_select(attr, old, new):
+        """Function that updates the selected plot according to the name text provided."""
+        global current_selection
+        logger.info("Current Selection: {}".format(current_selection))
+        input_text = select_input.value
+        # without fuzzy match, the new station is equal to the current station
+        if input_text == current_selection[0]:
+            return
+        if input_text != "":
+            selected_station_name = process.extractOne(input_text, source.data["name"])[
+                0
+            ]
+            if selected_station_name == current_selection[0]:
+                # after fuzzy match, the new station is equal to the current station
+                select_input.value = selected_station_name
+                return
+            logger.info(
+                "Input: {}, Matched: {}".format(input_text, selected_station_name)
+            )
+            indx = name_to_indx[selected_station_name]
+            # update the current selection cache
+            current_selection = [
+                selected_station_name,
+                indx,
+            ]
+            # update the selection on map
+            r.data_source.selected.indices = [indx]
+            # update the displayed text in the text input box
+            select_input.value = selected_station_name
+
+            # TODO recenter map
+
+            # load the data for the newly selected station
+            select_station(indx)
+        else:
+            current_selection = [None, None]  # update the current selection
+            r.data_source.selected.indices = []
+            select_station(None)
+
+    select_input.on_change("value", update_text_select)
+
+    def update_map_select(attr, old, new):
+        """Function that updates the selected plot according to selection on map."""
+        global current_selection
+        logger.info("Current Selection: {}".format(current_selection))
+        # if map_select is True and indx != []:
+        if new:  # if the selection is not empty
+            indx = new[0]
+            if indx == current_selection[1]:
+                return
+            selected_station_name = source.data["name"][indx]
+            logger.info("Selected on map: {}".format(selected_station_name))
+            # update the current selection cache
+            current_selection = [
+                selected_station_name,
+                indx,
+            ]
+            # update the displayed text in the text input box
+            select_input.value = selected_station_name
+            select_station(indx)
 
+    r.data_source.selected.on_change("indices", update_map_select)
 
-select_input.on_change("value", update_text_select)
+    selected_plot = plot_water_levels_dynamic(selected_plot_source)
+    selected_plot.plot_height = 350
+    selected_plot.plot_width = 600
+    selected_plot.sizing_mode = "scale_width"
 
+    def fetch_window(generation, measure_id, window):
+        """Function that reloads the visible window of the selected station
+        history from its pyramid on a worker thread, at the finest resolution
+        that fits, then hands it to the IO loop."""
 
-def update_map_select(attr, old, new):
-    """Function that updates the selected plot according to selection on map."""
-    global current_selection
-    logger.info("Current Selection: {}".format(current_selection))
-    # if map_select is True and indx != []:
-    if new:  # if the selection is not empty
-        indx = new[0]
-        if indx == current_selection[1]:
+        try:
+            pyramid = readings_lru.pyramid(measure_id, dt=timedelta(days=30))
+        except Exception:
+            logger.exception("Failed to reload the levels of {}".format(measure_id))
             return
-        selected_station_name = source.data["name"][indx]
-        logger.info("Selected on map: {}".format(selected_station_name))
-        # update the current selection cache
-        current_selection = [
-            selected_station_name,
-            indx,
-        ]
-        # update the displayed text in the text input box
-        select_input.value = selected_station_name
-        dates, levels = fetch_measure_levels(
-            source.data["measure_id"][indx], dt=timedelta(days=30)
+        dates = pyramid.dates
+        if window is not None and (
+            len(dates) == 0 or (window[0] <= dates[0] and window[1] >= dates[-1])
+        ):
+            window = None  # the whole history is visible
+        resolution, data = pyramid.select(
+            *(window or (None, None)), max_points=SELECTED_POINTS
+        )
+        doc.add_next_tick_callback(
+            partial(show_window, generation, measure_id, window, resolution, data)
         )
-        selected_plot_source.data.update(dict(dates=dates, levels=levels))
 
+    def show_window(generation, measure_id, window, resolution, data):
+        """Function that displays a reloaded window, unless the selection changed."""
 
-r.data_source.selected.on_change("indices", update_map_select)
+        global selected_window, selected_resolution
+        if generation != selection_generation or measure_id != plotted_measure:
+            return
+        selected_plot_source.data = data
+        selected_window, selected_resolution = window, resolution
 
-selected_plot = plot_water_levels_dynamic(selected_plot_source)
-selected_plot.plot_height = 350
-selected_plot.plot_width = 600
-selected_plot.sizing_mode = "scale_width"
+    def reload_window(window):
+        """Function that starts reloading a window of the selected station history."""
 
-# High risk stations
+        global zoom_timeout
+        zoom_timeout = None
+        if plotted_measure is None or window == selected_window:
+            return
+        executor.submit(fetch_window, selection_generation, plotted_measure, window)
 
-highrisk_title = Div(
-    text="""<h3>High Risk Stations</h3>
-        <p>The six stations with the highest relative water levels are shown below.</p> """
-)
-highrisk_plots = plot_water_levels_multiple(
-    highrisk_stations, dt=10, width=250, height=250
-)
-highrisk_plots.sizing_mode = "scale_width"
+    def zoom_selected(attr, old, new):
+        """Function that reloads the visible window once the zoom settles."""
 
-# Prediction
+        global zoom_timeout
+        x_range = selected_plot.x_range
+        if x_range.start is None or x_range.end is None:
+            return
+        # the range is in milliseconds since the epoch
+        window = (
+            np.datetime64(int(x_range.start), "ms"),
+            np.datetime64(int(x_range.end), "ms"),
+        )
+        if zoom_timeout is not None:
+            doc.remove_timeout_callback(zoom_timeout)
+        zoom_timeout = doc.add_timeout_callback(partial(reload_window, window), 250)
 
-# Main code is wrapped in the prediction_func()
+    selected_plot.x_range.on_change("start", zoom_selected)
+    selected_plot.x_range.on_change("end", zoom_selected)
+    # resetting the plot fits the range to the data shown, so show it all first
+    selected_plot.on_event(events.Reset, lambda event: reload_window(None))
 
-predict_text = Div(
-    text="""<p>Choose one of the high risk stations to see the prediction by a recurrent neural network
-        and least-squares polynomial fit.</p>"""
-)
+    # High risk stations
 
-if not ON_SERVER:
-    predicting_text = Div(text="""<p><i>Prediction is running...</i></p>""")
-else:
-    predicting_text = Div(
-        text="""<i>Please note that due to limited processing power
-        and lack of GPUs on the server, this part is suppressed.</i>"""
+    highrisk_title = Div(
+        text="""<h3>High Risk Stations</h3>
+            <p>The six stations with the highest relative water levels are shown below.</p> """
+    )
+    highrisk_plots = plot_water_levels_multiple(
+        highrisk_stations,
+        dt=10,
+        width=250,
+        height=250,
+        histories=snapshot.extras.get("highrisk"),
+        # without the scheduler stage, show the graphs while their levels load
+        placeholders=True,
+        schedule=doc.add_next_tick_callback,
+    )
+    highrisk_plots.sizing_mode = "scale_width"
+    # high risk stations are likely to be selected on the map
+    readings_lru.prefetch(
+        [station.measure_id for station in highrisk_stations], dt=timedelta(days=30)
     )
 
-# Warning
+    # Prediction
 
-warning_text = Div(
-    text="""<h3>Flooding Warnings</h3>
-        <p>All the stations with relative water level above 1.5 are shown in the map below.
-        DBSCAN clustering algorithm is used, the clusters are shown in the plot on the right.
-        The color indicates relative water level, while the transparency shows the risk.</p>"""
-)
+    # Main code is wrapped in the prediction_func()
 
-risky_stations_with_level = stations_level_over_threshold(stations, 1.5)
-risky_stations = [i[0] for i in risky_stations_with_level]
+    predict_text = Div(
+        text="""<p>Choose one of the high risk stations to see the prediction by a recurrent neural network
+            and least-squares polynomial fit.</p>"""
+    )
 
-if len(risky_stations) != 0:
-    risky_source = convert_to_datasource(risky_stations)
-    risky_source.add(["Moderate"] * len(risky_stations), name="risk")
-    risky_source.add([0.3] * len(risky_stations), name="alpha")
-    # building a hash table for quick search up of indices
-    risky_name_to_indx = {i: indx for indx, i in enumerate(risky_source.data["name"])}
+    if not ON_SERVER:
+        predicting_text = Div(text="""<p><i>Prediction is running...</i></p>""")
+    else:
+        predicting_text = Div(
+            text="""<i>Please note that due to limited processing power
+            and lack of GPUs on the server, this part is suppressed.</i>"""
+        )
 
-    mapper = log_cmap(
-        field_name="relative_level",
-        palette=Spectral10,
-        low=1.0,
-        high=risky_stations[0].relative_water_level(),
-    )
-    origin2 = (52.561928, -1.464854)
-    options2 = GMapOptions(lat=origin2[0], lng=origin2[1], map_type="roadmap", zoom=6)
-    location_map2 = gmap(
-        environ.get("API_KEY"),
-        options2,
-        title="Moderate to High Risk Stations",
-        tools=tools,
-        active_scroll="wheel_zoom",
-    )
-    r2 = location_map2.circle(
-        x="lng", y="lat", size=10, color=mapper, fill_alpha="alpha", source=risky_source
-    )
-    hover_tool = HoverTool(
-        tooltips=[
-            ("Station Name", "@name"),
-            ("River Name", "@river"),
-            ("Town", "@town"),
-            ("Latitude,Longitude", "(@lat, @lng)"),
-            ("Typical Range (m)", "@typical_low - @typical_high"),
-            ("Latest Level (m)", "@latest_level"),
-            ("Risk", "@risk"),
-        ]
+    # Warning
+
+    warning_text = Div(
+        text="""<h3>Flooding Warnings</h3>
+            <p>All the stations with relative water level above 1.5 are shown in the map below.
+            DBSCAN clustering algorithm is used, the clusters are shown in the plot on the right.
+            The color indicates relative water level, while the transparency shows the risk.</p>"""
     )
-    location_map2.add_tools(hover_tool)
-    color_bar = ColorBar(color_mapper=mapper["transform"], width=8, location=(0, 0))
-    location_map2.add_layout(color_bar, "right")
-    location_map2.plot_width = 700
-    location_map2.plot_height = 500
-    location_map2.sizing_mode = "scale_width"
 
-    # Clustering
+    risky_stations = ranking.stations(ranking.over(1.5))
+    risky_source = None
+
+    if len(risky_stations) != 0:
+        risky_source = convert_to_datasource(risky_stations)
+        risky_source.add(["Moderate"] * len(risky_stations), name="risk")
+        risky_source.add([0.3] * len(risky_stations), name="alpha")
+        # building a hash table for quick search up of indices
+        risky_name_to_indx = {
+            i: indx for indx, i in enumerate(risky_source.data["name"])
+        }
+
+        mapper = log_cmap(
+            field_name="relative_level",
+            palette=Spectral10,
+            low=1.0,
+            high=risky_stations[0].relative_water_level(),
+        )
+        origin2 = (52.561928, -1.464854)
+        options2 = GMapOptions(
+            lat=origin2[0], lng=origin2[1], map_type="roadmap", zoom=6
+        )
+        location_map2 = gmap(
+            environ.get("API_KEY"),
+            options2,
+            title="Moderate to High Risk Stations",
+            tools=tools,
+            active_scroll="wheel_zoom",
+        )
+        r2 = location_map2.circle(
+            x="lng",
+            y="lat",
+            size=10,
+            color=mapper,
+            fill_alpha="alpha",
+            source=risky_source,
+        )
+        hover_tool = HoverTool(
+            tooltips=[
+                ("Station Name", "@name"),
+                ("River Name", "@river"),
+                ("Town", "@town"),
+                ("Latitude,Longitude", "(@lat, @lng)"),
+                ("Typical Range (m)", "@typical_low - @typical_high"),
+                ("Latest Level (m)", "@latest_level"),
+                ("Risk", "@risk"),
+            ]
+        )
+        location_map2.add_tools(hover_tool)
+        color_bar = ColorBar(color_mapper=mapper["transform"], width=8, location=(0, 0))
+        location_map2.add_layout(color_bar, "right")
+        location_map2.plot_width = 700
+        location_map2.plot_height = 500
+        location_map2.sizing_mode = "scale_width"
+
+        # Clustering
+
+        labels = snapshot.extras.get("clusters")
+        if labels is None:
+            labels = risk_clusters(snapshot)
+        unique_labels = set(labels)
+        num_clusters = len(unique_labels) - (1 if -1 in labels else 0)
+        logger.info("Number of clusters: {}".format(num_clusters))
+
+        cluster_pallet = linear_palette(Turbo256, len(unique_labels))
+        # to find the list of stations knowing the cluster label
+        label_to_stations = defaultdict(list)
+
+        location_map3 = gmap(
+            environ.get("API_KEY"),
+            options2,
+            title="Clusters",
+            tools=tools,
+            active_scroll="wheel_zoom",
+        )
 
-    # to find the station after knowing which cluster its coordinate belongs to
-    coord_to_station = {i.coord: i for i in risky_stations}
+        for i in unique_labels:
+            if i != -1:  # not noise
+                for station, label in zip(risky_stations, labels):
+                    if label != i:
+                        continue
+                    location_map3.circle(
+                        x=station.coord[1],
+                        y=station.coord[0],
+                        size=10,
+                        color=cluster_pallet[i],
+                        fill_alpha=0.8,
+                    )
+                    label_to_stations[i].append(station)
+
+        location_map3.plot_width = 700
+        location_map3.plot_height = 500
+        location_map3.sizing_mode = "scale_width"
+
+        # Risky rivers
+        risky_index = snapshot.extras.get("risk_index")
+        if risky_index is None:
+            risky_index = risk_index(snapshot)
+        warning_text2 = Div(
+            text="""<p><b>{}</b> rivers with stations at risk, the top 5 is tabulated below.</p>""".format(
+                len(rivers_with_station(risky_index))
+            ),
+            width=600,
+        )
+        warning_text2.sizing_mode = "scale_width"
 
-    X = np.array(list(coord_to_station.keys()))
-    X_rad = np.radians(X)
+        risky_rivers = rivers_by_station_number(risky_index, 5)
+        risky_rivers_source = ColumnDataSource(
+            data=dict(
+                name=[i[0] for i in risky_rivers], num=[i[1] for i in risky_rivers]
+            )
+        )
+        risky_river_table_columns = [
+            TableColumn(field="name", title="River Name"),
+            TableColumn(field="num", title="Number of Risky Stations"),
+        ]
+        risky_river_table = DataTable(
+            source=risky_rivers_source,
+            columns=risky_river_table_columns,
+            width=500,
+            height=140,
+        )
+        risky_river_table.sizing_mode = "scale_width"
+
+        # Risky towns
+        risky_towns = []
+        key_station_in_cluster = []
+        mean_levels = []
+        for label, s in label_to_stations.items():
+            cluster_levels = np.array([i.relative_water_level() for i in s])
+            mean_levels.append(cluster_levels.mean())
+            key_station_in_cluster.append(s[np.argmax(cluster_levels)])
+            for i in s:
+                risky_towns.append(i.town)
+                risky_indx = risky_name_to_indx[i.name]
+                (
+                    risky_source.data["risk"][risky_indx],
+                    risky_source.data["alpha"][risky_indx],
+                ) = ("High", 1.0)
+
+        risky_towns = set(risky_towns)  # to find the total number of risky towns
+        # sort the towns by the mean relative water level of the cluster it is in
+        key_station_in_cluster = sorted(
+            key_station_in_cluster,
+            key=lambda x: mean_levels[key_station_in_cluster.index(x)],
+            reverse=True,
+        )
+        mean_levels = sorted(mean_levels, reverse=True)
+
+        risky_towns_source = ColumnDataSource(
+            data=dict(
+                key_stations=[i.name for i in key_station_in_cluster],
+                key_towns=[i.town for i in key_station_in_cluster],
+                levels=[
+                    round(i.relative_water_level(), 2) for i in key_station_in_cluster
+                ],
+                mean=[round(i, 2) for i in mean_levels],
+            )
+        )
+        warning_text3 = Div(
+            text="""<p><b>{}</b> clusters found, the towns within these clusters
+                (<b>{}</b> in total) have a high risk of flooding.
+                The table below lists the towns with the highest relative water level
+                within each cluster in the order of decreasing risk
+                (by calculating the mean relative water level of each cluster).</p>""".format(
+                num_clusters, len(risky_towns)
+            ),
+            width=600,
+        )
+        risky_town_table_columns = [
+            TableColumn(field="key_towns", title="Towns with Highest Risk"),
+            TableColumn(field="key_stations", title="Station Name"),
+            TableColumn(field="levels", title="Relative Water Level"),
+            TableColumn(field="mean", title="Mean Cluster Relative Water Level"),
+        ]
+        risky_town_table = DataTable(
+            source=risky_towns_source,
+            columns=risky_town_table_columns,
+            width=500,
+            height=140,
+        )
+        risky_town_table.sizing_mode = "scale_width"
 
-    ms_per_radian = 6373000.0
-    eps = 15000 / ms_per_radian
-    db = DBSCAN(eps=eps, min_samples=5, metric="haversine", n_jobs=-1).fit(X_rad)
+        warning_column = column(
+            warning_text, row(location_map2, location_map3), width=1300, height=600
+        )
 
-    labels = db.labels_
-    unique_labels = set(labels)
-    num_clusters = len(unique_labels) - (1 if -1 in labels else 0)
-    logger.info("Number of clusters: {}".format(num_clusters))
+        river_column = column(warning_text2, width=650, height=70)
+        town_column = column(warning_text3, width=650, height=70)
 
-    cluster_pallet = linear_palette(Turbo256, len(unique_labels))
-    # to find the list of stations knowing the cluster label
-    label_to_stations = defaultdict(list)
+    else:
+        no_warning_text = Div(
+            text="""<h3>Flooding Warnings</h3>
+            <p>There is no station with relative water level higher than 1.5,
+            no risk of flooding.</p>"""
+        )
+        no_data_text = Div(text="""<p><b>No Warning Issued</b></p>""", width=600)
+        blank = Div(text="", width=600)
+        warning_column = column(
+            no_warning_text, row(no_data_text, no_data_text), width=1300, height=1
+        )
 
-    location_map3 = gmap(
-        environ.get("API_KEY"),
-        options2,
-        title="Clusters",
-        tools=tools,
-        active_scroll="wheel_zoom",
-    )
+        river_column = column(blank, width=650, height=0)
+        town_column = column(blank, width=650, height=0)
 
-    for i in unique_labels:
-        if i != -1:  # not noise
-            for coord in X[labels == i]:
-                location_map3.circle(
-                    x=coord[1],
-                    y=coord[0],
-                    size=10,
-                    color=cluster_pallet[i],
-                    fill_alpha=0.8,
-                )
-                label_to_stations[i].append(coord_to_station[(coord[0], coord[1])])
-                # find the station from its coordinates and append it to the dictionary
-
-    location_map3.plot_width = 700
-    location_map3.plot_height = 500
-    location_map3.sizing_mode = "scale_width"
-
-    # Risky rivers
-    warning_text2 = Div(
-        text="""<p><b>{}</b> rivers with stations at risk, the top 5 is tabulated below.</p>""".format(
-            len(rivers_with_station(risky_stations))
-        ),
-        width=600,
-    )
-    warning_text2.sizing_mode = "scale_width"
+        risky_river_table = blank
+        risky_town_table = blank
 
-    risky_rivers = rivers_by_station_number(risky_stations, 5)
-    risky_rivers_source = ColumnDataSource(
-        data=dict(name=[i[0] for i in risky_rivers], num=[i[1] for i in risky_rivers])
-    )
-    risky_river_table_columns = [
-        TableColumn(field="name", title="River Name"),
-        TableColumn(field="num", title="Number of Risky Stations"),
-    ]
-    risky_river_table = DataTable(
-        source=risky_rivers_source,
-        columns=risky_river_table_columns,
-        width=500,
-        height=140,
-    )
-    risky_river_table.sizing_mode = "scale_width"
-
-    # Risky towns
-    risky_towns = []
-    key_station_in_cluster = []
-    mean_levels = []
-    for label, s in label_to_stations.items():
-        cluster_levels = np.array([i.relative_water_level() for i in s])
-        mean_levels.append(cluster_levels.mean())
-        key_station_in_cluster.append(s[np.argmax(cluster_levels)])
-        for i in s:
-            risky_towns.append(i.town)
-            risky_indx = risky_name_to_indx[i.name]
-            (
-                risky_source.data["risk"][risky_indx],
-                risky_source.data["alpha"][risky_indx],
-            ) = ("High", 1.0)
-
-    risky_towns = set(risky_towns)  # to find the total number of risky towns
-    # sort the towns by the mean relative water level of the cluster it is in
-    key_station_in_cluster = sorted(
-        key_station_in_cluster,
-        key=lambda x: mean_levels[key_station_in_cluster.index(x)],
-        reverse=True,
-    )
-    mean_levels = sorted(mean_levels, reverse=True)
+    # Layout
 
-    risky_towns_source = ColumnDataSource(
-        data=dict(
-            key_stations=[i.name for i in key_station_in_cluster],
-            key_towns=[i.town for i in key_station_in_cluster],
-            levels=[round(i.relative_water_level(), 2) for i in key_station_in_cluster],
-            mean=[round(i, 2) for i in mean_levels],
-        )
-    )
-    warning_text3 = Div(
-        text="""<p><b>{}</b> clusters found, the towns within these clusters
-            (<b>{}</b> in total) have a high risk of flooding.
-            The table below lists the towns with the highest relative water level
-            within each cluster in the order of decreasing risk
-            (by calculating the mean relative water level of each cluster).</p>""".format(
-            num_clusters, len(risky_towns)
-        ),
-        width=600,
-    )
-    risky_town_table_columns = [
-        TableColumn(field="key_towns", title="Towns with Highest Risk"),
-        TableColumn(field="key_stations", title="Station Name"),
-        TableColumn(field="levels", title="Relative Water Level"),
-        TableColumn(field="mean", title="Mean Cluster Relative Water Level"),
-    ]
-    risky_town_table = DataTable(
-        source=risky_towns_source,
-        columns=risky_town_table_columns,
-        width=500,
-        height=140,
-    )
-    risky_town_table.sizing_mode = "scale_width"
+    map_column = column(location_map, width=700, height=500)
 
-    warning_column = column(
-        warning_text, row(location_map2, location_map3), width=1300, height=600
+    select_column = column(
+        select_text, select_input, loading_text, selected_plot, width=600, height=500
     )
+    select_column.sizing_mode = "fixed"
 
-    river_column = column(warning_text2, width=650, height=70)
-    town_column = column(warning_text3, width=650, height=70)
+    highrisk_column = column(highrisk_title, highrisk_plots, width=800, height=650)
+    highrisk_column.sizing_mode = "fixed"
 
-else:
-    no_warning_text = Div(
-        text="""<h3>Flooding Warnings</h3>
-        <p>There is no station with relative water level higher than 1.5,
-        no risk of flooding.</p>"""
-    )
-    no_data_text = Div(text="""<p><b>No Warning Issued</b></p>""", width=600)
-    blank = Div(text="", width=600)
-    warning_column = column(
-        no_warning_text, row(no_data_text, no_data_text), width=1300, height=1
+    predict_column = column(predict_text, predicting_text, width=500, height=650)
+    predict_column.sizing_mode = "fixed"
+
+    warning_column.sizing_mode = "fixed"
+    river_column.sizing_mode = "fixed"
+    town_column.sizing_mode = "fixed"
+
+    notice = Div(
+        text="""<footer>&copy; Copyright 2020 Weixuan Zhang, Ghifari Pradana.
+            CUED Part 1A Lent computing project.</footer>""",
+        width=600,
     )
 
-    river_column = column(blank, width=650, height=0)
-    town_column = column(blank, width=650, height=0)
+    page_layout = layout(
+        [
+            [location_map, select_column],
+            [highrisk_column, predict_column],
+            [warning_column],
+            [river_column, town_column],
+            [row(risky_river_table, risky_town_table, width=1300, height=200)],
+            [notice],
+        ]
+    )
 
-    risky_river_table = blank
-    risky_town_table = blank
+    doc.add_root(page_layout)
+    doc.title = "Flood Warning System"
+
+    def changed_rows(old, new):
+        """Function that returns the rows of the map source that differ between
+        two snapshots, or None if the station lists differ."""
+
+        if new.changed is not None and new.version == old.version + 1:
+            return new.changed
+        if (
+            len(old.table) != len(new.table)
+            or (old.table.station_id != new.table.station_id).any()
+        ):
+            return None
+        old_level, new_level = old.table.latest_level, new.table.latest_level
+        return np.flatnonzero(
+            (old_level != new_level) & ~(np.isnan(old_level) & np.isnan(new_level))
+        )
 
-# Layout
+    def stream_readings(measure_id, pyramid):
+        """Function that appends the readings newer than the plotted ones to the
+        selected station plot, keeping the length of its window. If the readings
+        are aggregated, the last bucket is patched and new buckets are appended."""
 
-map_column = column(location_map, width=700, height=500)
+        if measure_id != plotted_measure or selected_window is not None:
+            return  # the selection changed while fetching, or is zoomed in
+        dates, low, levels, high = pyramid.level(selected_resolution)
+        stream_new_readings(selected_plot_source, dates, levels, low, high)
 
-select_column = column(select_text, select_input, selected_plot, width=600, height=500)
-select_column.sizing_mode = "fixed"
+    def fetch_new_readings(measure_id):
+        """Function that fetches the readings of the selected station off the
+        IO loop, then streams them into the plot."""
 
-highrisk_column = column(highrisk_title, highrisk_plots, width=800, height=650)
-highrisk_column.sizing_mode = "fixed"
+        # the level changed, so the kept and stored histories are out of date
+        pyramid = readings_lru.pyramid(
+            measure_id, dt=timedelta(days=30), use_cache=False
+        )
+        doc.add_next_tick_callback(partial(stream_readings, measure_id, pyramid))
 
-predict_column = column(predict_text, predicting_text, width=500, height=650)
-predict_column.sizing_mode = "fixed"
+    def apply_snapshot(new_snapshot):
+        """Function that brings the sources up to date with a snapshot, patching
+        only the changed stations and streaming new readings of the selected one."""
 
-warning_column.sizing_mode = "fixed"
-river_column.sizing_mode = "fixed"
-town_column.sizing_mode = "fixed"
+        global snapshot, name_to_indx, current_selection, spatial_index
+        if new_snapshot.version <= snapshot.version:
+            return
+        rows = changed_rows(snapshot, new_snapshot)
+        snapshot = new_snapshot
+        if rows is None:
+            # the station list was rebuilt
+            source.data = dict(convert_to_datasource(new_snapshot.table).data)
+            name_to_indx = {i: indx for indx, i in enumerate(source.data["name"])}
+            spatial_index = station_index(new_snapshot)
+            current_selection = [
+                current_selection[0],
+                name_to_indx.get(current_selection[0]),
+            ]
+            return
+        if len(rows) == 0:
+            return
 
-notice = Div(
-    text="""<footer>&copy; Copyright 2020 Weixuan Zhang, Ghifari Pradana.
-        CUED Part 1A Lent computing project.</footer>""",
-    width=600,
-)
+        changed = new_snapshot.table[rows]
+        latest_level = changed.latest_level.tolist()
+        relative_level = new_snapshot.ranking.relative_level[rows].tolist()
+        rows = rows.tolist()
+        source.patch(
+            dict(
+                latest_level=list(zip(rows, latest_level)),
+                relative_level=list(zip(rows, relative_level)),
+                color=list(zip(rows, map_palette(changed).tolist())),
+            )
+        )
+        if risky_source is not None:
+            risky_rows = [
+                (risky_name_to_indx[name], i)
+                for i, name in enumerate(changed.name)
+                if name in risky_name_to_indx
+            ]
+            if risky_rows:
+                risky_source.patch(
+                    dict(
+                        latest_level=[(j, latest_level[i]) for j, i in risky_rows],
+                        relative_level=[(j, relative_level[i]) for j, i in risky_rows],
+                    )
+                )
+        if current_selection[1] in rows:
+            executor.submit(
+                fetch_new_readings, source.data["measure_id"][current_selection[1]]
+            )
 
-page_layout = layout(
-    [
-        [location_map, select_column],
-        [highrisk_column, predict_column],
-        [warning_column],
-        [river_column, town_column],
-        [row(risky_river_table, risky_town_table, width=1300, height=200)],
-        [notice],
-    ]
-)
+    # snapshots are published on the scheduler thread, so they are applied to
+    # the document on its next tick
+    unsubscribe = scheduler.subscribe(
+        lambda new_snapshot: doc.add_next_tick_callback(
+            partial(apply_snapshot, new_snapshot)
+        )
+    )
 
-doc = curdoc()
-doc.add_root(page_layout)
-doc.title = "Flood Warning System"
-
-# Run prediction in a new thread
-if not ON_SERVER:
-
-    def update_layout(old, new):
-        """Function that updates the interface layout."""
-        old.children = new.children
-
-    def prediction_func():
-        """Function that wraps the prediction code."""
-        predict_plots = []
-        for i, station in enumerate(highrisk_stations):
-            try:
-                date, level = predict(
-                    station.name,
-                    dataset_size=1000,
-                    lookback=200,
-                    iteration=100,
-                    display=300,
-                    use_pretrained=True,
-                    batch_size=256,
-                    epoch=20,
+    def on_session_destroyed(session_context):
+        """Function that releases the resources of the session."""
+        unsubscribe()
+        executor.shutdown(wait=False)
+
+    doc.on_session_destroyed(on_session_destroyed)
+
+    # Run prediction in a new thread
+    if not ON_SERVER:
+
+        def update_layout(old, new):
+            """Function that updates the interface layout."""
+            old.children = new.children
+
+        def prediction_func():
+            """Function that wraps the prediction code."""
+            predict_plots = []
+            for i, station in enumerate(highrisk_stations):
+                try:
+                    date, level = predict(
+                        station.name,
+                        dataset_size=1000,
+                        lookback=200,
+                        iteration=100,
+                        display=300,
+                        use_pretrained=True,
+                        batch_size=256,
+                        epoch=20,
+                    )
+                except Exception:
+                    logger.error("NN prediction failed")
+                    date, level = ([], []), ([], [], [])
+                predict_plot = plot_prediction(date, level)
+                try:
+                    poly, d0 = polyfit(date[0], level[0], 4)
+                    all_dates = np.concatenate(date)
+                    predict_plot.line(
+                        all_dates,
+                        poly(date2num(all_dates) - d0),
+                        line_width=2,
+                        line_color="gray",
+                        legend_label="Polynomial Fit",
+                        line_dash="dashed",
+                    )
+                except (TypeError, ValueError):
+                    logger.error("No data for polyfit")
+                predict_plot.plot_width = 400
+                predict_plot.plot_height = 400
+                predict_plot.sizing_mode = "scale_width"
+                predict_plots.append(Panel(child=predict_plot, title=station.name))
+                predicting_text = Div(
+                    text="<p><i>Prediction is running... {:.0%}</i></p>".format(i / 6)
                 )
-            except Exception:
-                logger.error("NN prediction failed")
-                date, level = ([], []), ([], [], [])
-            predict_plot = plot_prediction(date, level)
-            try:
-                poly, d0 = polyfit(date[0], level[0], 4)
-                predict_plot.line(
-                    date[0] + date[1],
-                    [poly(date - d0) for date in date2num(date[0] + date[1])],
-                    line_width=2,
-                    line_color="gray",
-                    legend_label="Polynomial Fit",
-                    line_dash="dashed",
+                doc.add_next_tick_callback(
+                    partial(
+                        update_layout,
+                        old=predict_column,
+                        new=column(
+                            predict_text, predicting_text, width=500, height=650
+                        ),
+                    )
                 )
-            except TypeError:
-                logger.error("No data for polyfit")
-            predict_plot.plot_width = 400
-            predict_plot.plot_height = 400
-            predict_plot.sizing_mode = "scale_width"
-            predict_plots.append(Panel(child=predict_plot, title=station.name))
-            predicting_text = Div(
-                text="<p><i>Prediction is running... {:.0%}</i></p>".format(i / 6)
-            )
+
+            predict_tabs = Tabs(tabs=predict_plots)
             doc.add_next_tick_callback(
                 partial(
                     update_layout,
                     old=predict_column,
-                    new=column(predict_text, predicting_text, width=500, height=650),
+                    new=column(predict_text, predict_tabs, width=500, height=650),
                 )
             )
 
-        predict_tabs = Tabs(tabs=predict_plots)
-        doc.add_next_tick_callback(
-            partial(
-                update_layout,
-                old=predict_column,
-                new=column(predict_text, predict_tabs, width=500, height=650),
-            )
-        )
-
-    thread = Thread(target=prediction_func)
-    thread.start()
+        thread = Thread(target=prediction_func)
+        thread.start()
@@ -0,0 +1,43 @@
+# Copyright (C) 2020 Weixuan Zhang
+#
+# SPDX-License-Identifier: MIT
+"""Server hooks of the dashboard, when the repository is served as a
+directory app with ``bokeh serve``.
+
+The station data, the histories of the high risk stations and of the
+initially selected station, the risk clusters, the river and town index
+of the stations at risk and the spatial index of the stations are
+computed once per refresh on the process-wide scheduler, so sessions
+start from a shared snapshot instead of fetching from the API themselves.
+"""
+
+from functools import partial
+from os import environ
+
+from floodsystem.geo import SpatialIndex
+from floodsystem.refresh import (
+    get_scheduler,
+    highrisk_histories,
+    risk_clusters,
+    risk_index,
+    selection_history,
+)
+
+# the station selected when a session starts
+INITIAL_STATION = "Cambridge Jesus Lock"
+
+
+def on_server_loaded(server_context):
+    scheduler = get_scheduler(
+        float(environ.get("REFRESH_INTERVAL", 15 * 60)), start=False
+    )
+    scheduler.add_stage("highrisk", highrisk_histories)
+    scheduler.add_stage("selection", partial(selection_history, name=INITIAL_STATION))
+    scheduler.add_stage("clusters", risk_clusters)
+    scheduler.add_stage("risk_index", risk_index)
+    scheduler.add_stage("spatial_index", lambda s: SpatialIndex.from_stations(s.table))
+    scheduler.start()
+
+
+def on_server_unloaded(server_context):
+    get_scheduler(start=False).stop()
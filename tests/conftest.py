@@ -0,0 +1,108 @@
+"""Shared fixtures for the unit tests"""
+
+import gzip
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit
+
+import pytest
+
+from floodsystem import datafetcher
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInAPI:
+    """Local stand-in for the Environment Agency API.
+
+    Attributes:
+        routes (dict): Maps a url path to the JSON object served for it.
+        failures (dict): Maps a url path to the number of 503 responses
+            to give before serving the route.
+        requests (list): (path, query) of every request received.
+        headers (list): Request headers of every request received.
+
+    Responses carry an ETag, honour If-None-Match and are gzip
+    compressed when the client accepts it.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.failures = {}
+        self.requests = []
+        self.headers = []
+        self.delay = 0.0
+        self._lock = threading.Lock()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                with api._lock:
+                    api.requests.append((parts.path, parts.query))
+                    api.headers.append(dict(self.headers))
+                    failures = api.failures.get(parts.path, 0)
+                    if failures:
+                        api.failures[parts.path] = failures - 1
+                if api.delay:
+                    threading.Event().wait(api.delay)
+                if failures:
+                    self.send_error(503)
+                    return
+                if parts.path not in api.routes:
+                    self.send_error(404)
+                    return
+                body = json.dumps(api.routes[parts.path]).encode()
+                etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("ETag", etag)
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    body = gzip.compress(body)
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def url(self, path):
+        """Absolute url of a path on the stand-in server"""
+        return "http://127.0.0.1:{}{}".format(self._server.server_port, path)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def api():
+    server = StandInAPI()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def tmp_cache(tmp_path, monkeypatch):
+    """Point the datafetcher at an empty cache in a temporary directory"""
+    cache = datafetcher.Cache(str(tmp_path / "cache"))
+    monkeypatch.setattr(datafetcher, "cache", cache)
+    return cache
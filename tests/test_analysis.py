@@ -6,6 +6,7 @@
 from floodsystem.analysis import *
 from matplotlib.dates import num2date
 import numpy as np
+import pytest
 
 
 class TestClass:
@@ -23,3 +24,101 @@ class TestClass:
         p, d0 = polyfit(dates, levels, 3)
         assert round(p[2]) == -8
         assert d0 == 2
+
+    def test_polyfit_datetime64(self):
+        dates = np.array(
+            ["2020-03-01", "2020-03-02", "2020-03-03"], dtype="datetime64[s]"
+        )
+        levels = np.array([4.0, 1.0, 0.0])
+
+        p, d0 = polyfit(dates, levels, 2)
+        assert round(p[2]) == 1
+        assert round(p(0), 6) == 0
+
+    def test_polyfit_empty(self):
+        with pytest.raises(ValueError):
+            polyfit([], [], 4)
+        with pytest.raises(ValueError):
+            polyfit(np.array([], dtype="datetime64[s]"), np.array([]), 4)
+
+    def test_lttb(self):
+        dates = np.datetime64("2020-03-01") + np.arange(1000) * np.timedelta64(15, "m")
+        levels = np.sin(np.arange(1000) / 50.0)
+        levels[123] = 5.0
+
+        indices = lttb(dates, levels, 100)
+        assert len(indices) == 100
+        assert indices[0] == 0 and indices[-1] == 999
+        assert (np.diff(indices) > 0).all()
+        assert 123 in indices  # the peak is kept
+        # nothing to drop
+        assert list(lttb(dates[:10], levels[:10], 10)) == list(range(10))
+
+    def test_minmax(self):
+        x = np.arange(1000)
+        levels = np.zeros(1000)
+        levels[[10, 500]] = 1.0
+        levels[[11, 700]] = -1.0
+
+        indices = minmax(x, levels, 10)
+        assert len(indices) <= 22
+        assert indices[0] == 0 and indices[-1] == 999
+        assert (np.diff(indices) > 0).all()
+        assert {10, 11, 500, 700} <= set(indices)
+        assert list(minmax(x[:20], levels[:20], 10)) == list(range(20))
+
+    def test_decimate(self):
+        dates = num2date(np.arange(1000) / 96.0)
+        levels = np.random.rand(1000)
+
+        x, y = decimate(dates, levels, 50, method="lttb")
+        assert len(x) == len(y) == 50
+        assert x[0] == dates[0] and y[-1] == levels[-1]
+        x, y = decimate(dates, levels, 50)
+        assert len(x) == len(y) <= 102
+        assert max(y) == max(levels) and min(y) == min(levels)
+        with pytest.raises(ValueError):
+            decimate(dates, levels, 50, method="mean")
+
+    def test_aggregate(self):
+        dates = np.datetime64("2020-03-01T00:00") + np.arange(10) * np.timedelta64(
+            15, "m"
+        )
+        levels = np.arange(10.0)
+
+        starts, low, mean, high = aggregate(dates, levels, np.timedelta64(1, "h"))
+        assert list(starts) == list(
+            np.datetime64("2020-03-01T00:00", "s")
+            + np.arange(3) * np.timedelta64(1, "h")
+        )
+        assert list(low) == [0.0, 4.0, 8.0]
+        assert list(mean) == [1.5, 5.5, 8.5]
+        assert list(high) == [3.0, 7.0, 9.0]
+        assert len(aggregate(dates[:0], levels[:0], np.timedelta64(1, "D"))[0]) == 0
+
+    def test_level_pyramid(self):
+        # a year of readings every 15 minutes
+        dates = np.datetime64("2019-01-01") + np.arange(365 * 96) * np.timedelta64(
+            15, "m"
+        )
+        levels = np.random.rand(len(dates))
+        levels[1000] = 5.0
+        pyramid = LevelPyramid(dates, levels)
+        assert len(pyramid) == len(dates)
+        assert len(pyramid.level("daily")[0]) == 365
+        assert max(pyramid.level("weekly")[3]) == 5.0
+
+        end = dates[-1]
+        name, data = pyramid.select(end - np.timedelta64(2, "D"), end, max_points=1200)
+        assert name == "raw"
+        assert list(data["low"]) == list(data["levels"])
+        name, data = pyramid.select(end - np.timedelta64(30, "D"), end, max_points=1200)
+        assert name == "hourly"
+        assert len(data["dates"]) <= 1202
+        # the whole year
+        name, data = pyramid.select(max_points=1200)
+        assert name == "daily"
+        assert len(data["dates"]) == 365
+        assert max(data["high"]) == 5.0 and max(data["levels"]) < 5.0
+        # nothing fits, so the coarsest resolution is returned
+        assert pyramid.select(max_points=10)[0] == "weekly"
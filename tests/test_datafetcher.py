@@ -4,8 +4,30 @@
 """Unit test for the stationdata module"""
 
 import datetime
+import io
+import json
+import os
+import threading
+import time
 
-from floodsystem.datafetcher import fetch_measure_levels
+import dateutil.parser
+import numpy as np
+import pytest
+import requests
+
+from floodsystem import datafetcher
+from floodsystem.datafetcher import (
+    Cache,
+    ReadingsLRU,
+    fetch_measure_levels,
+    fetch_measure_levels_many,
+    fetch_measure_readings,
+    fetch_station_data,
+    iter_items,
+    parse_datetimes,
+    reset_transfer_stats,
+    transfer_stats,
+)
 from floodsystem.stationdata import build_station_list
 
 
@@ -37,3 +59,423 @@ def test_build_station_list():
     )
     assert len(dates10) == len(levels10)
     assert len(dates10) > len(levels2)
+
+
+def _readings(*values, hours_ago=1, now=None):
+    """Readings, newest first, taken an hour apart"""
+    if now is None:
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+    return {
+        "items": [
+            {
+                "dateTime": (now - datetime.timedelta(hours=i + hours_ago)).isoformat()
+                + "Z",
+                "value": v,
+            }
+            for i, v in enumerate(values)
+        ]
+    }
+
+
+def test_fetch_measure_levels_many(api, tmp_cache):
+    for name, values in (("a", (0.1, 0.2)), ("b", (1.5,)), ("c", (0.3, 0.4, 0.5))):
+        api.routes["/measures/{}/readings/".format(name)] = _readings(*values)
+    # the first two requests for b fail with a server error and are retried
+    api.failures["/measures/b/readings/"] = 2
+
+    measure_ids = [api.url("/measures/{}".format(i)) for i in "cba"]
+    results = fetch_measure_levels_many(
+        measure_ids, datetime.timedelta(days=2), max_per_host=2, backoff=0.01
+    )
+
+    assert [levels for _, levels in results] == [[0.3, 0.4, 0.5], [1.5], [0.1, 0.2]]
+    assert all(len(dates) == len(levels) for dates, levels in results)
+    assert len(api.requests) == 5
+    assert all("since=" in query for _, query in api.requests)
+
+
+def test_fetch_measure_levels_many_gives_up(api, tmp_cache):
+    api.failures["/measures/a/readings/"] = 10
+    with pytest.raises(requests.HTTPError):
+        fetch_measure_levels_many(
+            [api.url("/measures/a")], datetime.timedelta(days=2), retries=1, backoff=0
+        )
+    assert len(api.requests) == 2
+
+    # client errors are not retried
+    with pytest.raises(requests.HTTPError):
+        fetch_measure_levels_many([api.url("/measures/x")], datetime.timedelta(days=2))
+    assert len(api.requests) == 3
+
+
+def test_session_reuse_and_revalidation(api, tmp_cache, monkeypatch):
+    monkeypatch.setattr(datafetcher, "STATION_URL", api.url("/stations"))
+    api.routes["/stations"] = {
+        "items": [{"label": "Station {}".format(i)} for i in range(500)]
+    }
+    datafetcher.configure_session()
+    reset_transfer_stats()
+
+    data = fetch_station_data(use_cache=False)
+    assert len(data["items"]) == 500
+    assert "gzip" in api.headers[0]["Accept-Encoding"]
+
+    # unchanged, so the second refresh is answered with 304 from the same connection
+    assert fetch_station_data(use_cache=False) == data
+    assert "If-None-Match" in api.headers[1]
+    stats = transfer_stats()
+    assert stats["requests"] == 2
+    assert stats["not_modified"] == 1
+    assert stats["connections_opened"] == 1
+    assert 0 < stats["bytes_received"] < stats["bytes_decoded"]
+
+    # changed data is downloaded again
+    api.routes["/stations"] = {"items": []}
+    assert fetch_station_data(use_cache=False) == {"items": []}
+    assert fetch_station_data(use_cache=True) == {"items": []}
+    assert transfer_stats()["requests"] == 3
+
+
+def test_cache_expiry(api, tmp_cache):
+    url = api.url("/data")
+    api.routes["/data"] = {"items": [1]}
+    assert tmp_cache.get("data", url, ttl=60) == {"items": [1]}
+
+    # fresh entries are served from the cache
+    api.routes["/data"] = {"items": [2]}
+    assert tmp_cache.get("data", url, ttl=60) == {"items": [1]}
+    assert len(api.requests) == 1
+
+    # expired entries are refetched
+    assert tmp_cache.get("data", url, ttl=0) == {"items": [2]}
+    assert len(api.requests) == 2
+
+    # unchanged entries are revalidated without being downloaded again
+    assert tmp_cache.get("data", url, ttl=60, refresh=True) == {"items": [2]}
+    assert len(api.requests) == 3
+    assert tmp_cache.age("data") < 60
+
+
+def test_cache_offline(api, tmp_cache):
+    url = api.url("/data")
+    api.routes["/data"] = {"items": [1]}
+    tmp_cache.get("data", url, ttl=60)
+
+    # an expired entry is used when it cannot be revalidated
+    api.failures["/data"] = 10
+    assert tmp_cache.get("data", url, ttl=0) == {"items": [1]}
+    with pytest.raises(requests.HTTPError):
+        tmp_cache.get("data", url, ttl=0, refresh=True)
+    with pytest.raises(requests.HTTPError):
+        tmp_cache.get("other", api.url("/other"), ttl=0)
+
+
+def test_cache_stale_while_revalidate(api, tmp_cache):
+    url = api.url("/data")
+    api.routes["/data"] = {"items": [1]}
+    tmp_cache.get("data", url, ttl=60)
+    api.routes["/data"] = {"items": [2]}
+
+    # the stale copy is returned at once and refreshed in the background
+    assert tmp_cache.get("data", url, ttl=0, stale_ttl=60) == {"items": [1]}
+    for _ in range(100):
+        if tmp_cache.read("data") == {"items": [2]}:
+            break
+        time.sleep(0.02)
+    assert tmp_cache.read("data") == {"items": [2]}
+
+
+def test_cache_eviction(tmp_path):
+    cache = Cache(str(tmp_path))
+    cache.write("readings/0", {"items": [0] * 20})
+    # room for five entries
+    cache.max_bytes = os.path.getsize(cache.path("readings/0")) * 11 // 2
+    for i in range(5):
+        cache.write("readings/{}".format(i), {"items": [i] * 20})
+        # distinct modification times for a deterministic eviction order
+        os.utime(cache.path("readings/{}".format(i)), (i, i))
+    cache.read("readings/0")  # recently used entries are kept
+    cache.write("readings/5", {"items": [5] * 20})
+
+    assert cache.read("readings/0") is not None
+    assert cache.read("readings/5") is not None
+    assert cache.read("readings/1") is None
+    assert cache.read_meta("readings/1") is None
+    assert not [i for i in os.listdir(str(tmp_path / "readings")) if ".tmp" in i]
+
+
+def test_cache_eviction_keeps_other_files(tmp_path):
+    cache = Cache(str(tmp_path), max_bytes=0)
+    # e.g. the scaling parameters saved next to a trained model
+    datafetcher.dump({"min": 0.0}, str(tmp_path / "Station A.scaler.json"))
+    os.utime(str(tmp_path / "Station A.scaler.json"), (0, 0))
+    cache.write_arrays("readings/a", {"levels": np.arange(100.0)})
+    cache.write("readings/b", {"items": [0] * 20})
+
+    assert os.path.exists(str(tmp_path / "Station A.scaler.json"))
+    assert cache.read_arrays("readings/a") is None
+    assert cache.read("readings/b") is not None
+
+
+def test_fetch_measure_levels_cached(api, tmp_cache):
+    api.routes["/measures/a/readings/"] = _readings(0.1, 0.2)
+    dates, levels = fetch_measure_levels(
+        api.url("/measures/a"), dt=datetime.timedelta(days=2)
+    )
+    assert levels == [0.1, 0.2]
+    assert fetch_measure_levels(
+        api.url("/measures/a"), dt=datetime.timedelta(days=2)
+    ) == (dates, levels)
+    assert len(api.requests) == 1
+
+    # a different time window is a different entry
+    fetch_measure_levels(api.url("/measures/a"), dt=datetime.timedelta(days=3))
+    assert len(api.requests) == 2
+
+
+def test_fetch_measure_levels_incremental(api, tmp_cache, monkeypatch):
+    measure_id = api.url("/measures/a")
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    api.routes["/measures/a/readings/"] = _readings(0.3, 0.2, 0.1, hours_ago=2, now=now)
+    dates, levels = fetch_measure_levels(measure_id, dt=datetime.timedelta(days=2))
+    assert levels == [0.3, 0.2, 0.1]
+
+    # within the time to live no request is made
+    api.routes["/measures/a/readings/"] = _readings(0.5, 0.4, 0.3, hours_ago=0, now=now)
+    assert fetch_measure_levels(measure_id, dt=datetime.timedelta(days=1))[1] == levels
+    assert len(api.requests) == 1
+
+    # after it, only readings since the last stored one are requested and merged
+    monkeypatch.setitem(datafetcher.CACHE_POLICY, "readings", (0, 0))
+
+    dates, levels = fetch_measure_levels(measure_id, dt=datetime.timedelta(days=2))
+    assert levels == [0.5, 0.4, 0.3, 0.2, 0.1]
+    assert dates == sorted(dates, reverse=True)
+    assert len(api.requests) == 2
+    assert api.requests[1][1].endswith(dates[2].strftime("%Y-%m-%dT%H:%M:%SZ"))
+
+    # a longer period than stored is fetched in full
+    fetch_measure_levels(measure_id, dt=datetime.timedelta(days=5))
+    assert len(api.requests) == 3
+
+
+def test_fetch_measure_readings(api, tmp_cache):
+    measure_id = api.url("/measures/a")
+    api.routes["/measures/a/readings/"] = _readings(0.3, 0.2, 0.1)
+    dates, levels = fetch_measure_readings(measure_id, dt=datetime.timedelta(days=2))
+    assert dates.dtype.kind == "M"
+    assert list(levels) == [0.1, 0.2, 0.3]
+    assert (np.diff(dates) == np.timedelta64(1, "h")).all()
+
+    # read back as memory-mapped slices of the cache
+    dates, levels = fetch_measure_readings(measure_id, dt=datetime.timedelta(hours=2))
+    assert isinstance(levels.base, np.memmap) or isinstance(levels, np.memmap)
+    assert list(levels) == [0.2, 0.3]
+    assert len(api.requests) == 1
+
+
+def test_fetch_measure_readings_refresh(api, tmp_cache):
+    measure_id = api.url("/measures/a")
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    api.routes["/measures/a/readings/"] = _readings(0.3, 0.2, now=now)
+    fetch_measure_readings(measure_id, dt=datetime.timedelta(days=2))
+
+    # a new reading is only fetched while the stored history is fresh when asked
+    api.routes["/measures/a/readings/"] = _readings(0.4, 0.3, 0.2, hours_ago=0, now=now)
+    _, levels = fetch_measure_readings(measure_id, dt=datetime.timedelta(days=2))
+    assert list(levels) == [0.2, 0.3]
+    _, levels = fetch_measure_readings(
+        measure_id, dt=datetime.timedelta(days=2), use_cache=False
+    )
+    assert list(levels) == [0.2, 0.3, 0.4]
+    assert len(api.requests) == 2
+
+
+def test_history_trimmed(api, tmp_cache):
+    measure_id = api.url("/measures/a")
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    api.routes["/measures/a/readings/"] = _readings(0.3, 0.2, 0.1, now=now)
+    fetch_measure_readings(measure_id, dt=datetime.timedelta(hours=4))
+    key = datafetcher._history_key(measure_id)
+    assert tmp_cache.read_meta(key)["window"] == 4 * 3600
+
+    # appending keeps the readings of the longest period asked for
+    api.routes["/measures/a/readings/"] = _readings(0.4, 0.3, hours_ago=0, now=now)
+    fetch_measure_readings(measure_id, dt=datetime.timedelta(hours=1), use_cache=False)
+    assert list(tmp_cache.read_arrays(key)["levels"]) == [0.1, 0.2, 0.3, 0.4]
+
+    meta = tmp_cache.read_meta(key)
+    meta["window"] = 90 * 60
+    datafetcher.dump(meta, tmp_cache._meta_path(key))
+    _, levels = fetch_measure_readings(
+        measure_id, dt=datetime.timedelta(hours=1), use_cache=False
+    )
+    assert list(levels) == [0.3, 0.4]
+    assert list(tmp_cache.read_arrays(key)["levels"]) == [0.3, 0.4]
+    assert np.datetime64(tmp_cache.read_meta(key)["start"]) > np.datetime64(
+        now - datetime.timedelta(hours=2)
+    )
+
+
+def test_fetch_many_evicts_once(api, tmp_cache, monkeypatch):
+    evictions = []
+    evict = tmp_cache.evict
+    monkeypatch.setattr(
+        tmp_cache, "evict", lambda keep=None: evictions.append(keep) or evict(keep)
+    )
+    for name in "abc":
+        api.routes["/measures/{}/readings/".format(name)] = _readings(0.1)
+    fetch_measure_levels_many(
+        [api.url("/measures/{}".format(i)) for i in "abc"],
+        dt=datetime.timedelta(days=1),
+    )
+    assert evictions == [None]
+
+
+def test_readings_lru(api, tmp_cache, monkeypatch):
+    calls = []
+
+    def counting(measure_id, dt, use_cache=True):
+        calls.append(measure_id)
+        return fetch_measure_readings(measure_id, dt, use_cache)
+
+    monkeypatch.setattr(datafetcher, "fetch_measure_readings", counting)
+    for name in "abc":
+        api.routes["/measures/{}/readings/".format(name)] = _readings(0.3, 0.2, 0.1)
+    a, b, c = (api.url("/measures/{}".format(i)) for i in "abc")
+    lru = ReadingsLRU(maxsize=2, ttl=60)
+
+    dates, levels = lru.get(a, datetime.timedelta(days=2))
+    assert list(levels) == [0.1, 0.2, 0.3]
+    assert not levels.flags.writeable
+    # shorter windows are sliced out of the kept history
+    assert list(lru.get(a, datetime.timedelta(hours=2))[1]) == [0.2, 0.3]
+    assert calls == [a]
+    # the pyramid is computed once, when the history is stored
+    pyramid = lru.pyramid(a, datetime.timedelta(days=1))
+    assert list(pyramid.levels) == [0.1, 0.2, 0.3]
+    assert lru.pyramid(a, datetime.timedelta(days=2)) is pyramid
+    assert calls == [a]
+
+    # a longer window than the kept one is fetched again
+    lru.get(a, datetime.timedelta(days=3))
+    assert calls == [a, a]
+
+    lru.get(b, datetime.timedelta(days=2))
+    lru.get(a, datetime.timedelta(days=2))
+    lru.get(c, datetime.timedelta(days=2))
+    # b was the least recently used
+    lru.get(b, datetime.timedelta(days=2))
+    assert calls == [a, a, b, c, b]
+    assert len(lru) == 2
+
+    lru.invalidate(b)
+    lru.get(b, datetime.timedelta(days=2))
+    assert calls[-1] == b and len(calls) == 6
+
+
+def test_readings_lru_prefetch(api, tmp_cache, monkeypatch):
+    calls = []
+
+    def counting(measure_id, dt, use_cache=True):
+        calls.append(measure_id)
+        return fetch_measure_readings(measure_id, dt, use_cache)
+
+    monkeypatch.setattr(datafetcher, "fetch_measure_readings", counting)
+    api.routes["/measures/a/readings/"] = _readings(0.3, 0.2, 0.1)
+    api.routes["/measures/b/readings/"] = _readings(0.5)
+    a, b = api.url("/measures/a"), api.url("/measures/b")
+    lru = ReadingsLRU(ttl=60)
+    api.delay = 0.2
+
+    futures = lru.prefetch([a, b, a], datetime.timedelta(days=2))
+    assert len(futures) == 2
+    # waits for the prefetch in flight instead of fetching again
+    assert list(lru.get(a, datetime.timedelta(days=1))[1]) == [0.1, 0.2, 0.3]
+    for future in futures:
+        future.result()
+    assert sorted(calls) == [a, b]
+    assert lru.prefetch([a, b], datetime.timedelta(days=2)) == []
+
+
+def test_readings_lru_keeps_latest(monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    then = np.datetime64(datetime.datetime.utcnow() - datetime.timedelta(hours=1), "s")
+
+    def fetching(measure_id, dt, use_cache=True):
+        if use_cache:
+            # a slow fetch of the readings before the level changed
+            started.set()
+            release.wait(10)
+            return np.array([then]), np.array([0.1])
+        return np.array([then, then + np.timedelta64(15, "m")]), np.array([0.1, 0.2])
+
+    monkeypatch.setattr(datafetcher, "fetch_measure_readings", fetching)
+    lru = ReadingsLRU(ttl=60)
+    prefetch = threading.Thread(target=lru.get, args=("a", datetime.timedelta(days=1)))
+    prefetch.start()
+    assert started.wait(10)
+    assert list(lru.get("a", datetime.timedelta(days=1), use_cache=False)[1]) == [
+        0.1,
+        0.2,
+    ]
+    release.set()
+    prefetch.join(10)
+
+    # the slower fetch finishing later does not replace the newer history
+    assert list(lru.get("a", datetime.timedelta(days=1))[1]) == [0.1, 0.2]
+
+
+def test_cache_arrays(tmp_path):
+    cache = Cache(str(tmp_path))
+    assert cache.read_arrays("history/a") is None
+    cache.write_arrays("history/a", {"x": np.arange(3), "y": np.ones(3)}, start="t")
+    cache.write_arrays("history/a", {"x": np.arange(4), "y": np.ones(4)}, start="t")
+    columns = cache.read_arrays("history/a")
+    assert list(columns["x"]) == [0, 1, 2, 3]
+    assert cache.read_meta("history/a")["start"] == "t"
+    # the files of the replaced columns are removed
+    assert len(os.listdir(str(tmp_path / "history"))) == 3
+
+    cache.remove("history/a")
+    assert os.listdir(str(tmp_path / "history")) == []
+
+
+def test_parse_datetimes():
+    with open(
+        os.path.join(os.path.dirname(__file__), "fixtures", "readings.json")
+    ) as f:
+        strings = [i["dateTime"] for i in json.load(f)["items"]]
+    expected = [dateutil.parser.parse(i).replace(tzinfo=None) for i in strings]
+    assert parse_datetimes(strings).tolist() == expected
+
+    # other formats fall back to dateutil
+    dates = parse_datetimes(
+        [
+            "2020-03-01T10:00:00Z",
+            "2020-03-01T10:15:00+01:00",
+            "2020-03-01T10:30:00",
+            "2020-03-01T10:45:00.000Z",
+            "2020-03-01T11:00:00Z",
+        ]
+    )
+    assert list(np.diff(dates).astype(int)) == [-45 * 60, 75 * 60, 15 * 60, 15 * 60]
+    assert parse_datetimes([]).dtype == np.dtype("datetime64[s]")
+
+
+def test_iter_items():
+    with open(
+        os.path.join(os.path.dirname(__file__), "fixtures", "readings.json")
+    ) as f:
+        text = f.read()
+    expected = json.loads(text)["items"]
+    for chunk_size in (1, 7, 2 ** 16):
+        assert list(iter_items(io.StringIO(text), chunk_size)) == expected
+
+    assert list(iter_items(io.StringIO('{"items": [], "meta": {"items": [1]}}'))) == []
+    assert list(iter_items(io.StringIO('{"a": {"items": [1]}, "items": [2.5]}'))) == [
+        2.5
+    ]
+    assert list(iter_items(io.StringIO("{}"))) == []
+    with pytest.raises(ValueError):
+        list(iter_items(io.StringIO('{"items": [{"a": 1}, {"b"'), 4))
@@ -4,7 +4,7 @@
 """Unit test for the flood module"""
 
 from floodsystem.flood import *
-from floodsystem.station import MonitoringStation
+from floodsystem.station import MonitoringStation, StationTable
 
 
 class TestClass:
@@ -91,3 +91,60 @@ class TestClass:
 
         assert stations_highest_rel_level(stations, 3) == [station2, station1, station3]
         assert stations_highest_rel_level(stations, 2) == [station2, station1]
+
+    def test_station_table(self):
+        stations = [
+            MonitoringStation(
+                station_id="s{}".format(i),
+                measure_id="m{}".format(i),
+                label="Station {}".format(i),
+                coord=(0.0, 1.0),
+                typical_range=None if i % 5 == 0 else (0.0, 1.0 + i % 3),
+                river="River",
+                town="Town",
+            )
+            for i in range(20)
+        ]
+        for i, station in enumerate(stations):
+            station.latest_level = None if i % 7 == 0 else (i * 13 % 10) / 4
+        table = StationTable.from_stations(stations)
+
+        assert stations_level_over_threshold(
+            table, 0.5
+        ) == stations_level_over_threshold(stations, 0.5)
+        for N in (0, 1, 2, 3, 5, 50):
+            assert stations_highest_rel_level(
+                table, N
+            ).to_stations() == stations_highest_rel_level(stations, N)
+
+    def test_flood_ranking(self):
+        stations = [
+            MonitoringStation(
+                station_id="s{}".format(i),
+                measure_id="m{}".format(i),
+                label="Station {}".format(i),
+                coord=(0.0, 1.0),
+                typical_range=None if i % 9 == 0 else (0.0, 1.0),
+                river="River",
+                town="Town",
+            )
+            for i in range(10)
+        ]
+        levels = [3.0, 0.5, 1.5, 2.5, 1.2, None, 1.5, 0.9, 2.0, 1.8]
+        for station, level in zip(stations, levels):
+            station.latest_level = level
+        ranking = FloodRanking(stations, thresholds=(2.0, 1.0, 1.5))
+
+        assert ranking.order.tolist() == [3, 8, 2, 6, 4, 7, 1]
+        assert ranking.over(1.5).tolist() == [3, 8]
+        assert ranking.over(1.4).tolist() == [3, 8, 2, 6]
+        assert ranking.top(3).tolist() == [3, 8, 2]
+        assert {t: i.tolist() for t, i in ranking.bands().items()} == {
+            1.0: [2, 6, 4],
+            1.5: [8],
+            2.0: [3],
+        }
+        assert ranking.severity.tolist() == [-1, 0, 1, 3, 1, -1, 1, 0, 2, -1]
+        assert ranking.stations(ranking.top(2)) == [stations[3], stations[8]]
+        assert ranking.view(ranking.top(2)).name.tolist() == ["Station 3", "Station 8"]
+        assert ranking.levels(ranking.over(2.0)) == [(stations[3], 2.5)]
@@ -5,8 +5,11 @@
 
 from os import path
 
+import numpy as np
+import pytest
+
 from floodsystem.geo import *
-from floodsystem.station import MonitoringStation
+from floodsystem.station import MonitoringStation, StationTable
 
 
 class TestClass:
@@ -17,6 +20,17 @@ class TestClass:
         assert round(haversine((0.0, 0.0), (1.0, 0.0)), 2) == 111.19
         assert round(haversine((0.0, 0.0), (0.0, 1.0)), 2) == 111.19
 
+    def test_haversine_many(self):
+        a = [(0.0, 0.0), (1.0, 1.0), (52.2, 0.12), (-33.9, 151.2)]
+        b = [(0.0, 1.0), (51.5, -0.13)]
+        assert haversine_many(a, b[1]) == pytest.approx([haversine(i, b[1]) for i in a])
+        matrix = haversine_matrix(a, b)
+        assert matrix.shape == (4, 2)
+        assert matrix == pytest.approx(
+            np.array([[haversine(i, j) for j in b] for i in a])
+        )
+        assert haversine_many([], (0.0, 0.0)).shape == (0,)
+
     def test_stations_by_distance(self):
         station1 = MonitoringStation(
             station_id="test_station_id_1",
@@ -175,3 +189,211 @@ class TestClass:
         assert rivers_by_station_number(
             [station1, station2, station3, station4], 5
         ) == [("River 2", 2), ("River 1", 1), ("River 3", 1)]
+
+    def test_station_table(self):
+        stations = [
+            MonitoringStation(
+                station_id="s{}".format(i),
+                measure_id="m{}".format(i),
+                label="Station {}".format(i),
+                coord=(50.0 + (i * 7 % 10) / 10, -1.0 + (i * 3 % 10) / 10),
+                typical_range=(0.0, 1.0),
+                river="River {}".format(i % 4 if i < 12 else 0),
+                town="Town {}".format(i),
+            )
+            for i in range(20)
+        ]
+        table = StationTable.from_stations(stations)
+
+        assert stations_by_distance(table, (50.3, -0.6)) == [
+            (name, town, pytest.approx(d))
+            for name, town, d in stations_by_distance(stations, (50.3, -0.6))
+        ]
+        assert stations_within_radius(table, (50.3, -0.6), 40).to_stations() == (
+            stations_within_radius(stations, (50.3, -0.6), 40)
+        )
+        assert rivers_with_station(table) == rivers_with_station(stations)
+        assert {
+            river: subset.to_stations()
+            for river, subset in stations_by_river(table).items()
+        } == stations_by_river(stations)
+        assert list(stations_by_river(table)) == list(stations_by_river(stations))
+        for N in range(1, 5):
+            assert rivers_by_station_number(table, N) == rivers_by_station_number(
+                stations, N
+            )
+
+    def test_rivers_by_station_number_ties(self):
+        rng = np.random.RandomState(1)
+        stations = [
+            MonitoringStation(
+                "s{}".format(i),
+                "m{}".format(i),
+                "Station {}".format(i),
+                (0.0, 0.0),
+                None,
+                "River {}".format(rng.randint(40)),
+                None,
+            )
+            for i in range(300)
+        ]
+        table = StationTable.from_stations(stations)
+
+        # counts sorted in full and taken while below N or tied with the last
+        counts = sorted(
+            [(river, len(i)) for river, i in stations_by_river(stations).items()],
+            key=lambda x: (-x[1], x[0]),
+        )
+        for N in (1, 2, 5, 13, 40, 100):
+            expected = [x for x in counts if x[1] >= counts[min(N, len(counts)) - 1][1]]
+            assert rivers_by_station_number(stations, N) == expected
+            assert rivers_by_station_number(table, N) == expected
+            assert rivers_by_station_number(table[:150], N) == (
+                rivers_by_station_number(stations[:150], N)
+            )
+
+    def test_river_town_index(self):
+        stations = [
+            MonitoringStation(
+                "s{}".format(i),
+                "m{}".format(i),
+                "Station {}".format(i),
+                (0.0, 0.0),
+                None,
+                None if i % 5 == 0 else "River {}".format(i % 3),
+                None if i % 4 == 0 else "Town {}".format(i % 2),
+            )
+            for i in range(20)
+        ]
+        index = RiverTownIndex(stations)
+        assert len(index) == 20
+
+        # None sorts last instead of breaking the sort
+        by_river = stations_by_river(stations)
+        assert list(by_river) == ["River 0", "River 1", "River 2", None]
+        assert stations_by_river(index) == by_river
+        assert list(stations_by_river(StationTable.from_stations(stations))) == list(
+            by_river
+        )
+        assert rivers_with_station(index) == rivers_with_station(stations)
+        assert rivers_by_station_number(index, 2) == rivers_by_station_number(
+            stations, 2
+        )
+        assert index.stations_in_town(None) == [stations[i] for i in (0, 4, 8, 12, 16)]
+        assert index.town_count("Town 1") == 10
+
+        index.remove(stations[1])
+        index.add(stations[1])
+        index.add(stations[1])
+        assert index.river_count("River 1") == 6
+        assert index.stations_on_river("River 1")[-1] is stations[1]
+
+        for station in index.stations_on_river("River 2"):
+            index.remove(station)
+        assert "River 2" not in index.rivers()
+        assert index.river_count("River 2") == 0
+        assert stations[2] not in index
+        with pytest.raises(KeyError):
+            index.remove(stations[2])
+
+    def test_spatial_index(self):
+        rng = np.random.RandomState(0)
+        coords = np.column_stack(
+            (rng.uniform(-90, 90, 3000), rng.uniform(-180, 180, 3000))
+        )
+        # a dense cluster, as the UK network is
+        coords[:1000] = np.column_stack(
+            (rng.uniform(50, 55, 1000), rng.uniform(-5, 1, 1000))
+        )
+        index = SpatialIndex(coords, cell_size=0.5)
+
+        for centre, r in (
+            ((52.2, 0.12), 30),
+            ((52.2, 0.12), 500),
+            ((10.0, 179.5), 800),
+            ((-89.0, 0.0), 400),
+            ((0.0, 0.0), 30000),
+        ):
+            expected = np.flatnonzero(haversine_many(coords, centre) <= r)
+            assert index.within_radius(centre, r).tolist() == expected.tolist()
+
+            for k in (1, 7):
+                indices, distance = index.nearest(centre, k)
+                brute = haversine_many(coords, centre)
+                assert indices.tolist() == np.argsort(brute, kind="stable")[:k].tolist()
+                assert distance == pytest.approx(np.sort(brute)[:k])
+
+        lat, lon = coords[:, 0], coords[:, 1]
+        box = index.within_box(51.0, -2.0, 53.0, 0.5)
+        expected = (lat >= 51) & (lat <= 53) & (lon >= -2) & (lon <= 0.5)
+        assert box.tolist() == np.flatnonzero(expected).tolist()
+        box = index.within_box(-10.0, 170.0, 10.0, -170.0)
+        expected = (lat >= -10) & (lat <= 10) & ((lon >= 170) | (lon <= -170))
+        assert box.tolist() == np.flatnonzero(expected).tolist()
+
+        assert len(SpatialIndex([]).nearest((0.0, 0.0), 3)[0]) == 0
+
+    def test_stations_with_index(self):
+        stations = [
+            MonitoringStation(
+                station_id="s{}".format(i),
+                measure_id="m{}".format(i),
+                label="Station {}".format(i),
+                coord=(50.0 + i / 10, -1.0 + i / 20),
+                typical_range=(0.0, 1.0),
+                river="River",
+                town="Town {}".format(i),
+            )
+            for i in range(30)
+        ]
+        table = StationTable.from_stations(stations)
+        index = SpatialIndex.from_stations(stations)
+
+        assert stations_within_radius(
+            stations, (51.0, -0.5), 60, index=index
+        ) == stations_within_radius(stations, (51.0, -0.5), 60)
+        assert stations_within_radius(
+            table, (51.0, -0.5), 60, index=index
+        ).to_stations() == stations_within_radius(stations, (51.0, -0.5), 60)
+        assert [i.name for i in stations_nearest(stations, (51.0, -0.5), 3)] == [
+            "Station 10",
+            "Station 11",
+            "Station 9",
+        ]
+        assert stations_nearest(table, (51.0, -0.5), 3, index=index).name.tolist() == [
+            "Station 10",
+            "Station 11",
+            "Station 9",
+        ]
+
+    def test_cluster_stations(self):
+        rng = np.random.RandomState(2)
+        # two groups of stations 5 km apart, far from each other, and a lone station
+        coords = np.concatenate(
+            (
+                [52.2, 0.1] + rng.uniform(-0.02, 0.02, (6, 2)),
+                [51.5, -1.0] + rng.uniform(-0.02, 0.02, (5, 2)),
+                [[54.0, -2.0]],
+            )
+        )
+        stations = [
+            MonitoringStation(
+                "s{}".format(i), "m{}".format(i), "S", tuple(c), None, None, None
+            )
+            for i, c in enumerate(coords)
+        ]
+        labels = cluster_stations(stations)
+        assert labels.tolist() == [0] * 6 + [1] * 5 + [-1]
+        assert cluster_stations(StationTable.from_stations(stations)).tolist() == (
+            labels.tolist()
+        )
+        assert len(cluster_stations([])) == 0
+
+        # stations sharing coordinates are counted once
+        assert cluster_stations(stations[11:] * 5).tolist() == [-1] * 5
+        shared = stations[6:7] * 3 + stations[7:8]
+        assert cluster_stations(shared, min_samples=3).tolist() == [-1] * 4
+        assert cluster_stations(shared, min_samples=2).tolist() == [0] * 4
+        assert cluster_stations(stations + stations[:1]).tolist() == (
+            labels.tolist() + [0]
+        )
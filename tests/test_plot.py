@@ -2,11 +2,15 @@
 #
 # SPDX-License-Identifier: MIT
 
+import datetime
+import threading
 from os import path
 
 from matplotlib.dates import num2date
 from bokeh.io import show
 
+from floodsystem.analysis import LevelPyramid
+from floodsystem.datafetcher import ReadingsLRU
 from floodsystem.plot import *
 from floodsystem.station import MonitoringStation
 
@@ -54,3 +58,119 @@ class TestClass:
 
         show(plot_water_level_with_fit(station2, dates, levels, 2))
         assert path.isfile(station2.name + ".html")
+
+    def test_plot_water_levels_multiple(self, monkeypatch):
+        stations = [
+            MonitoringStation(
+                station_id="test_station_id_{}".format(i),
+                measure_id="test_measure_id_{}".format(i),
+                label="Test Station {}".format(i),
+                coord=(0.0, 1.0),
+                typical_range=(0.0, 1.0),
+                river="test_river",
+                town="test_town",
+            )
+            for i in range(4)
+        ]
+        histories = [([0, 1, 2], [0.1 * i, 0.2, 0.3]) for i in range(4)]
+        grid = plot_water_levels_multiple(stations, 2, ncol=2, histories=histories)
+        plots = [child[0] for child in grid.children[1].children]
+        assert len(plots) == 4
+        # one formatter shared by every graph, one annotation per graph
+        assert len({id(p.xaxis[0].formatter) for p in plots}) == 1
+        assert all(len(p.center) == 3 for p in plots)
+        sources = [p.renderers[0].data_source for p in plots]
+        assert len({id(s) for s in sources}) == 4
+        assert list(sources[1].data["levels"]) == [0.1, 0.2, 0.3]
+
+        # placeholders are filled in through schedule as the levels arrive
+        def fetch(measure_id, dt):
+            if measure_id == "test_measure_id_2":
+                raise ValueError(measure_id)
+            return [0, 1], [float(measure_id[-1])] * 2
+
+        monkeypatch.setattr("floodsystem.plot.fetch_measure_readings", fetch)
+        updates = []
+        done = threading.Event()
+
+        def schedule(update):
+            updates.append(update)
+            if len(updates) == 3:
+                done.set()
+
+        grid = plot_water_levels_multiple(
+            stations, 2, ncol=2, placeholders=True, schedule=schedule
+        )
+        plots = [child[0] for child in grid.children[1].children]
+        sources = [p.renderers[0].data_source for p in plots]
+        assert all(len(s.data["levels"]) == 0 for s in sources)
+        assert done.wait(5)
+        for update in updates:
+            update()
+        assert [list(s.data["levels"]) for s in sources] == [
+            [0.0, 0.0],
+            [1.0, 1.0],
+            [],
+            [3.0, 3.0],
+        ]
+
+    def test_stream_new_readings(self, api, tmp_cache):
+        measure_id = api.url("/measures/a")
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+
+        def readings(*values):
+            return {
+                "items": [
+                    {
+                        "dateTime": (now - datetime.timedelta(hours=i)).isoformat()
+                        + "Z",
+                        "value": v,
+                    }
+                    for i, v in enumerate(values)
+                ]
+            }
+
+        api.routes["/measures/a/readings/"] = readings(0.3, 0.2, 0.1)
+        lru = ReadingsLRU(ttl=60)
+        dates, levels = lru.get(measure_id, datetime.timedelta(days=1))
+        source = ColumnDataSource(
+            data=dict(dates=dates, levels=levels, low=levels, high=levels)
+        )
+        assert stream_new_readings(source, dates, levels) == 0
+
+        # the level changed within the time to live of the kept history
+        now += datetime.timedelta(minutes=15)
+        api.routes["/measures/a/readings/"] = readings(0.4, 0.3, 0.2, 0.1)
+        pyramid = lru.pyramid(measure_id, datetime.timedelta(days=1), use_cache=False)
+        assert stream_new_readings(source, pyramid.dates, pyramid.levels) == 1
+        assert list(source.data["levels"]) == [0.2, 0.3, 0.4]
+        assert list(source.data["high"]) == [0.2, 0.3, 0.4]
+
+    def test_stream_new_buckets(self):
+        dates = np.datetime64("2020-03-01T00:00") + np.arange(6) * np.timedelta64(
+            15, "m"
+        )
+        levels = np.array([1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+        resolution, data = LevelPyramid(dates, levels).select(max_points=3)
+        assert resolution == "hourly"
+        source = ColumnDataSource(data=data)
+
+        # a reading within the last hour only changes its bucket
+        pyramid = LevelPyramid(
+            np.append(dates, dates[-1] + np.timedelta64(15, "m")), np.append(levels, 7)
+        )
+        dates_h, low, mean, high = pyramid.level("hourly")
+        assert stream_new_readings(source, dates_h, mean, low, high) == 1
+        assert list(source.data["levels"]) == [2.5, 6.0]
+        assert list(source.data["low"]) == [1.0, 5.0]
+        assert list(source.data["high"]) == [4.0, 7.0]
+
+        # a reading in the next hour starts a new bucket
+        pyramid = LevelPyramid(
+            np.append(pyramid.dates, dates[0] + np.timedelta64(2, "h")),
+            np.append(pyramid.levels, 8),
+        )
+        dates_h, low, mean, high = pyramid.level("hourly")
+        assert stream_new_readings(source, dates_h, mean, low, high) == 1
+        assert list(source.data["levels"]) == [6.0, 8.0]
+        assert list(source.data["dates"]) == list(dates_h[1:])
@@ -0,0 +1,107 @@
+# Copyright (C) 2020 Weixuan Zhang
+#
+# SPDX-License-Identifier: MIT
+"""Unit test for the predictor module"""
+
+import numpy as np
+import pytest
+
+from floodsystem.predictor import (
+    fit_scaler,
+    load_scaler,
+    model_scaler,
+    rollout,
+    save_scaler,
+    scaler_file,
+)
+
+
+@pytest.mark.parametrize(
+    "levels", [np.linspace(0.2, 3.5, 50), np.full(50, 1.25)], ids=["range", "constant"]
+)
+def test_scaler_round_trip(tmp_path, levels):
+    scaler = fit_scaler(levels)
+    filename = scaler_file(str(tmp_path / "Station A.hdf5"))
+    assert filename == str(tmp_path / "Station A.scaler.json")
+    save_scaler(scaler, filename)
+    loaded = load_scaler(filename)
+
+    x = np.concatenate((levels, [0.0, 5.0])).reshape(-1, 1)
+    assert np.allclose(loaded.transform(x), scaler.transform(x))
+    assert np.allclose(loaded.inverse_transform(x), scaler.inverse_transform(x))
+
+
+def test_model_scaler(tmp_path):
+    model_file = str(tmp_path / "Station A.hdf5")
+    levels = np.linspace(1.0, 2.0, 20)
+
+    # a model saved without its scaling parameters
+    scaler = model_scaler(model_file, levels)
+    assert scaler.transform([[1.0], [2.0]]).ravel().tolist() == [0.0, 1.0]
+
+    # the parameters saved with the model are used, not the dataset
+    save_scaler(fit_scaler([0.0, 4.0]), scaler_file(model_file))
+    scaler = model_scaler(model_file, levels)
+    assert scaler.transform([[1.0], [2.0]]).ravel().tolist() == [0.25, 0.5]
+
+
+class StubModel:
+    """Model predicting the mean of its window plus one step, recording its inputs"""
+
+    def __init__(self):
+        self.inputs = []
+
+    def predict_on_batch(self, x):
+        self.inputs.append(np.array(x))
+        return x.mean(axis=2) + 0.1
+
+    def predict(self, x):
+        return self.predict_on_batch(x)
+
+
+def loop_rollout(model, window, steps):
+    """The rollout of predictor.predict before it was batched, one step at a time"""
+
+    lookback = len(window)
+    predictions = None
+    levels = window.reshape(1, 1, lookback)
+    for _ in range(steps):
+        prediction = model.predict(levels)
+        levels = np.append(
+            levels[:, :, -lookback + 1 :], prediction.reshape(1, 1, 1), axis=2
+        )
+        predictions = (
+            np.append(predictions, prediction, axis=0)
+            if predictions is not None
+            else prediction
+        )
+    return predictions
+
+
+def test_rollout():
+    rng = np.random.RandomState(0)
+    windows = rng.uniform(0, 1, (3, 5)).astype(np.float32)
+    model = StubModel()
+
+    predictions = rollout(model, windows, 4)
+    assert predictions.shape == (3, 4)
+    assert len(model.inputs) == 4
+    assert model.inputs[0].shape == (3, 1, 5)
+    assert np.array_equal(model.inputs[0][:, 0], windows)
+    for step in range(1, 4):
+        previous, current = model.inputs[step - 1][:, 0], model.inputs[step][:, 0]
+        # shifted by one, ending with the last prediction
+        assert np.array_equal(current[:, :-1], previous[:, 1:])
+        assert np.array_equal(current[:, -1], predictions[:, step - 1])
+    assert np.allclose(predictions[:, 0], windows.mean(axis=1) + 0.1)
+
+
+def test_rollout_matches_loop():
+    rng = np.random.RandomState(1)
+    windows = rng.uniform(0, 1, (2, 6)).astype(np.float32)
+
+    predictions = rollout(StubModel(), windows, 10)
+    for window, rolled in zip(windows, predictions):
+        looped = loop_rollout(StubModel(), window, 10)
+        assert looped.shape == (10, 1)
+        assert np.allclose(looped.ravel(), rolled)
@@ -0,0 +1,160 @@
+# Copyright (C) 2020 Weixuan Zhang
+#
+# SPDX-License-Identifier: MIT
+"""Unit test for the refresh module"""
+
+import threading
+
+import pytest
+
+from floodsystem import datafetcher
+from floodsystem.refresh import RefreshScheduler, risk_clusters, risk_index
+
+
+@pytest.fixture
+def network(api, tmp_cache, monkeypatch):
+    monkeypatch.setattr(datafetcher, "STATION_URL", api.url("/stations"))
+    monkeypatch.setattr(datafetcher, "LEVEL_URL", api.url("/measures"))
+    api.routes["/stations"] = {
+        "items": [
+            {
+                "@id": "s{}".format(i),
+                "label": "Station {}".format(i),
+                "lat": 52.0,
+                "long": 0.1 * i,
+                "measures": [{"@id": "m{}".format(i)}],
+                "stageScale": {"typicalRangeLow": 0.0, "typicalRangeHigh": 1.0},
+            }
+            for i in range(5)
+        ]
+    }
+    api.set_levels = lambda levels, date_time: api.routes.__setitem__(
+        "/measures",
+        {
+            "items": [
+                {
+                    "latestReading": {
+                        "measure": "m{}".format(i),
+                        "dateTime": date_time,
+                        "value": level,
+                    }
+                }
+                for i, level in enumerate(levels)
+            ]
+        },
+    )
+    return api
+
+
+def test_refresh(network):
+    scheduler = RefreshScheduler()
+    network.set_levels([0.5, 1.2, 0.1, 2.0, 0.3], "2020-02-10T14:00:00Z")
+    first = scheduler.refresh()
+    assert first.version == 1
+    assert first.changed is None
+    assert first.ranking.top(2).tolist() == [3, 1]
+    for column in (first.table.latest_level, first.table.name):
+        with pytest.raises(ValueError):
+            column[0] = column[1]
+    stations = first.ranking.stations(first.ranking.top(2))
+    assert [s.latest_level for s in stations] == [2.0, 1.2]
+    assert first.ranking.stations([3])[0] is stations[0]
+
+    network.set_levels([0.5, 1.2, 1.6, 2.0, 0.3], "2020-02-10T14:15:00Z")
+    second = scheduler.refresh()
+    assert second.version == 2
+    assert second.changed.tolist() == [2]
+    assert second.ranking.top(2).tolist() == [3, 2]
+    # earlier snapshots are not modified
+    assert first.table.latest_level[2] == 0.1
+    assert first.table.station(2).latest_level == 0.1
+    assert second.table.station(2).latest_level == 1.6
+
+
+def test_refresh_after_ttl(network, tmp_cache):
+    scheduler = RefreshScheduler()
+    network.set_levels([0.5, 1.2, 0.1, 2.0, 0.3], "2020-02-10T14:00:00Z")
+    scheduler.refresh()
+
+    # the level data is past its time to live, but may still be served stale
+    ttl, stale_ttl = datafetcher.CACHE_POLICY["level_data"]
+    meta = tmp_cache.read_meta("level_data")
+    meta["fetched"] -= ttl + stale_ttl / 2
+    datafetcher.dump(meta, tmp_cache._meta_path("level_data"))
+    network.set_levels([0.5, 1.2, 1.6, 2.0, 0.3], "2020-02-10T14:15:00Z")
+    second = scheduler.refresh()
+    assert second.changed.tolist() == [2]
+    assert second.table.latest_level[2] == 1.6
+
+    # and within its time to live
+    network.set_levels([0.5, 1.2, 1.6, 2.0, 0.4], "2020-02-10T14:30:00Z")
+    assert scheduler.refresh().changed.tolist() == [4]
+
+
+def test_scheduler_thread(network):
+    network.set_levels([0.5, 1.2, 0.1, 2.0, 0.3], "2020-02-10T14:00:00Z")
+    scheduler = RefreshScheduler(interval=0.05)
+    published = []
+    second = threading.Event()
+
+    def callback(snapshot):
+        published.append(snapshot.version)
+        if snapshot.version >= 2:
+            second.set()
+
+    unsubscribe = scheduler.subscribe(callback)
+    scheduler.start()
+    try:
+        assert scheduler.snapshot(timeout=10).version >= 1
+        assert second.wait(10)
+    finally:
+        scheduler.stop()
+    unsubscribe()
+    assert published[:2] == [1, 2]
+
+
+def test_stages(network):
+    network.set_levels([0.5, 1.2, 1.6, 2.0, 1.9], "2020-02-10T14:00:00Z")
+    scheduler = RefreshScheduler()
+    calls = []
+
+    def flaky(snapshot):
+        calls.append(snapshot.version)
+        if snapshot.version == 2:
+            raise RuntimeError("upstream failure")
+        return snapshot.version
+
+    scheduler.add_stage("clusters", lambda s: risk_clusters(s, tol=1.5))
+    scheduler.add_stage("risk_index", risk_index)
+    scheduler.add_stage("flaky", flaky)
+    scheduler.add_stage("previous", lambda s: s.extras["flaky"])
+
+    first = scheduler.refresh()
+    # three neighbouring stations, fewer than a cluster
+    assert first.extras["clusters"].tolist() == [-1, -1, -1]
+    assert list(first.extras["risk_index"]) == first.ranking.stations(
+        first.ranking.over(1.5)
+    )
+    assert len(first.extras["risk_index"]) == 3
+    assert first.extras["previous"] == 1
+    with pytest.raises(TypeError):
+        first.extras["flaky"] = 0
+
+    # a failing stage keeps the value of the previous refresh
+    second = scheduler.refresh()
+    assert second.extras["flaky"] == 1
+    assert calls == [1, 2]
+
+
+def test_scheduler_retry(network):
+    # the level data is missing, so the first refresh fails
+    scheduler = RefreshScheduler(interval=3600, retry_interval=0.05)
+    scheduler.start()
+    try:
+        assert scheduler.snapshot(timeout=0.01) is None
+        network.set_levels([0.5, 1.2, 0.1, 2.0, 0.3], "2020-02-10T14:00:00Z")
+        # retried well before the refresh interval
+        snapshot = scheduler.snapshot(timeout=10)
+        assert snapshot is not None and snapshot.version == 1
+    finally:
+        scheduler.stop()
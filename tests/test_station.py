@@ -3,6 +3,8 @@
 # SPDX-License-Identifier: MIT
 """Unit test for the station module"""
 
+import numpy as np
+
 from floodsystem.station import *
 
 
@@ -134,3 +136,77 @@ class TestClass:
 
         station2.latest_level = 0.5
         assert station2.relative_water_level() is None
+
+    def test_relative_water_level_cached(self):
+        s = MonitoringStation("1", "m1", "A", (0.0, 1.0), (1.0, 3.0), "River 1", "T")
+        assert not hasattr(s, "__dict__")
+        assert s.relative_water_level() is None
+
+        s.latest_level = 2.0
+        assert s.relative_water_level() == 0.5
+        assert s.relative_water_level() == 0.5
+
+        # assigning a new level invalidates the cached relative level
+        s.latest_level = 3.0
+        assert s.relative_water_level() == 1.0
+        s.latest_level = None
+        assert s.relative_water_level() is None
+
+    def test_station_table(self):
+        stations = [
+            MonitoringStation("1", "m1", "A", (0.0, 1.0), (1.0, 4.0), "River 1", "T"),
+            MonitoringStation("2", "m2", "B", (1.0, 1.0), None, None, "T"),
+            MonitoringStation("3", "m3", "C", (2.0, 1.0), (0.0, 0.0), "River 2", None),
+            MonitoringStation("4", "m4", "D", (3.0, 1.0), (0.0, 2.0), "River 1", "U"),
+        ]
+        stations[0].latest_level = 2.5
+        stations[3].latest_level = 3.0
+
+        table = StationTable.from_stations(stations)
+        assert len(table) == 4
+        assert table.coord.tolist() == [list(s.coord) for s in stations]
+        assert table.river.tolist() == [s.river for s in stations]
+        assert table.town.tolist() == [s.town for s in stations]
+        assert table.typical_range_consistent().tolist() == [
+            s.typical_range_consistent() for s in stations
+        ]
+        assert [
+            None if np.isnan(level) else level for level in table.relative_water_level()
+        ] == [s.relative_water_level() for s in stations]
+        assert inconsistent_typical_range_stations(
+            table
+        ) == inconsistent_typical_range_stations(stations)
+
+        # the original stations are kept, and not changed by the table
+        table.latest_level[1] = 0.5
+        assert table.to_stations() == stations
+        assert stations[1].latest_level is None
+        stations[0].latest_level = None
+        assert table.station(0).latest_level is None
+
+        subset = table[table.typical_range_consistent()]
+        assert subset.name.tolist() == ["A", "D"]
+        assert subset.station(1) is stations[3]
+
+        # stations built from the columns
+        table = StationTable(
+            station_id=["1"],
+            measure_id=["m1"],
+            name=["A"],
+            lat=[0.0],
+            lon=[1.0],
+            typical_low=[np.nan],
+            typical_high=[np.nan],
+            river=["River 1"],
+            town=[None],
+        )
+        station = table.station(0)
+        assert station.coord == (0.0, 1.0)
+        assert station.typical_range is None
+        assert station.town is None
+        assert station.latest_level is None
+        assert table.station(0) is station
+
+        # the level of a station built by the table follows the table
+        table.latest_level[0] = 1.5
+        assert table.station(0).latest_level == 1.5
@@ -3,7 +3,14 @@
 # SPDX-License-Identifier: MIT
 """Unit test for the stationdata module"""
 
-from floodsystem.stationdata import build_station_list, update_water_levels
+from floodsystem import datafetcher
+from floodsystem.station import MonitoringStation, StationTable
+from floodsystem.stationdata import (
+    build_station_list,
+    build_station_table,
+    update_water_levels,
+    WaterLevelUpdater,
+)
 
 
 def test_build_station_list():
@@ -28,3 +35,102 @@ def test_update_level():
             counter += 1
 
     assert counter > 0
+
+
+def test_build_station_list_streamed(api, tmp_cache, monkeypatch):
+    """Test building and updating stations from a stand-in API"""
+    monkeypatch.setattr(datafetcher, "STATION_URL", api.url("/stations"))
+    monkeypatch.setattr(datafetcher, "LEVEL_URL", api.url("/measures"))
+    api.routes["/stations"] = {
+        "meta": {},
+        "items": [
+            {
+                "@id": "s{}".format(i),
+                "label": "Station {}".format(i),
+                "lat": 52.0,
+                "long": 0.1 * i,
+                "measures": [{"@id": "m{}".format(i)}],
+                "riverName": "River {}".format(i % 3),
+                "stageScale": {"typicalRangeLow": 0.1, "typicalRangeHigh": 0.9},
+            }
+            for i in range(100)
+        ]
+        # incomplete data is skipped
+        + [{"@id": "s100", "label": "Station 100"}],
+    }
+    api.routes["/measures"] = {
+        "items": [
+            {"latestReading": {"measure": "m{}".format(i), "value": 0.5}}
+            for i in range(0, 100, 2)
+        ]
+    }
+
+    stations = build_station_list()
+    assert len(stations) == 100
+    assert stations[1].river == "River 1"
+    assert stations[1].typical_range == (0.1, 0.9)
+
+    update_water_levels(stations)
+    assert sum(station.latest_level == 0.5 for station in stations) == 50
+
+    table = build_station_table()
+    assert len(table) == 100
+    assert table.rivers == ["River 0", "River 1", "River 2"]
+    assert table.station(1).typical_range == (0.1, 0.9)
+
+    update_water_levels(table)
+    assert (table.latest_level == 0.5).sum() == 50
+    assert table.station(0).latest_level == 0.5
+    assert table.station(1).latest_level is None
+
+
+def test_water_level_updater(api, tmp_cache, monkeypatch):
+    """Test applying only the readings that advanced"""
+    monkeypatch.setattr(datafetcher, "LEVEL_URL", api.url("/measures"))
+
+    def readings(values, date_time):
+        return {
+            "items": [
+                {
+                    "latestReading": {
+                        "measure": "m{}".format(i),
+                        "dateTime": date_time,
+                        "value": value,
+                    }
+                }
+                for i, value in values.items()
+            ]
+        }
+
+    stations = [
+        MonitoringStation(
+            "s{}".format(i),
+            "m{}".format(i),
+            "Station {}".format(i),
+            (52.0, 0.0),
+            (0.1, 0.9),
+            "River",
+            "Town",
+        )
+        for i in range(4)
+    ]
+    table = StationTable.from_stations(stations)
+    updater = WaterLevelUpdater(stations)
+    table_updater = WaterLevelUpdater(table)
+
+    api.routes["/measures"] = readings({0: 0.5, 1: 0.6, 2: 0.7}, "2020-02-10T14:00:00Z")
+    assert updater.update() == set(stations[:3])
+    assert table_updater.update() == {0, 1, 2}
+    assert [s.latest_level for s in stations] == [0.5, 0.6, 0.7, None]
+
+    # stale and unchanged readings are skipped
+    api.routes["/measures"] = readings(
+        {0: 0.4, 1: 0.6, 2: 0.9, 3: 0.2}, "2020-02-10T14:15:00Z"
+    )
+    api.routes["/measures"]["items"][0]["latestReading"][
+        "dateTime"
+    ] = "2020-02-10T14:00:00Z"
+    assert updater.update(use_cache=False) == {stations[2], stations[3]}
+    assert table_updater.update(use_cache=False) == {2, 3}
+    assert [s.latest_level for s in stations] == [0.5, 0.6, 0.9, 0.2]
+    assert table.latest_level.tolist() == [0.5, 0.6, 0.9, 0.2]